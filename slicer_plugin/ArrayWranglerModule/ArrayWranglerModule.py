@@ -1,8 +1,13 @@
+import collections
+import contextlib
+import functools
 import logging
 import os
+import time
 import vtk
+from vtk.util import numpy_support
 
-from PythonQt.QtCore import Qt
+from PythonQt.QtCore import Qt, QTimer
 
 import slicer
 from slicer.ScriptedLoadableModule import (
@@ -23,6 +28,17 @@ from slicer.util import VTKObservationMixin
 # pylint: skip-file
 
 from sort_library import sorting_logic as slogic
+from sort_library import engine as sengine
+from sort_library import object_table as sobjects
+from sort_library import label_cache as scache
+from sort_library import memory as smemory
+from sort_library import separation as sseparation
+from sort_library import morphology as smorphology
+from sort_library import mask_pipeline as smaskpipeline
+from sort_library import timing as stiming
+from sort_library import cubicle_writer as scubiclewriter
+from sort_library import orientation as sorientation
+from sort_library import axis_detection as saxisdetection
 from scipy import ndimage as ndi
 import numpy as np
 import random
@@ -54,6 +70,24 @@ logging.basicConfig(level=logging.DEBUG)
 FOLDER_ATTRIBUTE = "IsDataset"
 FOLDER_ATTRIBUTE_VALUE = "True"
 
+# When closed surfaces (3D meshes) of updated segmentations are built:
+# right away, after the operation has returned to the event loop
+# (one segment per timer tick, so the GUI stays responsive),
+# or only when requested (Build 3D Surfaces button or Show 3D
+# in the Segmentations module). Meshing thousands of segments
+# takes longer than the operations themselves.
+SURFACE_IMMEDIATE = "immediate"
+SURFACE_DEFERRED = "deferred"
+SURFACE_ON_DEMAND = "on_demand"
+SURFACE_MODES = {
+    SURFACE_IMMEDIATE: "Immediately",
+    SURFACE_DEFERRED: "After the operation",
+    SURFACE_ON_DEMAND: "On demand",
+}
+
+# Break reports its progress and processes GUI events every that many cubicles
+BREAK_PROGRESS_STEP = 100
+
 
 class ArrayWranglerModule(ScriptedLoadableModule):
     """Uses ScriptedLoadableModule base class, available at:
@@ -191,12 +225,33 @@ class ArrayWranglerModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
         self.ui.checkRasCompatible.connect(
             "stateChanged(int)", self.updateParameterNodeFromGUI
         )
+        self.ui.checkMemoryBudget.connect("toggled(bool)", self.onMemoryBudgetToggled)
+        for method, methodTitle in slogic.CLUSTERING_METHODS.items():
+            self.ui.clusteringMethodSelector.addItem(methodTitle, method)
+        self.ui.clusteringMethodSelector.connect(
+            "currentIndexChanged(int)", self.onClusteringMethodChanged
+        )
+        for level, levelTitle in scubiclewriter.COMPRESSION_LEVELS.items():
+            self.ui.exportCompressionSelector.addItem(levelTitle, level)
+        self.ui.exportCompressionSelector.setCurrentIndex(
+            self.ui.exportCompressionSelector.findData(
+                scubiclewriter.DEFAULT_COMPRESSLEVEL
+            )
+        )
+        for mode, modeTitle in SURFACE_MODES.items():
+            self.ui.surfaceModeSelector.addItem(modeTitle, mode)
+        self.ui.surfaceModeSelector.connect(
+            "currentIndexChanged(int)", self.onSurfaceModeChanged
+        )
 
         # Buttons
         self.ui.applyButton.connect("clicked(bool)", self.onApplyButton)
         self.ui.assessButton.connect("clicked(bool)", self.onAssessButton)
         self.ui.binaryErosionButton.connect("clicked(bool)", self.onErosionButton)
         self.ui.removeSmallObjectsButton.connect("clicked(bool)", self.onRemoveObButton)
+        self.ui.separateButton.connect("clicked(bool)", self.onSeparateButton)
+        self.ui.pipelineButton.connect("clicked(bool)", self.onPipelineButton)
+        self.ui.buildSurfacesButton.connect("clicked(bool)", self.onBuildSurfacesButton)
         self.ui.breakButton.connect("clicked(bool)", self.onBreakButton)
         self.ui.exportButton.connect("clicked(bool)", self.onExportButton)
         self.ui.activateHelperButton.connect(
@@ -214,6 +269,21 @@ class ArrayWranglerModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
         self.ui.btRotYCC.connect("clicked(bool)", self.onRotYCCButton)
         self.ui.btRotXCC.connect("clicked(bool)", self.onRotXCCButton)
         self.ui.btRotZCC.connect("clicked(bool)", self.onRotZCCButton)
+        self.ui.checkZeroCopyOrientation.connect(
+            "toggled(bool)", self.onZeroCopyOrientationToggled
+        )
+        self.ui.resetOrientationButton.connect(
+            "clicked(bool)", self.onResetOrientationButton
+        )
+        self.ui.checkQueueOrientation.connect(
+            "toggled(bool)", self.onQueueOrientationToggled
+        )
+        self.ui.commitOrientationButton.connect(
+            "clicked(bool)", self.onCommitOrientationButton
+        )
+        self.ui.discardOrientationButton.connect(
+            "clicked(bool)", self.onDiscardOrientationButton
+        )
         self.ui.refreshLocalButton.connect("clicked(bool)", self.onRefreshLocalButton)
         self.ui.treeDatasetLocal.setColumnCount(1)
         self.ui.treeDatasetLocal.setHeaderLabels(["Name"])
@@ -257,6 +327,14 @@ class ArrayWranglerModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
         """
         # Parameter node will be reset, do not use it anymore
         self.setParameterNode(None)
+        # cached labels refer to nodes of the closed scene
+        self.logic.labelCache.clear()
+        self.logic.pendingSurfaces.clear()
+        self.logic.surfaceQueue.clear()
+        self.logic.axisOrientations.clear()
+        self.logic.originalIjkToRas.clear()
+        self.logic.pendingOperations.clear()
+        colorTables.clear()
 
     def onSceneEndClose(self, caller, event):
         """
@@ -427,6 +505,44 @@ class ArrayWranglerModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
             else slogic.sorting_order_classic
         )
 
+    def getClusteringMethod(self):
+        """
+        Return the name of the clustering backend selected in UI.
+        """
+        return self.ui.clusteringMethodSelector.currentData
+
+    def onClusteringMethodChanged(self, index):
+        """
+        Offer to install scikit-learn when the 'kmeans' method is selected,
+        fall back to the exact 1D k-means if it is not installed.
+        """
+        method = self.ui.clusteringMethodSelector.itemData(index)
+        if method == "kmeans" and not importScikitLearn():
+            self.ui.clusteringMethodSelector.setCurrentIndex(
+                self.ui.clusteringMethodSelector.findData("optimal")
+            )
+
+    def onMemoryBudgetToggled(self, checked):
+        """
+        Switch the memory-budget mode of the logic.
+        """
+        self.logic.memoryBudgetMode = checked
+
+    def onSurfaceModeChanged(self, index):
+        """
+        Switch the mode of building closed surfaces of the logic.
+        """
+        self.logic.surfaceMode = self.ui.surfaceModeSelector.itemData(index)
+
+    def onBuildSurfacesButton(self):
+        """
+        Run processing when user clicks "Build 3D Surfaces" button.
+        """
+        with slicer.util.tryWithErrorDisplay(
+            "Failed to build surfaces.", waitCursor=True
+        ):
+            self.logic.buildPendingSurfaces()
+
     def onAssessButton(self):
         """
         Run processing when user clicks "Assess" button.
@@ -442,6 +558,14 @@ class ArrayWranglerModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
                 self.ui.checkVerbose.checked,
             )
             self.ui.assessLabel.text = f"Number of segments: {numSegments}"
+            if self.logic.memoryBudgetMode:
+                estimate, available = self.logic.processEstimateMemory(
+                    self.ui.inputSelector.currentNode()
+                )
+                memoryText = f"estimated peak memory: {estimate / 2**20:.0f} MB"
+                if available is not None:
+                    memoryText += f" of {available / 2**20:.0f} MB available"
+                self.ui.assessLabel.text += f", {memoryText}"
 
     def onErosionButton(self):
         """
@@ -474,6 +598,41 @@ class ArrayWranglerModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
                 self.ui.checkVerbose.checked,
             )
 
+    def onSeparateButton(self):
+        """
+        Run processing when user clicks "Separate Touching Objects" button.
+        """
+        with slicer.util.tryWithErrorDisplay(
+            "Failed to compute results.", waitCursor=True
+        ):
+
+            # Compute output
+            numSplit, numPieces = self.logic.processSeparate(
+                self.ui.inputSelector.currentNode(),
+                self.ui.inputSegmentSelector.currentNode(),
+                self.ui.sizeFactorSlider.value,
+                self.ui.checkVerbose.checked,
+            )
+            slicer.util.showStatusMessage(
+                f"Split {numSplit} touching objects into {numPieces} pieces", 5000
+            )
+
+    def onPipelineButton(self):
+        """
+        Run processing when user clicks "Run Pipeline" button.
+        """
+        with slicer.util.tryWithErrorDisplay(
+            "Failed to compute results.", waitCursor=True
+        ):
+
+            # Compute output
+            self.logic.processMaskPipeline(
+                self.ui.inputSelector.currentNode(),
+                self.ui.inputSegmentSelector.currentNode(),
+                self.ui.pipelineEdit.text,
+                self.ui.checkVerbose.checked,
+            )
+
     def onApplyButton(self):
         """
         Run processing when user clicks "Apply" button.
@@ -483,7 +642,7 @@ class ArrayWranglerModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
         ):
 
             # Compute output
-            self.logic.processApply(
+            layout = self.logic.processApply(
                 self.ui.inputSelector.currentNode(),
                 self.ui.inputSegmentSelector.currentNode(),
                 self.ui.outputSelector.currentNode(),
@@ -492,13 +651,31 @@ class ArrayWranglerModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
                 self.ui.mbasesEdit.text,
                 self.getSortingLogic(),
                 self.ui.checkVerbose.checked,
+                self.getClusteringMethod(),
+                self.ui.rowsPerLevelEdit.text,
+                self.ui.checkDetectAxes.checked,
             )
+            if layout is not None:
+                numLayers, rowsPerLevel, sortingOrder = layout
+                self.ui.layoutLabel.text = (
+                    f"Layers: {numLayers}, rows per layer: "
+                    f"{', '.join(str(rows) for rows in rowsPerLevel)}"
+                )
+                if self.ui.checkDetectAxes.checked:
+                    self.ui.layoutLabel.text += (
+                        f"\nAxes: {saxisdetection.describe_sorting_order(sortingOrder)}"
+                    )
 
     def onBreakButton(self):
         """
         Run processing when user clicks "Break" button.
         """
         success = False
+        # cubicles can be written to the export folders while breaking
+        streamPathSource, streamPathSegm = "", ""
+        if self.ui.checkStreamBreak.checked:
+            streamPathSource = self.ui.saveField.currentPath
+            streamPathSegm = self.ui.savePathSegm.currentPath
         with slicer.util.tryWithErrorDisplay("Failed to break.", waitCursor=True):
 
             # Compute output
@@ -509,6 +686,10 @@ class ArrayWranglerModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
                 int(self.ui.marginSliderWidget.value),
                 self.ui.namePrefixEdit.text,
                 self.ui.checkVerbose.checked,
+                savePathSource=streamPathSource,
+                savePathSegm=streamPathSegm,
+                populateScene=self.ui.checkPopulateScene.checked,
+                compressLevel=self.ui.exportCompressionSelector.currentData,
             )
             success = True
         if success:
@@ -525,16 +706,18 @@ class ArrayWranglerModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
         with slicer.util.tryWithErrorDisplay("Failed to export.", waitCursor=True):
 
             # Compute output
-            self.logic.processExport(
+            numFiles, throughput = self.logic.processExport(
                 self._parameterNode.GetParameter("Key_local"),
                 self.ui.saveField.currentPath,
                 self.ui.savePathSegm.currentPath,
                 self.ui.checkVerbose.checked,
+                self.ui.exportCompressionSelector.currentData,
             )
             success = True
         if success:
             slicer.util.infoDisplay(
-                "Processing completed successfully.",
+                "Processing completed successfully: "
+                f"{numFiles} files written, {throughput:.1f} MB/s.",
                 windowTitle="ArrayWranglerModule",
             )
             self._parameterNode.SetParameter("Key_local", "")
@@ -741,6 +924,63 @@ class ArrayWranglerModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
                 axes=(self.getSortingLogic().get("rotation_y", (1, 2)))[::-1],
             )
 
+    def onZeroCopyOrientationToggled(self, checked):
+        """
+        Switch between reorienting volumes by their geometry
+        and rewriting their voxels.
+        """
+        self.logic.zeroCopyOrientation = checked
+
+    def onResetOrientationButton(self):
+        """
+        When the button 'Reset orientation' is clicked
+        It brings the geometry of the volume(s) reoriented without
+        rewriting voxels back to the original orientation
+        """
+        logging.debug("Reset orientation clicked")
+        with slicer.util.tryWithErrorDisplay("Failed to process", waitCursor=True):
+            self.logic.resetOrientation(
+                self.ui.inputSelector.currentNode(),
+                self.ui.inputSegmentSelector.currentNode(),
+                self.ui.alignHelperSelector.currentNode(),
+            )
+
+    def onQueueOrientationToggled(self, checked):
+        """
+        Switch between queueing flips/swaps/rotations (previewed on the helper)
+        and applying them right away.
+        """
+        self.logic.queueOrientation = checked
+
+    def onCommitOrientationButton(self):
+        """
+        When the button 'Commit orientation' is clicked
+        It applies the queued flips/swaps/rotations to the volume(s) at once
+        """
+        logging.debug("Commit orientation clicked")
+        with slicer.util.tryWithErrorDisplay("Failed to process", waitCursor=True):
+            numOperations = self.logic.commitOrientation(
+                self.ui.inputSelector.currentNode(),
+                self.ui.inputSegmentSelector.currentNode(),
+                self.ui.alignHelperSelector.currentNode(),
+            )
+            slicer.util.showStatusMessage(
+                f"Applied {numOperations} queued orientation changes", 5000
+            )
+
+    def onDiscardOrientationButton(self):
+        """
+        When the button 'Discard queued' is clicked
+        It drops the queued flips/swaps/rotations
+        """
+        logging.debug("Discard orientation clicked")
+        with slicer.util.tryWithErrorDisplay("Failed to process", waitCursor=True):
+            self.logic.discardOrientation(
+                self.ui.inputSelector.currentNode(),
+                self.ui.inputSegmentSelector.currentNode(),
+                self.ui.alignHelperSelector.currentNode(),
+            )
+
     def onDatasetAvailClicked(self, index):
         """
         Handle click events on the available datasets items.
@@ -806,6 +1046,49 @@ class ArrayWranglerModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixi
 #
 # ArrayWranglerModuleLogic
 #
+def reportsPeakMemory(method):
+    """
+    Decorator of the logic process* methods: in the memory-budget mode
+    the peak memory of the call is logged and kept in logic.memoryReports.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with smemory.peak_memory(
+            method.__name__, enabled=self.memoryBudgetMode
+        ) as report:
+            result = method(self, *args, **kwargs)
+        if self.memoryBudgetMode:
+            self.memoryReports[method.__name__] = report
+        return result
+
+    return wrapper
+
+
+def reportsStageTimes(method):
+    """
+    Decorator of the logic methods: the durations of the stages of the call
+    (see logic.stage) are logged and kept in logic.timingReports.
+    Decorated methods called from a decorated method add their stages
+    to the report of the outer call.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.stageTimer is not None:
+            return method(self, *args, **kwargs)
+        self.stageTimer = stiming.StageTimer(method.__name__)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            timer, self.stageTimer = self.stageTimer, None
+            timer.stop()
+            timer.log()
+            self.timingReports[method.__name__] = timer
+
+    return wrapper
+
+
 class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
     """This class should implement all the actual
     computation done by your module.  The interface
@@ -814,12 +1097,282 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
     requiring an instance of the Widget.
     """
 
-    def __init__(self):
+    def __init__(
+        self,
+        labelCacheBudgetMB=scache.LABEL_CACHE_BUDGET_MB,
+        labelSlabSize=0,
+        memoryBudgetMode=False,
+        surfaceMode=SURFACE_IMMEDIATE,
+    ):
         """
         Called when the logic class is instantiated.
         Can be used for initializing member variables.
+        :param labelCacheBudgetMB: memory budget of the cache of labeled masks
+        (MB), 0 disables caching
+        :param labelSlabSize: if > 0, masks are labeled in slabs of that many
+        planes (lower peak memory for large volumes), 0 - the whole volume at once
+        :param memoryBudgetMode: if True, masks are labeled straight into uint16,
+        enumerated labels are kept in the narrowest unsigned dtype
+        and the peak memory of process* calls is reported
+        :param surfaceMode: when closed surfaces of updated segmentations
+        are built, one of SURFACE_MODES
         """
         ScriptedLoadableModuleLogic.__init__(self)
+        self.memoryBudgetMode = memoryBudgetMode
+        self.memoryReports = {}  # name of the process* method -> MemoryReport
+        self.labelSlabSize = labelSlabSize
+        # labeled masks and their object tables, keyed on the segmentation
+        # content (see segmentationCacheKey), so Assess, Remove Small Objects
+        # and Apply on the same mask label it only once
+        self.labelCache = scache.LabelCache(labelCacheBudgetMB)
+        self.surfaceMode = surfaceMode
+        # IDs of segmentation nodes waiting for their closed surfaces
+        self.pendingSurfaces = set()
+        # (node ID, segment ID) pairs converted one per timer tick in the
+        # deferred mode, segment ID None completes the node
+        self.surfaceQueue = collections.deque()
+        self.surfaceBuildScheduled = False
+        self.stageTimer = None  # StageTimer of the running operation
+        self.timingReports = {}  # name of the method -> StageTimer
+        # if True, flips/swaps/rotations change the IJK to RAS matrix of
+        # the volume and the mask geometry instead of rewriting their voxels
+        self.zeroCopyOrientation = False
+        # ID of the volume node -> AxisOrientation of its aligned axes
+        self.axisOrientations = {}
+        # ID of the volume node -> its IJK to RAS matrix (spacing included)
+        # before the first reorientation, restored by resetOrientation
+        self.originalIjkToRas = {}
+        # if True, flips/swaps/rotations are queued and previewed on the helper
+        # until commitOrientation (or Apply) applies them at once
+        self.queueOrientation = False
+        # ID of the volume node -> list of queued (name, args, kwargs)
+        self.pendingOperations = {}
+
+    def stage(self, name):
+        """
+        Context manager timing a stage of the running operation
+        (does nothing outside of a method decorated by reportsStageTimes).
+        """
+        if self.stageTimer is None:
+            return contextlib.nullcontext()
+        return self.stageTimer.stage(name)
+
+    def requestClosedSurface(self, segmentationNode):
+        """
+        Build the closed surface representation of an updated segmentation
+        right away or schedule it, depending on the surface mode.
+        :param segmentationNode: segmentation node with updated segments
+        """
+        if self.surfaceMode == SURFACE_IMMEDIATE:
+            with self.stage("surface"):
+                segmentationNode.CreateClosedSurfaceRepresentation()
+            return
+        # an outdated surface would be shown in 3D until the new one is built
+        segmentationNode.RemoveClosedSurfaceRepresentation()
+        nodeID = segmentationNode.GetID()
+        self.pendingSurfaces.add(nodeID)
+        # segments queued before the update are converted again from scratch
+        self.surfaceQueue = collections.deque(
+            item for item in self.surfaceQueue if item[0] != nodeID
+        )
+        if self.surfaceMode == SURFACE_DEFERRED and not self.surfaceBuildScheduled:
+            # starts when the control returns to the event loop
+            self.surfaceBuildScheduled = True
+            QTimer.singleShot(0, self.buildNextSurface)
+
+    def buildNextSurface(self):
+        """
+        Build the closed surface of one pending segment and schedule the next
+        one (deferred surface mode), so the event loop runs between segments
+        and the application stays responsive while thousands of them are meshed.
+        """
+        if self.surfaceMode != SURFACE_DEFERRED:  # the mode has been switched
+            self.surfaceQueue.clear()
+            self.surfaceBuildScheduled = False
+            return
+        if not self.surfaceQueue:
+            nodeID = next(iter(self.pendingSurfaces), None)
+            if nodeID is None:
+                self.surfaceBuildScheduled = False
+                return
+            segmentationNode = slicer.mrmlScene.GetNodeByID(nodeID)
+            segmentIDs = (
+                segmentationNode.GetSegmentation().GetSegmentIDs()
+                if segmentationNode
+                else []
+            )
+            self.surfaceQueue.extend((nodeID, segmentID) for segmentID in segmentIDs)
+            self.surfaceQueue.append((nodeID, None))
+
+        nodeID, segmentID = self.surfaceQueue.popleft()
+        segmentationNode = slicer.mrmlScene.GetNodeByID(nodeID)
+        if segmentationNode is None:  # removed in the meantime
+            self.pendingSurfaces.discard(nodeID)
+        elif segmentID is None:
+            # all segments are converted, only the representation is registered
+            segmentationNode.CreateClosedSurfaceRepresentation()
+            self.pendingSurfaces.discard(nodeID)
+        elif segmentationNode.GetSegmentation().GetSegment(segmentID):
+            segmentationNode.GetSegmentation().ConvertSingleSegment(
+                segmentID,
+                slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName(),
+            )
+        QTimer.singleShot(0, self.buildNextSurface)
+
+    @reportsStageTimes
+    def buildPendingSurfaces(self):
+        """
+        Build the closed surfaces requested in the deferred
+        and on-demand surface modes at once.
+        :return: number of segmentation nodes updated
+        """
+        nodeIDs, self.pendingSurfaces = self.pendingSurfaces, set()
+        # a node can be partially converted by buildNextSurface
+        self.surfaceQueue.clear()
+        numBuilt = 0
+        for nodeID in nodeIDs:
+            segmentationNode = slicer.mrmlScene.GetNodeByID(nodeID)
+            if segmentationNode is None:  # removed in the meantime
+                continue
+            with self.stage("surface"):
+                # forced, a partially converted segmentation counts as converted
+                segmentationNode.GetSegmentation().CreateRepresentation(
+                    slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName(),
+                    True,
+                )
+            numBuilt += 1
+        return numBuilt
+
+    def axisOrientation(self, volumeNode):
+        """
+        Return the AxisOrientation of a volume reoriented without rewriting
+        its voxels (identity if it has not been reoriented).
+        """
+        orientation = self.axisOrientations.get(volumeNode.GetID())
+        return (
+            orientation if orientation is not None else sorientation.AxisOrientation()
+        )
+
+    def setAxisOrientation(self, inputNode, maskNode, orientation):
+        """
+        Reorient the volume and its mask by their geometry: the IJK to RAS
+        matrix of the volume is composed with the axis permutation/flips,
+        the same change is applied to the mask as a linear transform.
+        Every stored axis keeps its own spacing, i.e. the spacing is permuted
+        together with the axes, so anisotropic voxels are not stretched.
+        No voxels are copied.
+        :param inputNode: source volume node
+        :param maskNode: segmentation node of the mask (may be None)
+        :param orientation: new AxisOrientation of the aligned axes,
+        identity restores the original IJK to RAS matrix
+        """
+        nodeID = inputNode.GetID()
+        ijkToRas = ijkToRasArray(inputNode)
+        originalIjkToRas = self.originalIjkToRas.get(nodeID, ijkToRas)
+        if orientation.is_identity:
+            newIjkToRas = originalIjkToRas
+        else:
+            shape = slicer.util.arrayFromVolume(inputNode).shape
+            indexMatrix = orientation.ijk_matrix(shape)  # stored -> aligned IJK
+            spacing = np.linalg.norm(originalIjkToRas[:3, :3], axis=0)
+            directions = originalIjkToRas[:3, :3] / spacing
+            # geometry of the aligned volume: the original directions and origin,
+            # the spacing of the stored axis that every aligned axis comes from
+            alignedIjkToRas = originalIjkToRas.copy()
+            alignedIjkToRas[:3, :3] = directions * (
+                np.abs(indexMatrix[:3, :3]) @ spacing
+            )
+            newIjkToRas = alignedIjkToRas @ indexMatrix
+        inputNode.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(newIjkToRas))
+        if maskNode:
+            maskNode.ApplyTransformMatrix(
+                slicer.util.vtkMatrixFromArray(newIjkToRas @ np.linalg.inv(ijkToRas))
+            )
+        if orientation.is_identity:
+            self.axisOrientations.pop(nodeID, None)
+            self.originalIjkToRas.pop(nodeID, None)
+        else:
+            self.axisOrientations[nodeID] = orientation
+            self.originalIjkToRas[nodeID] = originalIjkToRas
+
+    def resetOrientation(self, inputNode, maskNode, helperNode=None):
+        """
+        Bring the volume and the mask reoriented by their geometry back
+        to the original orientation (the IJK to RAS matrix stored before
+        the first reorientation) and redraw the helper.
+        """
+        if not inputNode:
+            raise ValueError("Input volume is invalid")
+        self.setAxisOrientation(inputNode, maskNode, sorientation.AxisOrientation())
+        self.redrawHelper(inputNode, maskNode, helperNode)
+
+    def labelMask(self, inputMask, referenceVolume, boolVerbose=False):
+        """
+        Label connected components of the visible segments of the mask,
+        reusing the cached result if the mask has not been changed.
+        :param inputMask: segmentation node with the mask
+        :param referenceVolume: volume defining the geometry of the labelmap
+        :return: tuple of the read-only labeled image and its ObjectTable
+        """
+        # the labeling settings are a part of the key: the memory-budget
+        # mode changes the dtype of the labels, a slab size the way they are made
+        key = (
+            ("labels",)
+            + segmentationCacheKey(inputMask, referenceVolume)
+            + (self.memoryBudgetMode, self.labelSlabSize)
+        )
+        cached = self.labelCache.get(key)
+        if cached is not None:
+            if boolVerbose:
+                logging.info("Reusing cached labels of the mask")
+            return cached
+
+        with self.stage("export"):
+            labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass(
+                "vtkMRMLLabelMapVolumeNode"
+            )
+            slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(
+                inputMask, labelmapVolumeNode, referenceVolume
+            )
+        label_img = slicer.util.arrayFromVolume(labelmapVolumeNode)
+        engine = sengine.SortingEngine(
+            debug=boolVerbose,
+            slab_size=self.labelSlabSize,
+            label_workers=os.cpu_count() or 1,
+            compact=self.memoryBudgetMode,
+        )
+        with self.stage("label"):
+            label_img_enum, table = engine.label(label_img)
+        slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+        self.labelCache.put(key, label_img_enum, table)
+        return label_img_enum, table
+
+    def enumeratedObjects(self, enumeratedNode, referenceVolume):
+        """
+        Export the enumerated segmentation as a labelmap and collect
+        its object table, reusing the cached result if the segmentation
+        has not been changed.
+        :return: tuple of the read-only labelmap array and its ObjectTable
+        """
+        key = ("objects",) + segmentationCacheKey(enumeratedNode, referenceVolume)
+        cached = self.labelCache.get(key)
+        if cached is not None:
+            return cached
+
+        with self.stage("export"):
+            labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass(
+                "vtkMRMLLabelMapVolumeNode"
+            )
+            slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(
+                enumeratedNode, labelmapVolumeNode, referenceVolume
+            )
+            # a copy, the array should outlive the temporary node
+            enum_array = np.array(slicer.util.arrayFromVolume(labelmapVolumeNode))
+            slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+        with self.stage("objects"):
+            table = sobjects.object_table(enum_array)
+        self.labelCache.put(key, enum_array, table)
+        return enum_array, table
 
     def setDefaultParameters(self, parameterNode):
         """
@@ -828,6 +1381,20 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         # if not parameterNode.GetParameter("NumLayers"):
         #    parameterNode.SetParaupdateGUIFromParameterNodemeter("NumLayers", "4")
 
+    def processEstimateMemory(self, inputVolume):
+        """
+        Estimate the peak memory of enumerating a mask in the geometry
+        of the input volume (see smemory.estimate_peak_bytes).
+        :param inputVolume: volume defining the geometry
+        :return: tuple of the estimate and the available memory in bytes
+        (None if unknown)
+        """
+        imageData = inputVolume.GetImageData()
+        dims = imageData.GetDimensions() if imageData else (0, 0, 0)
+        return smemory.estimate_peak_bytes(dims), smemory.available_memory_bytes()
+
+    @reportsPeakMemory
+    @reportsStageTimes
     def processAssess(
         self,
         inputVolume,
@@ -850,38 +1417,34 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         # label_img = slicer.util.arrayFromVolume(inputVolume).astype(np.uint8)
         # label_img = slicer.util.arrayFromVolume(inputMask).astype(np.uint8)
 
-        labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass(
-            "vtkMRMLLabelMapVolumeNode"
-        )
-        slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(
-            inputMask, labelmapVolumeNode, inputVolume
-        )
-        label_img = slicer.util.arrayFromVolume(labelmapVolumeNode)
-        label_img = np.where(label_img > 0, 1, 0)  # binarization
-
-        label_img_enum, _ = ndi.label(label_img)
-        enum_labels = np.unique(label_img_enum)[1:]
+        label_img_enum, table = self.labelMask(inputMask, inputVolume, boolVerbose)
         if boolVerbose:
-            logging.info(f"{label_img.shape = } {label_img.dtype = }")
-            logging.info(f"{np.unique(label_img_enum) = }")
-            logging.info(f"{enum_labels = }")
+            logging.info(f"{label_img_enum.shape = } {label_img_enum.dtype = }")
+            logging.info(f"{table.labels = }")
+            logging.info(f"{table.counts = }")
 
-        slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
-        return enum_labels.size
+        return table.num_objects
 
+    @reportsPeakMemory
+    @reportsStageTimes
     def processErosion(
         self,
         inputVolume,
         inputMask,
         boolVerbose=False,
+        iterations=1,
+        structure=None,
     ):
         """
         Run the algorithm to perform binary erosion on the mask.
         It will modify the inputMask in place, and the mask
         will remain binary.
+        The volume is eroded in overlapping blocks on all cores.
         :param inputVolume: source volume to serve as reference
         :param inputMask: mask volume to be used for enumeration
         :param boolVerbose: if True, then print debug information
+        :param iterations: number of erosions
+        :param structure: structuring element, the 6-connected cross if None
 
         """
         if not inputVolume or not inputMask:
@@ -890,19 +1453,24 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         if boolVerbose:
             logging.info("Processing started")
 
-        labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass(
-            "vtkMRMLLabelMapVolumeNode"
-        )
-        slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(
-            inputMask, labelmapVolumeNode, inputVolume
-        )
+        with self.stage("export"):
+            labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass(
+                "vtkMRMLLabelMapVolumeNode"
+            )
+            slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(
+                inputMask, labelmapVolumeNode, inputVolume
+            )
         label_img = slicer.util.arrayFromVolume(labelmapVolumeNode)
-        label_img = label_img.astype(bool)  # binarization
         if boolVerbose:
             logging.info(
                 f"Before erosion: {label_img.shape=}, {np.count_nonzero(label_img)=}"
             )
-        label_img = ski.morphology.binary_erosion(label_img).astype(np.uint8)
+        # binarization happens block by block inside the erosion,
+        # the bool result is reinterpreted as uint8 without a copy
+        with self.stage("erosion"):
+            label_img = smorphology.binary_erosion(
+                label_img, structure, iterations, workers=os.cpu_count()
+            ).view(np.uint8)
         if boolVerbose:
             logging.info(
                 f"After erosion {label_img.shape=}, {np.count_nonzero(label_img)=}"
@@ -912,20 +1480,79 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
             slicer.mrmlScene.RemoveNode(inputMask)
             return
 
-        slicer.util.updateVolumeFromArray(labelmapVolumeNode, label_img)
+        slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+        self.importMask(label_img, inputMask, inputVolume)
+
+    def importMask(self, label_img, inputMask, inputVolume, createSurface=True):
+        """
+        Replace the segments of the mask segmentation by a binary mask array.
+        :param label_img: binary mask (uint8) in the geometry of inputVolume
+        :param inputMask: segmentation node to be updated
+        :param inputVolume: reference volume
+        :param createSurface: if True, request the closed surface representation
+        (built right away or later, see requestClosedSurface)
+        """
+        with self.stage("import"):
+            labelmapVolumeNode = createLabelmapLike(inputVolume)
+            slicer.util.updateVolumeFromArray(labelmapVolumeNode, label_img)
+            colorTableNode = setColorTable([0, 1])
+            labelmapVolumeNode.GetDisplayNode().SetAndObserveColorNodeID(
+                colorTableNode.GetID()
+            )
+            inputMask.GetSegmentation().RemoveAllSegments()  # in case we reuse
+            slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(
+                labelmapVolumeNode, inputMask
+            )
+            slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+        if createSurface:
+            self.requestClosedSurface(inputMask)
 
-        # slicer.util.updateVolumeFromArray(outputVolume, label_img_enum_copy)
-        colorTableNode = setColorTable([0, 1])
-        labelmapVolumeNode.GetDisplayNode().SetAndObserveColorNodeID(
-            colorTableNode.GetID()
-        )
-        inputMask.GetSegmentation().RemoveAllSegments()  # in case we reuse
-        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(
-            labelmapVolumeNode, inputMask
-        )
-        inputMask.CreateClosedSurfaceRepresentation()
+    @reportsPeakMemory
+    @reportsStageTimes
+    def processMaskPipeline(
+        self,
+        inputVolume,
+        inputMask,
+        steps,
+        boolVerbose=False,
+    ):
+        """
+        Run a chain of mask operations (erosion, small object removal,
+        separation of touching objects) in a single export/import roundtrip:
+        the segmentation is exported once, all steps run on the array,
+        the result is imported once and the surface is rebuilt at the end.
+        It will modify the inputMask in place, and the mask will remain binary.
+        :param inputVolume: source volume to serve as reference
+        :param inputMask: mask volume to be modified
+        :param steps: list of (operation name, parameters) tuples, see
+        smaskpipeline.MASK_OPERATIONS, or a text like "erosion 2; remove_small 30"
+        :param boolVerbose: if True, then print debug information
+        """
+        if not inputVolume or not inputMask:
+            raise ValueError("Input mask or reference input volume is invalid")
+        if isinstance(steps, str):
+            steps = smaskpipeline.parse_pipeline(steps)
+        if not steps:
+            logging.error("Empty mask pipeline. Canceling operation.")
+            return
+
+        with self.stage("export"):
+            labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass(
+                "vtkMRMLLabelMapVolumeNode"
+            )
+            slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(
+                inputMask, labelmapVolumeNode, inputVolume
+            )
+        label_img = slicer.util.arrayFromVolume(labelmapVolumeNode)
+        with self.stage("pipeline"):
+            mask = smaskpipeline.run_pipeline(
+                label_img, steps, workers=os.cpu_count(), debug=boolVerbose
+            )
         slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+        self.importMask(mask.view(np.uint8), inputMask, inputVolume)
 
+    @reportsPeakMemory
+    @reportsStageTimes
     def processRemoveSmallObj(
         self,
         inputVolume,
@@ -949,46 +1576,81 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         if boolVerbose:
             logging.info("Processing started")
 
-        labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass(
-            "vtkMRMLLabelMapVolumeNode"
-        )
-        slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(
-            inputMask, labelmapVolumeNode, inputVolume
-        )
-        label_img = slicer.util.arrayFromVolume(labelmapVolumeNode)
-        label_img = label_img.astype(bool)  # binarization
+        # objects are labeled once (or taken from the cache), and their sizes
+        # come from the object table (the same face connectivity as
+        # skimage remove_small_objects)
+        label_img_enum, table = self.labelMask(inputMask, inputVolume, boolVerbose)
         if boolVerbose:
-            logging.info(f"Before removal: {label_img.shape=} {label_img.dtype=}")
-        label_img = ski.morphology.remove_small_objects(label_img, obSize).astype(
-            np.uint8
-        )
+            logging.info(
+                f"Before removal: {label_img_enum.shape=} {table.num_objects=}"
+            )
+        with self.stage("removal"):
+            label_img = sobjects.remove_small_objects(
+                label_img_enum, table, obSize, workers=os.cpu_count()
+            ).view(np.uint8)
         if boolVerbose:
-            logging.info(f"After removal {label_img.shape=} {label_img.dtype=}")
+            removed = np.count_nonzero(table.counts < obSize)
+            logging.info(f"After removal {label_img.shape=} {removed = }")
 
-        slicer.util.updateVolumeFromArray(labelmapVolumeNode, label_img)
+        self.importMask(label_img, inputMask, inputVolume)
 
-        # slicer.util.updateVolumeFromArray(outputVolume, label_img_enum_copy)
-        colorTableNode = setColorTable([0, 1])
-        labelmapVolumeNode.GetDisplayNode().SetAndObserveColorNodeID(
-            colorTableNode.GetID()
-        )
-        inputMask.GetSegmentation().RemoveAllSegments()  # in case we reuse
-        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(
-            labelmapVolumeNode, inputMask
-        )
-        inputMask.CreateClosedSurfaceRepresentation()
-        slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+    @reportsPeakMemory
+    @reportsStageTimes
+    def processSeparate(
+        self,
+        inputVolume,
+        inputMask,
+        sizeFactor=sseparation.SIZE_FACTOR,
+        boolVerbose=False,
+    ):
+        """
+        Run the algorithm to split touching objects of the mask.
+        Objects larger than sizeFactor times the median object size are split
+        by a distance-transform watershed inside their bounding boxes.
+        It will modify the inputMask in place, and the mask will remain binary,
+        touching pieces are kept apart by clearing one voxel of their
+        contact (see sseparation.pieces_mask).
+        :param inputVolume: source volume to serve as reference
+        :param inputMask: mask volume to be used for enumeration
+        :param sizeFactor: size factor of merged objects
+        :param boolVerbose: if True, then print debug information
+        :return: tuple of the number of split objects and the number of pieces
+        """
+        if not inputVolume or not inputMask:
+            raise ValueError("Input mask or reference input volume is invalid")
 
+        if boolVerbose:
+            logging.info("Processing started")
+
+        label_img_enum, table = self.labelMask(inputMask, inputVolume, boolVerbose)
+        with self.stage("separation"):
+            separated, numSplit, numPieces = sseparation.separate_objects(
+                label_img_enum, table, sizeFactor, workers=os.cpu_count() or 1
+            )
+        if boolVerbose:
+            logging.info(f"{table.num_objects = } {numSplit = } {numPieces = }")
+        if numSplit == 0:
+            return 0, 0
+
+        mask = sseparation.pieces_mask(separated, table.max_label + 1)
+        self.importMask(mask.view(np.uint8), inputMask, inputVolume)
+        return numSplit, numPieces
+
+    @reportsPeakMemory
+    @reportsStageTimes
     def processApply(
         self,
         inputVolume,
         inputMask,
         outputVolume,
         numLayers,
-        numRows=3,  # TODO make it variable like mbases list
+        numRows=3,
         mbases="",
         sorting_order=slogic.sorting_order_classic,
         boolVerbose=False,
+        clusteringMethod="optimal",
+        rowsPerLevel="",
+        detectAxes=False,
     ):
         """
         Run the enumeration algorithm.
@@ -997,150 +1659,103 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         :param inputMask: mask volume to be used for enumeration
         :param outputVolume: enumerated result
         :param numLayers: number of layers in stack to be used for clustering
-        by height
-        :param numRows: number of rows on a layer/plate
+        by height, 0 - detect the number of layers automatically
+        :param numRows: number of rows on a layer/plate,
+        0 - detect the number of rows on every layer automatically
         :param mbases: mapping bases for enumeration, e.g. "100,200,300,400"
         :param boolVerbose: if True, then print debug information
+        :param clusteringMethod: backend to cluster layers and rows,
+        one of slogic.CLUSTERING_METHODS
+        :param rowsPerLevel: number of rows for every layer, e.g. "3,3,4"
+        (0 for automatic detection), overrides numRows if not empty
+        :param detectAxes: if True, the height, rows and columns axes are
+        detected from the object centroids (no alignment of the volume needed),
+        sorting_order gives the directions only
+        :return: tuple of the number of layers, list of rows per layer
+        and the sorting order used
 
         """
         if not inputVolume or not outputVolume or not inputMask:
             raise ValueError("Inputs or outputs are invalid")
-
-        # TODO : comment after debugging
-        import importlib
-
-        importlib.reload(slogic)
-        import time
+        # queued flips/swaps/rotations are applied to the data before sorting
+        self.commitOrientation(
+            inputVolume,
+            inputMask,
+            self.getParameterNode().GetNodeReference("alignHelperVolume"),
+        )
 
         numLayers = int(numLayers)
         numRows = int(numRows)
+        if len(rowsPerLevel) > 0:
+            numRows = parseIntList(rowsPerLevel)
+            if numRows is None:
+                logging.error("Wrong format of rows per layer. Canceling operation.")
+                return
+        mapping_bases = None  # default mapping [100, 200, 300, 400...]
+        if len(mbases) > 0:
+            mapping_bases = parseIntList(mbases)
+            if mapping_bases is None:
+                logging.error("Wrong format of mapping bases. Canceling operation.")
+                return
         startTime = time.time()
         if boolVerbose:
             logging.info("Processing started")
             logging.info("Updating output volume")
             logging.info(f"{numLayers = }")
-            logging.info(f"{numLayers = }")
-
-        # label_img = slicer.util.arrayFromVolume(inputVolume).astype(np.uint8)
-        # label_img = slicer.util.arrayFromVolume(inputMask).astype(np.uint8)
-
-        labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass(
-            "vtkMRMLLabelMapVolumeNode"
-        )
-        slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(
-            inputMask, labelmapVolumeNode, inputVolume
-        )
-        label_img = slicer.util.arrayFromVolume(labelmapVolumeNode)
-        label_img = np.where(label_img > 0, 1, 0)  # binarization
-
-        # TODO: remove this workaround when alinement feature is done
-        # label_img = np.swapaxes(label_img, 0, 2)  # temporary fix
-        label_img_enum, _ = ndi.label(label_img)
-        enum_labels = np.unique(label_img_enum)[1:]
-        if boolVerbose:
-            logging.info(f"{label_img.shape = } {label_img.dtype = }")
-            logging.info(f"{np.unique(label_img_enum) = }")
-            logging.info(f"{enum_labels = }")
-
-        # slicer.util.updateVolumeFromArray(outputVolume, input_nparray)
-        centroids = np.round(
-            ndi.center_of_mass(label_img_enum, label_img_enum, enum_labels)
-        ).astype(np.int32)
-
-        # 4 numLayers
-        sorted_level_labels = slogic.cluster_zcoord(
-            cpoints=centroids,
-            num_zclusters=numLayers,
-            sorder=sorting_order,
-            debug=boolVerbose,
-        )
-        if boolVerbose:
-            logging.info(f"{centroids.shape = }")
-            logging.info(f"{sorted_level_labels = }")
-
-        if len(mbases) > 0:
-            if "," in mbases:
-                mapping_bases = [int(mbase) for mbase in mbases.split(",")]
-            elif "-" in mbases:
-                mapping_bases = [int(mbase) for mbase in mbases.split("-")]
-            elif " " in mbases:
-                mapping_bases = [int(mbase) for mbase in mbases.split()]
-            else:
-                logging.error("Wrong format of mapping bases. Canceling operation.")
-                return
-            assert (
-                len(mapping_bases) == numLayers
-            ), "Number of mapping bases should be equal to number of layers."
-        else:  # mapping_bases = [100, 200, 300, 400] #
-            spacer = 100  # the 'space' between level numbers, should be made adjustable
-            mapping_bases = np.arange(spacer, (numLayers + 1) * spacer, spacer)
-        if boolVerbose:
+            logging.info(f"{numRows = }")
             logging.info(f"{mapping_bases = }")
 
-        final_remap = slogic.full_remap(
-            level_bases=mapping_bases,
-            center_points=centroids,
-            levelwise_labels=sorted_level_labels,
-            init_enum=enum_labels,
-            rows_onlevel=numRows,  # TODO: make it variable in a list
-            sorting_scheme=sorting_order,
+        engine = sengine.SortingEngine(
+            num_layers=numLayers,
+            num_rows=numRows,
+            mapping_bases=mapping_bases,
+            sorting_order=sorting_order,
+            clustering_method=clusteringMethod,
             debug=boolVerbose,
-        )
-        final_labels = sorted(set(final_remap.values()))
-        if boolVerbose:
-            logging.info(f"{final_remap = }")
-
-        label_img_enum_copy = label_img_enum.copy()
-
-        # restore the volume orientation from the workarond before
-        # TODO: remove this workaround when alinement feature is done
-        # label_img_enum_copy = np.swapaxes(label_img_enum_copy, 0, 2)
-        label_img_enum_copy = slogic.perform_remap(
-            remapping_dict=final_remap, enum_img=label_img_enum_copy
+            orientation=self.axisOrientations.get(inputVolume.GetID()),
+            detect_axes=detectAxes,
         )
 
-        # logging.info(f'Exporting labelmapVolumeNode level-wise enumeration')
+        label_img_enum, table = self.labelMask(inputMask, inputVolume, boolVerbose)
+        labelmapVolumeNode = createLabelmapLike(inputVolume)
 
-        """
-        # These steps would export the label map with original enumaration
-        # (having levels starting 100, 200 etc.)
-        slicer.util.updateVolumeFromArray(labelmapVolumeNode, label_img_enum_copy)
-        slicer.util.exportNode(labelmapVolumeNode,
-        "path/labelmapVolumeNode_level-wise.nii")
-        """
-        # self.temp_enum_array = label_img_enum_copy.copy()
-
-        # Bringing enumaration to consequtive format.
         # Converions between label map and Segmentation node working properly
         # with consequtive labels only
-        # Color Table doesn't accept large numbers like 100+, 200+ either
-        label_img_enum_copy = slogic.make_consequtive_labels(
-            enum_img=label_img_enum_copy, sparse_labels=final_labels
-        ).astype(np.int16)
-        if boolVerbose:
-            logging.info(
-                f"{label_img_enum_copy.shape = } {label_img_enum_copy.dtype = }"
+        # The label volume is int16 while the labels fit, and uint16/uint32
+        # for larger arrays of objects
+        # Color Table doesn't accept large numbers like 100+, 200+ either,
+        # so the level-wise labels are kept only in the segment names
+        with self.stage("sort"):
+            label_img_enum, result = engine.run_labeled(
+                label_img_enum,
+                table,
+                dtype=None if self.memoryBudgetMode else "auto",
             )
-        slicer.util.updateVolumeFromArray(labelmapVolumeNode, label_img_enum_copy)
+        if boolVerbose:
+            logging.info(f"{label_img_enum.shape = } {label_img_enum.dtype = }")
+        with self.stage("import"):
+            slicer.util.updateVolumeFromArray(labelmapVolumeNode, label_img_enum)
 
-        # slicer.util.updateVolumeFromArray(outputVolume, label_img_enum_copy)
-        colorTableNode = setColorTable(final_labels)
-        labelmapVolumeNode.GetDisplayNode().SetAndObserveColorNodeID(
-            colorTableNode.GetID()
-        )
-        outputVolume.GetSegmentation().RemoveAllSegments()  # in case we reuse
-        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(
-            labelmapVolumeNode, outputVolume
-        )
-        outputVolume.CreateClosedSurfaceRepresentation()
+            colorTableNode = setColorTable(result.sparse_labels)
+            labelmapVolumeNode.GetDisplayNode().SetAndObserveColorNodeID(
+                colorTableNode.GetID()
+            )
+            outputVolume.GetSegmentation().RemoveAllSegments()  # in case we reuse
+            slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(
+                labelmapVolumeNode, outputVolume
+            )
+        self.requestClosedSurface(outputVolume)
         stopTime = time.time()
         if boolVerbose:
             logging.info(f"Processing completed in {stopTime-startTime:.2f} seconds")
+        return result.num_layers, result.rows_per_level, result.sorting_order
 
         # logging.info(f'Exporting labelmapVolumeNode')
         # slicer.util.exportNode(labelmapVolumeNode,
         # "X:\Yaroslav\SlicerExtensions\labelmapVolumeNode.nii.gz")
 
+    @reportsPeakMemory
+    @reportsStageTimes
     def processBreak(
         self,
         inputNode,
@@ -1148,10 +1763,12 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         enumeratedNode,
         span,
         # boolPreserve,
-        # savePathSource,
-        # savePathSegm,
         namePrefix,
         boolVerbose,
+        savePathSource="",
+        savePathSegm="",
+        populateScene=True,
+        compressLevel=scubiclewriter.DEFAULT_COMPRESSLEVEL,
     ):
         """
         Run the processing algorithm to break the source volume into smaller cubicles
@@ -1160,6 +1777,13 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         inputNode (vtkMRMLScalarVolumeNode): Node with the source volume to be broken.
         maskNode (vtkMRMLScalarVolumeNode): Node with the mask volume for breaking.
         enumeratedNode (vtkMRMLScalarVolumeNode): Node with the enumerated volume.
+        savePathSource (string): if not empty, source cubicles are written
+        to this folder as they are carved (<name>_0000.nii.gz)
+        savePathSegm (string): if not empty, segmentation cubicles are written
+        to this folder as they are carved (<name>.nii.gz)
+        populateScene (bool): if True, cubicles are added to the scene
+        compressLevel (int): gzip level of the written files,
+        0 - uncompressed .nii
         Returns:
         None
         The function performs the following steps:
@@ -1167,19 +1791,17 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         2. Uses a temporary enumerated array for processing.
         3. Finds objects in the enumerated array.
         4. Expands the dimensions of the found objects by a specified number of voxels.
-        5. Breaks the expanded objects into smaller cubicles.
-        6. Creates new volume nodes for each cubicle and adds them to the scene.
+        5. Breaks the expanded objects into smaller cubicles one by one.
+        6. Streams every cubicle to files by a bounded pool of writer threads
+        and/or creates new volume nodes for it in the scene.
 
         """
-        # assert len(savePathSource) > 0 , "No output paths selected"
-        boolPreserve = True  # saving objects in the Slicer scene
-
-        source_img = slicer.util.arrayFromVolume(inputNode).astype(np.int16)
-        # enum_img = slicer.util.arrayFromVolume(inputMask).astype(np.uint8)
+        streaming = bool(savePathSource or savePathSegm)
+        if not streaming and not populateScene:
+            raise ValueError("No output folders selected and scene population is off")
 
-        labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass(
-            "vtkMRMLLabelMapVolumeNode"
-        )
+        # cubicles are cast to int16 one by one, the source volume is not copied
+        source_img = slicer.util.arrayFromVolume(inputNode)
 
         # This node will serve to transfer ColorTable from segmentation
         # node to separated pieces
@@ -1193,13 +1815,13 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         # slicer.modules.segmentations.logic().ExportAllSegmentsToLabelmapNode(
         # segmentationNode, labelmapVolumeNode,
         # slicer.vtkSegmentation.EXTENT_REFERENCE_GEOMETRY)
-        slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(
-            enumeratedNode, labelmapVolumeNode, inputNode
-        )
-        slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(
-            maskNode, labelmapSegNode, inputNode
-        )
-        enum_array = slicer.util.arrayFromVolume(labelmapVolumeNode)
+        with self.stage("export"):
+            slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(
+                maskNode, labelmapSegNode, inputNode
+            )
+        # labels and bounding boxes of the objects in one sweep
+        # (or from the cache, if the enumeration has not been changed)
+        enum_array, table = self.enumeratedObjects(enumeratedNode, inputNode)
         segm_img = slicer.util.arrayFromVolume(labelmapSegNode)
         node_segmentation = enumeratedNode.GetSegmentation()
         seg_ids = list(node_segmentation.GetSegmentIDs())
@@ -1208,131 +1830,140 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
             segment = node_segmentation.GetSegment(seg_id)
             seg_map[segment.GetLabelValue()] = segment.GetName()
         assert set(seg_map.keys()) == set(
-            np.unique(enum_array)[1:]
+            table.labels
         ), "Segmentation labels and enumerated labels are not matching"
 
-        obfound = ndi.find_objects(enum_array)  # labels_dbscan  labels_watershed
-
         # span = 5
-        ymax, xmax, zmax = enum_array.shape  #
-
-        ob_expanded = slogic.expand_object_dims(
-            obj_list=obfound, span=span, ymax0=ymax, xmax1=xmax, zmax2=zmax
-        )
+        ob_expanded = table.slices(span)
 
         if boolVerbose:
-            logging.info(f"{len(obfound) = }")
+            logging.info(f"{table.num_objects = }")
             logging.info(f"{len(ob_expanded) = }")
 
-        if boolVerbose:
-            logging.info("Processing obcubes_mask")
-        # so far unused
-        obcubes_mask, shapes = slogic.break_cubicles(ob_expanded, enum_array)
-
-        if boolVerbose:
-            logging.info("Processing obcubes_source")
-        obcubes_source, _ = slogic.break_cubicles(ob_expanded, source_img)
-
-        if boolVerbose:
-            logging.info("Processing obcubes_segm")
-        obcubes_segm, _ = slogic.break_cubicles(ob_expanded, segm_img)
-
-        # cleaning segmented cubicles by restricting the segmentation to
-        # enumerated mask (prevents the snapping of adjacent seeds)
-        obcubes_segm_clean = []
-        unique_labels = np.unique(enum_array)[1:]
-        for i, obcube_segm in enumerate(obcubes_segm):
-            lb_index = unique_labels[i]
-            lb_mask = obcubes_mask[i]
-            obcube_segm_new = np.where(lb_mask == lb_index, obcube_segm, 0)
-            obcubes_segm_clean.append(obcube_segm_new)
-
-        if boolVerbose:
-            logging.info(f"{len(obcubes_mask) = }")
-            logging.info(f"{len(obcubes_source) = }")
-            logging.info(f"{len(obcubes_segm_clean) = }")
-
-        # temp_path = r"\\filer-5\user\plutenko\projects\gitlab\playground"
-        # slicer.mrmlScene.CreateNodeByClass("vtkMRMLScalarVolumeNode")
-
         # color_table_seg = labelmapSegNode.GetDisplayNode().GetColorNode()
         # original_color_table_id = color_table_seg.GetID()
         original_color_table_id = labelmapSegNode.GetDisplayNode().GetColorNodeID()
 
-        # print(f"{original_color_table_id = }")
-        # TBD processing for segmentation node
-
-        # Getting Subject Hierarchy node to arrange newly created nodes
-        # under a folder node
-        shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-        sceneItemID = shNode.GetSceneItemID()
-        folderName = inputNode.GetName()
-        if len(namePrefix) > 0:
-            folderName = namePrefix + "_" + folderName
-        # checking if the folder with given name already exist
-        if shNode.GetItemByName(folderName) != 0:
-            folderName = f"{folderName}_{str(np.random.randint(np.iinfo(np.int16).max))}"  # 32767
+        writer = None
+        if streaming:
+            importNibabel()
+            # cubicles keep the spacing, directions and position of the source
+            writer = scubiclewriter.CubicleWriter(
+                savePathSource,
+                savePathSegm,
+                ijkToRasArray(inputNode),
+                workers=min(scubiclewriter.WRITER_THREADS, os.cpu_count() or 1),
+                compresslevel=compressLevel,
+            )
 
-        dataFolderNodeID = shNode.CreateFolderItem(sceneItemID, folderName)
-        shNode.SetItemAttribute(
-            dataFolderNodeID, FOLDER_ATTRIBUTE, FOLDER_ATTRIBUTE_VALUE
-        )
-        for lb, ob_source in enumerate(obcubes_source):
-            ob_node = slicer.mrmlScene.CreateNodeByClass("vtkMRMLScalarVolumeNode")
-            # deprecated version
-            # node_name = seg_map.get(lb + 1, f"Unknown_Segment_{lb+1}").replace(
-            #     "Segment", namePrefix
-            # )
-            node_name = seg_map.get(lb + 1, f"Unknown_Segment_{lb+1}").replace(
-                "Segment_", ""  # only label names to be left
+        # scene cubicles have no geometry, so the voxels of a volume reoriented
+        # by its geometry are laid out along the aligned axes
+        orientation = self.axisOrientation(inputNode)
+        if populateScene:
+            # Getting Subject Hierarchy node to arrange newly created nodes
+            # under a folder node
+            shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+            sceneItemID = shNode.GetSceneItemID()
+            folderName = inputNode.GetName()
+            if len(namePrefix) > 0:
+                folderName = namePrefix + "_" + folderName
+            # checking if the folder with given name already exist
+            if shNode.GetItemByName(folderName) != 0:
+                folderName = f"{folderName}_{str(np.random.randint(np.iinfo(np.int16).max))}"  # 32767
+
+            dataFolderNodeID = shNode.CreateFolderItem(sceneItemID, folderName)
+            shNode.SetItemAttribute(
+                dataFolderNodeID, FOLDER_ATTRIBUTE, FOLDER_ATTRIBUTE_VALUE
             )
-            ob_node.SetName(node_name)
-            slicer.util.updateVolumeFromArray(ob_node, ob_source)
-            slicer.mrmlScene.AddNode(ob_node)
-            # getting id of newly created node in the hierarchy space
-            hierarchyItemID = shNode.GetItemChildWithName(sceneItemID, node_name)
-            # and putting it under the folder item
-            shNode.SetItemParent(hierarchyItemID, dataFolderNodeID)
-            # ob_node.UnRegister(None)
-            # if len(savePathSource) > 0:
-            #     fname = node_name + "_0000.nii.gz"
-            #     slicer.util.exportNode(ob_node, os.path.join(savePathSource, fname))
-
-            # obseg_node = slicer.vtkMRMLSegmentationNode()
-            # slicer.mrmlScene.AddNode(obseg_node)
-            obseg_node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
-            obseg_node.CreateDefaultDisplayNodes()  # only needed for display
-            obseg_node.SetReferenceImageGeometryParameterFromVolumeNode(ob_node)
+            # one temporary labelmap node transfers all segmentation cubicles
             obseg_lbmapnode = slicer.mrmlScene.AddNewNodeByClass(
                 "vtkMRMLLabelMapVolumeNode"
             )
-            obseg_node.SetName(node_name)
             obseg_lbmapnode.CreateDefaultDisplayNodes()
-            slicer.util.updateVolumeFromArray(obseg_lbmapnode, obcubes_segm_clean[lb])
             obseg_lbmapnode.GetDisplayNode().SetAndObserveColorNodeID(
                 original_color_table_id
             )
-            slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(
-                obseg_lbmapnode, obseg_node
-            )
-            ob_node.UnRegister(None)
-            # getting id of newly created node in the hierarchy space under the root
-            # the node name is the same as for source volume, but it has been
-            # moved under the folder already
-            hierarchyItemID = shNode.GetItemChildWithName(sceneItemID, node_name)
-            shNode.SetItemParent(hierarchyItemID, dataFolderNodeID)
-            # if len(savePathSegm) > 0:
-            #     fsegname = node_name + ".nii.gz"
-            #     slicer.util.exportNode(
-            #         obseg_lbmapnode, os.path.join(savePathSegm, fsegname)
-            #     )
-            if not boolPreserve:
-                slicer.mrmlScene.RemoveNode(ob_node)
-                slicer.mrmlScene.RemoveNode(obseg_node)
-            slicer.mrmlScene.RemoveNode(obseg_lbmapnode)
-        slicer.mrmlScene.RemoveNode(labelmapSegNode)
-        slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+            # views and the data tree are updated once, when the state ends
+            slicer.mrmlScene.StartState(slicer.mrmlScene.BatchProcessState)
+        try:
+            for lb, obex in enumerate(ob_expanded):
+                labelValue = int(table.labels[lb])
+                node_name = seg_map.get(
+                    labelValue, f"Unknown_Segment_{labelValue}"
+                ).replace(
+                    "Segment_", ""  # only label names to be left
+                )
+                with self.stage("carve"):
+                    ob_source = source_img[obex].astype(np.int16)
+                    # cleaning segmented cubicles by restricting the segmentation
+                    # to enumerated mask (prevents the snapping of adjacent seeds)
+                    ob_segm = np.where(
+                        enum_array[obex] == labelValue, segm_img[obex], 0
+                    )
+                if writer is not None:
+                    # the writer owns the cubicles, the nodes below copy them
+                    # (waits here while the queue of the writer is full)
+                    with self.stage("write"):
+                        writer.submit(
+                            node_name,
+                            tuple(sl.start for sl in obex),
+                            ob_source,
+                            ob_segm,
+                        )
+                if not populateScene:
+                    continue
+
+                with self.stage("scene"):
+                    ob_node = slicer.mrmlScene.CreateNodeByClass(
+                        "vtkMRMLScalarVolumeNode"
+                    )
+                    ob_node.SetName(node_name)
+                    slicer.util.updateVolumeFromArray(
+                        ob_node, orientation.view(ob_source)
+                    )
+                    slicer.mrmlScene.AddNode(ob_node)
+                    # putting the node under the folder item by its own item
+                    # (not by a name lookup among all items of the scene)
+                    placeInFolder(shNode, ob_node, dataFolderNodeID)
+
+                    obseg_node = slicer.mrmlScene.AddNewNodeByClass(
+                        "vtkMRMLSegmentationNode"
+                    )
+                    obseg_node.CreateDefaultDisplayNodes()  # only needed for display
+                    obseg_node.SetReferenceImageGeometryParameterFromVolumeNode(ob_node)
+                    obseg_node.SetName(node_name)
+                    slicer.util.updateVolumeFromArray(
+                        obseg_lbmapnode, orientation.view(ob_segm)
+                    )
+                    slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(
+                        obseg_lbmapnode, obseg_node
+                    )
+                    ob_node.UnRegister(None)
+                    placeInFolder(shNode, obseg_node, dataFolderNodeID)
+                if (lb + 1) % BREAK_PROGRESS_STEP == 0:
+                    # keeps the application responsive
+                    slicer.util.showStatusMessage(
+                        f"Breaking: {lb + 1} of {len(ob_expanded)} cubicles"
+                    )
+                    slicer.app.processEvents()
+        finally:
+            if populateScene:
+                # the views and the data tree are updated here
+                with self.stage("scene"):
+                    slicer.mrmlScene.EndState(slicer.mrmlScene.BatchProcessState)
+                slicer.mrmlScene.RemoveNode(obseg_lbmapnode)
+            if writer is not None:
+                # waits for the queued cubicles, raises the first write error
+                with self.stage("write"):
+                    writer.close()
+            slicer.mrmlScene.RemoveNode(labelmapSegNode)
+        if writer is not None and boolVerbose:
+            logging.info(
+                f"{writer.num_written} files written, "
+                f"{writer.throughput_mb_s:.1f} MB/s"
+            )
 
+    @reportsStageTimes
     def activateHelper(
         self,
         inputNode,
@@ -1351,62 +1982,69 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         Returns:
         None
         The function performs the following steps:
-        1. Converts the input volume to a numpy array.
-        2. Creates a new empty numpy with the same shape as the input volume.
-        3. Draws axes in a new volume with different lengh to differentiate.
-        4. Converts/assigns the new volume with axes to a helper segmentation node.
+        1. Computes the boxes of the axes (different length to differentiate)
+        in the index space of the aligned volume, no voxels are allocated.
+        2. Maps the boxes to RAS through the orientation and the geometry
+        of the input volume.
+        3. Adds the boxes to the helper segmentation as closed surfaces.
 
         """
-        # TODO: comment after debugging
-        import importlib
-
-        importlib.reload(slogic)
         if not inputNode or not helperNode:
             raise ValueError("Input or Helper object(node) is invalid")
 
         # Cleaning the helper node (everything will be recreated anyway)
         # if helperNode.GetNumberOfSegments() > 0:
-        helperNode.GetSegmentation().RemoveAllSegments()
-
-        # Create a new empty numpy array with the same shape as the input volume
-        helper_array = np.zeros_like(slicer.util.arrayFromVolume(inputNode))
-
-        # TODO: remove this workaround when alinement feature is done
-        # helper_array = np.swapaxes(helper_array, 0, 2)  # temporary fix
-
-        # Get the dimensions of the input volume
-        z_dim, y_dim, x_dim = helper_array.shape
-
-        # Draw axes in the helper array
-        # The axes are drawn with different lengths to differentiate them
-        if rasCompatible:
-            helper_array = slogic.draw_axes_ras(
-                vol_image=helper_array, offset=5, line_width=5
-            )
+        segmentation = helperNode.GetSegmentation()
+        segmentation.RemoveAllSegments()
+        # the boxes are the source representation, nothing is rasterized
+        closedSurfaceName = (
+            slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+        )
+        if hasattr(segmentation, "SetSourceRepresentationName"):
+            segmentation.SetSourceRepresentationName(closedSurfaceName)
         else:
-            helper_array = slogic.draw_axes(
-                vol_image=helper_array, offset=5, line_width=5
+            segmentation.SetMasterRepresentationName(closedSurfaceName)
+
+        with self.stage("helper"):
+            # Draw axes along the aligned axes (if the volume has been
+            # reoriented by its geometry or operations are queued)
+            # The axes are drawn with different lengths to differentiate them
+            shape = inputNode.GetImageData().GetDimensions()[::-1]  # KJI
+            orientation = self.previewOrientation(inputNode)
+            alignedShape = orientation.aligned_shape(shape)
+            if rasCompatible:
+                boxes = slogic.axes_boxes_ras(alignedShape, offset=5, line_width=5)
+            else:
+                boxes = slogic.axes_boxes(alignedShape, offset=5, line_width=5)
+            # aligned KJI indices -> stored KJI -> IJK -> RAS
+            kjiToIjk = np.eye(4)[[2, 1, 0, 3]]
+            alignedToRas = (
+                ijkToRasArray(inputNode)
+                @ kjiToIjk
+                @ np.linalg.inv(orientation.index_matrix(shape))
             )
-
-        # Temporary label map node before converting to segmentation node
-        labelmapHelperNode = slicer.mrmlScene.AddNewNodeByClass(
-            "vtkMRMLLabelMapVolumeNode"
-        )
-
-        colorHelperTable = setHelperTable()
-        labelmapHelperNode.CreateDefaultDisplayNodes()
-        labelmapHelperNode.GetDisplayNode().SetAndObserveColorNodeID(
-            colorHelperTable.GetID()
-        )
-
-        slicer.util.updateVolumeFromArray(labelmapHelperNode, helper_array)
-        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(
-            labelmapHelperNode, helperNode
-        )
+            transform = vtk.vtkTransform()
+            transform.SetMatrix(slicer.util.vtkMatrixFromArray(alignedToRas))
+
+            colorHelperTable = setHelperTable()
+            for label, box in boxes:
+                # voxel centers are at integer indices
+                cube = vtk.vtkCubeSource()
+                cube.SetBounds(
+                    *[bound for sl in box for bound in (sl.start - 0.5, sl.stop - 0.5)]
+                )
+                toRas = vtk.vtkTransformPolyDataFilter()
+                toRas.SetInputConnection(cube.GetOutputPort())
+                toRas.SetTransform(transform)
+                toRas.Update()
+                color = [0.0, 0.0, 0.0, 0.0]
+                colorHelperTable.GetColor(label, color)
+                helperNode.AddSegmentFromClosedSurfaceRepresentation(
+                    toRas.GetOutput(), colorHelperTable.GetColorName(label), color[:3]
+                )
         helperNode.SetName("Helper Segmentation (Axes)")
+        helperNode.CreateDefaultDisplayNodes()
         # helperNode.GetDisplayNode().SetVisibility(True) # already by default
-        helperNode.CreateClosedSurfaceRepresentation()
-        slicer.mrmlScene.RemoveNode(labelmapHelperNode)
 
         # debugging
         # labelmapVolumeNode_debug = slicer.mrmlScene.AddNewNodeByClass(
@@ -1420,6 +2058,7 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         # print(f"{debug_volume.shape = } {debug_volume.dtype = }")
         # slicer.mrmlScene.RemoveNode(labelmapVolumeNode_debug)
 
+    @reportsStageTimes
     def array_manipulation_wrapper(
         self, inputNode, maskNode, helperNode, func, *args, **kwargs
     ):
@@ -1431,13 +2070,50 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         helperNode (vtkMRMLSegmentationNode): Node with the helper volume
         to be recreated.
         func (function): Numpy operation Function to be applied to the input
-        and mask arrays.
+        and mask arrays (np.flip, np.swapaxes or np.rot90). In the zero-copy
+        orientation mode it is composed into the volume geometry instead.
         *args: Additional arguments to be passed to the function.
         **kwargs: Additional keyword arguments to be passed to the function.
         Returns:
         None
         """
         logging.debug(f"{func.__name__} called with {args = } and {kwargs = }")
+        if self.queueOrientation:
+            # previewed on the helper only, applied by commitOrientation
+            sorientation.simplify([(func.__name__, args, kwargs)])  # validation
+            self.pendingOperations.setdefault(inputNode.GetID(), []).append(
+                (func.__name__, args, kwargs)
+            )
+            self.redrawHelper(inputNode, maskNode, helperNode)
+            return
+        if self.zeroCopyOrientation:
+            # the operation is composed into the geometry, no voxels are copied
+            with self.stage("reorient"):
+                orientation = sorientation.simplify(
+                    [(func.__name__, args, kwargs)], self.axisOrientation(inputNode)
+                )
+                self.setAxisOrientation(inputNode, maskNode, orientation)
+            self.redrawHelper(inputNode, maskNode, helperNode)
+            return
+        self.rewriteVoxels(inputNode, maskNode, func, *args, **kwargs)
+        self.redrawHelper(inputNode, maskNode, helperNode)
+
+    def rewriteVoxels(self, inputNode, maskNode, func, *args, **kwargs):
+        """
+        Apply a numpy operation to the voxels of the volume and the mask
+        (one export and import of the mask).
+        Parameters:
+        inputNode (vtkMRMLScalarVolumeNode): Node with the source volume.
+        maskNode (vtkMRMLSegmentationNode): Node with the mask.
+        func (function): Numpy operation Function to be applied to the input
+        and mask arrays.
+        *args, **kwargs: Additional arguments to be passed to the function.
+        """
+        if inputNode.GetID() in self.axisOrientations:
+            raise ValueError(
+                "The volume has been reoriented by its geometry, "
+                "reset the orientation before rewriting its voxels"
+            )
         src_volume = slicer.util.arrayFromVolume(inputNode)
 
         labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass(
@@ -1450,9 +2126,10 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         #     slicer.vtkSegmentation.EXTENT_REFERENCE_GEOMETRY)
         # this is preferred to ExportVisibleSegmentsToLabelmapNode
         # as it preserves the volume extents matching the inputNode
-        slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(
-            maskNode, labelmapVolumeNode, inputNode
-        )
+        with self.stage("export"):
+            slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(
+                maskNode, labelmapVolumeNode, inputNode
+            )
         mask_volume = slicer.util.arrayFromVolume(labelmapVolumeNode)
 
         # TODO: remove this workaround when alinement feature is done
@@ -1463,26 +2140,34 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         logging.debug(f"{mask_volume.shape = } {mask_volume.dtype = }")
         # src_volume = np.flip(src_volume, axis=0)  # flip along Y axis
         # mask_volume = np.flip(mask_volume, axis=0)
-        src_volume = func(
-            src_volume, *args, **kwargs
-        )  # apply the function to the source volume
-        mask_volume = func(
-            mask_volume, *args, **kwargs
-        )  # apply the function to the mask volume
+        with self.stage("reorient"):
+            src_volume = func(
+                src_volume, *args, **kwargs
+            )  # apply the function to the source volume
+            mask_volume = func(
+                mask_volume, *args, **kwargs
+            )  # apply the function to the mask volume
         logging.debug("After manipulation:")
         logging.debug(f"{src_volume.shape = } {src_volume.dtype = }")
         logging.debug(f"{mask_volume.shape = } {mask_volume.dtype = }")
 
-        slicer.util.updateVolumeFromArray(inputNode, src_volume)
+        with self.stage("import"):
+            slicer.util.updateVolumeFromArray(inputNode, src_volume)
 
-        maskNode.GetSegmentation().RemoveAllSegments()
-        slicer.util.updateVolumeFromArray(labelmapVolumeNode, mask_volume)
-        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(
-            labelmapVolumeNode, maskNode
-        )
-        maskNode.CreateClosedSurfaceRepresentation()
+            maskNode.GetSegmentation().RemoveAllSegments()
+            slicer.util.updateVolumeFromArray(labelmapVolumeNode, mask_volume)
+            slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(
+                labelmapVolumeNode, maskNode
+            )
+        self.requestClosedSurface(maskNode)
         slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
-        # print(f"{self.getParameterNode().GetParameter('RasCompatible')=}")
+
+    def redrawHelper(self, inputNode, maskNode, helperNode):
+        """
+        Redraw the helper axes (if a helper node is selected).
+        """
+        if not helperNode:
+            return
         self.activateHelper(
             inputNode=inputNode,
             maskNode=maskNode,
@@ -1491,6 +2176,55 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
             == "True",
         )
 
+    def previewOrientation(self, volumeNode):
+        """
+        Return the AxisOrientation of the volume including the queued
+        operations (what the helper shows before they are committed).
+        """
+        return sorientation.simplify(
+            self.pendingOperations.get(volumeNode.GetID(), []),
+            self.axisOrientation(volumeNode),
+        )
+
+    @reportsStageTimes
+    def commitOrientation(self, inputNode, maskNode, helperNode=None):
+        """
+        Apply the queued flips/swaps/rotations to the volume and the mask
+        at once: they are simplified into one axis permutation and flips,
+        composed into the geometry (zero-copy orientation mode) or written
+        to the voxels in a single pass (one transpose + flip).
+        :param inputNode: source volume node
+        :param maskNode: segmentation node of the mask
+        :param helperNode: helper segmentation node to be redrawn (may be None)
+        :return: number of the applied operations
+        """
+        if not inputNode:
+            raise ValueError("Input volume is invalid")
+        operations = self.pendingOperations.pop(inputNode.GetID(), [])
+        if not operations:
+            return 0
+        if self.zeroCopyOrientation:
+            with self.stage("reorient"):
+                orientation = sorientation.simplify(
+                    operations, self.axisOrientation(inputNode)
+                )
+                self.setAxisOrientation(inputNode, maskNode, orientation)
+        else:
+            orientation = sorientation.simplify(operations)
+            logging.debug(f"{len(operations)} operations simplified to {orientation}")
+            self.rewriteVoxels(inputNode, maskNode, orientation.view)
+        self.redrawHelper(inputNode, maskNode, helperNode)
+        return len(operations)
+
+    def discardOrientation(self, inputNode, maskNode=None, helperNode=None):
+        """
+        Drop the queued flips/swaps/rotations and redraw the helper.
+        """
+        if not inputNode:
+            raise ValueError("Input volume is invalid")
+        self.pendingOperations.pop(inputNode.GetID(), None)
+        self.redrawHelper(inputNode, maskNode, helperNode)
+
     def processRefresh(self, localTreeWidget):
         """
         processRefresh: Refresh the local datasets tree widget.
@@ -1498,12 +2232,14 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         """
         populateLocalDatasets(localTreeWidget)
 
+    @reportsPeakMemory
     def processExport(
         self,
         datasetName,
         savePathSource,
         savePathSegm,
         boolVerbose,
+        compressLevel=scubiclewriter.DEFAULT_COMPRESSLEVEL,
     ):
         """
         Run the algorithm to export the source and/or label volumes into a local
@@ -1514,44 +2250,69 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         savePathSource (string): Node with the source volume to be broken.
         savePathSegm (string): Node with the mask volume for breaking.
         enumeratedNode (vtkMRMLScalarVolumeNode): Node with the enumerated volume.
+        compressLevel (int): gzip level of .nii.gz files, 0 - uncompressed .nii
+        (one of scubiclewriter.COMPRESSION_LEVELS)
         Returns:
-        None
+        tuple of the number of written files and the throughput in MB/s
 
         """
         logging.debug(f"{datasetName = }")
         logging.debug(f"{savePathSource = }")
         logging.debug(f"{savePathSegm = }")
         assert len(datasetName) > 0, "Dataset name is not specified!"
+        importNibabel()
 
+        # arrays and geometry are gathered from the nodes here, compression
+        # and writing run concurrently in the pool of writer threads
         shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-        if len(savePathSource) > 0:
-            volNodesDict = extractNodes(
-                shNd=shNode, key_name=datasetName, nodeClass="vtkMRMLScalarVolumeNode"
-            )
-            for i, (node_name, volumeNode) in enumerate(volNodesDict.items()):
-                fname = node_name + "_0000.nii.gz"
-                slicer.util.exportNode(volumeNode, os.path.join(savePathSource, fname))
-
-        if len(savePathSegm) > 0:
-            segNodesDict = extractNodes(
-                shNd=shNode, key_name=datasetName, nodeClass="vtkMRMLSegmentationNode"
-            )
-            for i, (node_name, segNode) in enumerate(segNodesDict.items()):
-                fname = node_name + ".nii.gz"
-                labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass(
-                    "vtkMRMLLabelMapVolumeNode"
+        writer = scubiclewriter.VolumeWriter(
+            workers=os.cpu_count() or 1, compresslevel=compressLevel
+        )
+        with writer:
+            if len(savePathSource) > 0:
+                volNodesDict = extractNodes(
+                    shNd=shNode,
+                    key_name=datasetName,
+                    nodeClass="vtkMRMLScalarVolumeNode",
                 )
+                for i, (node_name, volumeNode) in enumerate(volNodesDict.items()):
+                    # a view of the node data, the nodes are not modified
+                    writer.write(
+                        slicer.util.arrayFromVolume(volumeNode),
+                        ijkToRasArray(volumeNode),
+                        os.path.join(savePathSource, node_name + "_0000"),
+                    )
 
-                slicer.modules.segmentations.logic().ExportAllSegmentsToLabelmapNode(
-                    segNode,
-                    labelmapVolumeNode,
-                    slicer.vtkSegmentation.EXTENT_REFERENCE_GEOMETRY,
+            if len(savePathSegm) > 0:
+                segNodesDict = extractNodes(
+                    shNd=shNode,
+                    key_name=datasetName,
+                    nodeClass="vtkMRMLSegmentationNode",
                 )
-
-                slicer.util.exportNode(
-                    labelmapVolumeNode, os.path.join(savePathSegm, fname)
+                # one temporary labelmap node serves all segmentations
+                labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass(
+                    "vtkMRMLLabelMapVolumeNode"
                 )
+                for i, (node_name, segNode) in enumerate(segNodesDict.items()):
+                    slicer.modules.segmentations.logic().ExportAllSegmentsToLabelmapNode(
+                        segNode,
+                        labelmapVolumeNode,
+                        slicer.vtkSegmentation.EXTENT_REFERENCE_GEOMETRY,
+                    )
+                    # a copy, the node is overwritten by the next segmentation
+                    writer.write(
+                        np.array(slicer.util.arrayFromVolume(labelmapVolumeNode)),
+                        ijkToRasArray(labelmapVolumeNode),
+                        os.path.join(savePathSegm, node_name),
+                    )
                 slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+        logging.info(
+            f"Exported {writer.num_written} files, "
+            f"{writer.raw_bytes / 2**20:.1f} MB of data "
+            f"({writer.file_bytes / 2**20:.1f} MB on disk) "
+            f"in {writer.seconds:.2f} s, {writer.throughput_mb_s:.1f} MB/s"
+        )
+        return writer.num_written, writer.throughput_mb_s
 
     def processEvaluateMaxDim(
         self,
@@ -1607,14 +2368,9 @@ class ArrayWranglerModuleLogic(ScriptedLoadableModuleLogic):
         assert len(datasetName) > 0, "Dataset name is not specified!"
         assert len(dimensions) > 0, "Dimensions are not specified"
 
-        if "," in dimensions:
-            dims = [int(dm) for dm in dimensions.split(",")]
-        elif "-" in dimensions:
-            dims = [int(dm) for dm in dimensions.split("-")]
-        elif " " in dimensions:
-            dims = [int(dm) for dm in dimensions.split()]
-        else:
-            logging.error("Wrong format of mapping bases. Canceling operation.")
+        dims = parseIntList(dimensions)
+        if dims is None:
+            logging.error("Wrong format of dimensions. Canceling operation.")
             return
         logging.debug(f"{dims = }")
         assert len(dims) == 3, "Wrong number of dimensions"
@@ -1738,6 +2494,105 @@ class ArrayWranglerModuleTest(ScriptedLoadableModuleTest):
         self.delayDisplay("Test passed")
 
 
+def importScikitLearn():
+    """
+    Make scikit-learn (used by the 'kmeans' clustering method) available
+    to the sorting library, offering to install it if it is missing.
+    :return: True if it is available
+    """
+    if slogic.KMeans is not None:
+        return True
+    if not slicer.util.confirmOkCancelDisplay(
+        "The 'kmeans' clustering method requires 'scikit-learn' Python package. "
+        "Click OK to install it now."
+    ):
+        return False
+    slicer.util.pip_install("scikit-learn")
+    from sklearn.cluster import KMeans
+
+    # the library looked for it when it was imported
+    slogic.KMeans = KMeans
+    return True
+
+
+def importNibabel():
+    """
+    Import nibabel (used to write cubicles to files without scene nodes),
+    offering to install it if it is missing.
+    """
+    try:
+        import nibabel
+    except ModuleNotFoundError:
+        if not slicer.util.confirmOkCancelDisplay(
+            "Writing cubicles to files requires 'nibabel' Python package. "
+            "Click OK to install it now."
+        ):
+            raise
+        slicer.util.pip_install("nibabel")
+        import nibabel
+    return nibabel
+
+
+def parseIntList(text):
+    """
+    Parse a list of integers typed in UI, like "100,200,300", "3-3-4" or "3 3 4".
+    Returns the list of integers or None if the format is wrong.
+    """
+    text = text.strip()
+    try:
+        if "," in text:
+            return [int(value) for value in text.split(",")]
+        if "-" in text:
+            return [int(value) for value in text.split("-")]
+        return [int(value) for value in text.split()]
+    except ValueError:
+        return None
+
+
+def segmentationCacheKey(segmentationNode, referenceNode):
+    """
+    Build a key identifying the content of the segmentation exported
+    with the reference geometry: IDs and modification times of the nodes,
+    the segmentation, its display (visibility of segments) and the source
+    representation of every segment. Any edit of the mask changes the key.
+    """
+    segmentation = segmentationNode.GetSegmentation()
+    if hasattr(segmentation, "GetSourceRepresentationName"):
+        sourceName = segmentation.GetSourceRepresentationName()
+    else:  # Slicer < 5.4
+        sourceName = segmentation.GetMasterRepresentationName()
+    key = [
+        segmentationNode.GetID(),
+        segmentationNode.GetMTime(),
+        segmentation.GetMTime(),
+        referenceNode.GetID(),
+        referenceNode.GetMTime(),
+    ]
+    displayNode = segmentationNode.GetDisplayNode()
+    if displayNode:
+        key.append(displayNode.GetMTime())
+    for segmentID in segmentation.GetSegmentIDs():
+        segment = segmentation.GetSegment(segmentID)
+        representation = segment.GetRepresentation(sourceName)
+        key += [
+            segmentID,
+            segment.GetMTime(),
+            representation.GetMTime() if representation else 0,
+        ]
+    return tuple(key)
+
+
+def createLabelmapLike(referenceVolume):
+    """
+    Create a labelmap node with the geometry of the reference volume,
+    the same as ExportVisibleSegmentsToLabelmapNode gives with this reference.
+    """
+    labelmapVolumeNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLabelMapVolumeNode")
+    labelmapVolumeNode.CopyOrientation(referenceVolume)
+    labelmapVolumeNode.CreateDefaultDisplayNodes()
+    return labelmapVolumeNode
+
+
 def setColorTable(mapped_labels):
     # assumed that mapped labels should be sorted in the order
     # of the consequtive labels
@@ -1745,29 +2600,12 @@ def setColorTable(mapped_labels):
     # we can pass the sorted labels to the function,
     # and/or check the consistency of labels/segments after returning the function
     # UPD: the checkup actually performed in processBreak
-    colorTableNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLColorTableNode")
-    colorTableNode.SetTypeToUser()
-    colorTableNode.HideFromEditorsOff()  # make selectable in the GUI
-    slicer.mrmlScene.AddNode(colorTableNode)
-    colorTableNode.UnRegister(None)
-    largestLabelValue = len(mapped_labels)
-    colorTableNode.SetNumberOfColors(largestLabelValue + 1)
-    # prevent automatic color name generation
-    colorTableNode.SetNamesInitialised(True)
-
-    g = random.uniform(0.0, 1.0)
-    b = random.uniform(0.0, 1.0)
-    r = random.uniform(0.0, 1.0)
-    a = 1.0
-
-    coff = 1 / len(mapped_labels)  # for making progressive coloring
-    for i, labelValue in enumerate(mapped_labels):
-        r = coff * (i + 1)
-        segmentName = f"Segment_{labelValue}_{i+1}"
-        # Can use success variable instead of _ to check if performed ok
-        _ = colorTableNode.SetColor(i + 1, segmentName, r, g, b, a)
-
-    return colorTableNode
+    names = [
+        f"Segment_{labelValue}_{i+1}" for i, labelValue in enumerate(mapped_labels)
+    ]
+    return colorTables.getColorTable(
+        ("labels", len(names)), names, lambda: progressiveColors(len(names))
+    )
 
 
 def setHelperTable():
@@ -1778,29 +2616,101 @@ def setHelperTable():
         2: "X Axis (Columns, or seeds in a row)",
         3: "Z Axis/Height (Layers/plates in a stack)",
     }
+    names = [
+        f"{name_template}_{labelValue}"
+        for labelValue, name_template in mapped_labels.items()
+    ]
+    return colorTables.getColorTable(
+        ("helper",), names, lambda: progressiveColors(len(names))
+    )
+
+
+def progressiveColors(numLabels):
+    """
+    Colors of labels 1..numLabels: red grows with the label, green and blue
+    are random but fixed for the table. Row 0 (background) is transparent.
+    Returns an array (numLabels + 1, 4) of RGBA values in [0, 1].
+    """
+    g = random.uniform(0.0, 1.0)
+    b = random.uniform(0.0, 1.0)
+    colors = np.zeros((numLabels + 1, 4))
+    colors[1:, 0] = np.arange(1, numLabels + 1) / max(numLabels, 1)
+    colors[1:, 1:] = (g, b, 1.0)
+    return colors
+
+
+def fillColorTable(colorTableNode, colors, names):
+    """
+    Fill the color table from arrays in bulk.
+    colors - array (n + 1, 4) of RGBA values in [0, 1], row 0 is the background
+    names - list of n names of labels 1..n
+    """
+    lookupTable = colorTableNode.GetLookupTable()
+    rgba = np.round(np.clip(colors, 0.0, 1.0) * 255).astype(np.uint8)
+    lookupTable.SetTable(
+        numpy_support.numpy_to_vtk(rgba, deep=True, array_type=vtk.VTK_UNSIGNED_CHAR)
+    )
+    lookupTable.SetRange(0, len(colors) - 1)
+    for labelValue, name in enumerate(names, start=1):
+        colorTableNode.SetColorName(labelValue, name)
+    colorTableNode.Modified()
+
+
+class ColorTableCache:
+    """
+    Color table nodes reused across operations instead of adding a new node
+    to the scene on every Apply, Erosion or Remove Small Objects.
+    Tables are cached per signature (e.g. ("labels", n)) and list of names:
+    a table with the same names is returned as is, other names get a new
+    table, so the names of a table shown by another labelmap never change.
+    The colors are built once per signature and shared by its tables.
+    """
+
+    def __init__(self):
+        self._entries = {}  # (signature, tuple of names) -> node ID
+        self._colors = {}  # signature -> colors (n + 1, 4)
+
+    def getColorTable(self, signature, names, colorsFactory):
+        """
+        Get the color table node for the signature with the given names.
+        signature - hashable key of the table (e.g. ("labels", n))
+        names - list of n names of labels 1..n
+        colorsFactory - function returning colors (n + 1, 4) for a new table
+        """
+        key = (signature, tuple(names))
+        nodeID = self._entries.get(key)
+        colorTableNode = slicer.mrmlScene.GetNodeByID(nodeID) if nodeID else None
+        if colorTableNode is None:
+            colors = self._colors.get(signature)
+            if colors is None or len(colors) != len(names) + 1:
+                colors = self._colors[signature] = colorsFactory()
+            colorTableNode = createColorTableNode(len(names))
+            fillColorTable(colorTableNode, colors, list(names))
+            self._entries[key] = colorTableNode.GetID()
+        return colorTableNode
+
+    def clear(self):
+        """
+        Forget the tables, called when the scene is closed (the nodes are gone).
+        """
+        self._entries.clear()
+        self._colors.clear()
+
+
+def createColorTableNode(numLabels):
     colorTableNode = slicer.mrmlScene.CreateNodeByClass("vtkMRMLColorTableNode")
     colorTableNode.SetTypeToUser()
     colorTableNode.HideFromEditorsOff()  # make selectable in the GUI
     slicer.mrmlScene.AddNode(colorTableNode)
     colorTableNode.UnRegister(None)
-    largestLabelValue = len(mapped_labels)
-    colorTableNode.SetNumberOfColors(largestLabelValue + 1)
+    colorTableNode.SetNumberOfColors(numLabels + 1)
     # prevent automatic color name generation
     colorTableNode.SetNamesInitialised(True)
+    return colorTableNode
 
-    g = random.uniform(0.0, 1.0)
-    b = random.uniform(0.0, 1.0)
-    r = random.uniform(0.0, 1.0)
-    a = 1.0
-
-    coff = 1 / len(mapped_labels)  # for making progressive coloring
-    for labelValue, name_template in mapped_labels.items():
-        r = coff * (labelValue)
-        segmentName = f"{name_template}_{labelValue}"
-        # Can use success variable instead of _ to check if performed ok
-        _ = colorTableNode.SetColor(labelValue, segmentName, r, g, b, a)
 
-    return colorTableNode
+# shared by all operations of the module
+colorTables = ColorTableCache()
 
 
 def populateLocalDatasets(tree):
@@ -1835,6 +2745,29 @@ def populateLocalDatasets(tree):
     tree.insertTopLevelItems(0, items)
 
 
+def ijkToRasArray(volumeNode):
+    """
+    Return the IJK to RAS matrix of a volume node as a 4x4 numpy array
+    (the affine of its NIfTI file).
+    """
+    ijkToRas = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRas)
+    return slicer.util.arrayFromVTKMatrix(ijkToRas)
+
+
+def placeInFolder(shNd, node, folderItemID):
+    """
+    Put the subject hierarchy item of a data node under a folder item.
+    The item is found by the node itself, and created right under the folder
+    if the hierarchy has not got it yet (e.g. in the batch processing state).
+    """
+    itemID = shNd.GetItemByDataNode(node)
+    if itemID:
+        shNd.SetItemParent(itemID, folderItemID)
+    else:
+        shNd.CreateItem(folderItemID, node)
+
+
 def criteria_node_in_sh(node, shNd, keyname):
     shItemID = shNd.GetItemByDataNode(node)
     parentItem = shNd.GetItemParent(shItemID)
@@ -1854,5 +2787,3 @@ def extractNodes(shNd, key_name, nodeClass="vtkMRMLScalarVolumeNode"):
     )
     nodes_dict = {node.GetName(): node for node in nodes}
     return nodes_dict
-
-
@@ -0,0 +1,176 @@
+import itertools
+import logging
+
+import numpy as np
+
+from . import sorting_logic as slogic
+
+# pylint: skip-file
+
+# Automatic detection of the sorting axes from object centroids, so the
+# volume doesn't have to be aligned with the helper before sorting.
+# The principal axes of the centroid cloud are snapped to the array axes:
+# a stack of trays is lower than the trays are wide, so the direction
+# of the least variance is the height. Of the two axes in the plane
+# of a layer, rows are the one along which the objects of a layer fall
+# into the most clearly separated clusters (objects in a row share
+# the row coordinate, while their positions along a row vary).
+# A stack about as high as it is wide leaves the height ambiguous, then
+# the axis with more clearly separated layers is the height, and if neither
+# axis separates them clearly better, the axes of the template are kept.
+# Directions (signs) of the axes can't be told from a regular array: which
+# corner holds the first object is not visible in the centroids, so the
+# directions are always kept from the template sorting order.
+
+# deviation of the principal axes from the array axes (degrees) above which
+# the array of objects is reported as tilted (sorting along the array axes
+# may mix up neighbouring rows), the principal axes of a finite lattice
+# deviate by several degrees even if it is aligned
+MAX_TILT_DEGREES = 20.0
+
+# the height is ambiguous if the two smallest principal variances differ less
+# than AMBIGUOUS_VARIANCE_RATIO times, the candidate axes (and the rows
+# and columns) are told apart by separation ratios differing at least
+# SEPARATION_MARGIN times
+AMBIGUOUS_VARIANCE_RATIO = 2.0
+SEPARATION_MARGIN = 1.1
+
+
+def principal_axes(points):
+    """
+    Function to find the principal axes of a point cloud.
+    points - an array of the shape (n, 3)
+    Returns a tuple of variances (3,) in ascending order and unit directions
+    as columns of a 3x3 array in the same order.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    variances, directions = np.linalg.eigh(np.cov(points.T))
+    return variances, directions
+
+
+def snap_to_axes(directions):
+    """
+    Function to match directions with the array axes.
+    directions - 3x3 array with unit directions as columns
+    Returns a tuple of the array axis of every direction (3,) and the angles
+    between the directions and their axes in degrees (3,).
+    """
+    loadings = np.abs(directions)
+    axes = max(
+        itertools.permutations(range(3)),
+        key=lambda perm: sum(loadings[axis, i] for i, axis in enumerate(perm)),
+    )
+    cosines = np.clip([loadings[axis, i] for i, axis in enumerate(axes)], 0.0, 1.0)
+    return np.array(axes), np.degrees(np.arccos(cosines))
+
+
+def separation_ratio(data, min_gap=0.0):
+    """
+    Function to measure how clearly 1D coordinates fall into clusters:
+    the smallest break between clusters (count_clusters_1d) divided
+    by the widest cluster.
+    data - an array of n values
+    min_gap - the smallest gap accepted as a break (see count_clusters_1d)
+    Returns the ratio, 0 if no break is found.
+    """
+    data = np.asarray(data, dtype=np.float64).ravel()
+    labels, centers = slogic.cluster_by_gaps(data, min_gap=min_gap)
+    if centers.size < 2:
+        return 0.0
+    lows = np.full(centers.size, np.inf)
+    highs = np.full(centers.size, -np.inf)
+    np.minimum.at(lows, labels, data)
+    np.maximum.at(highs, labels, data)
+    # clusters are numbered in ascending order
+    breaks = lows[1:] - highs[:-1]
+    return float(breaks.min() / max((highs - lows).max(), 1.0))
+
+
+def _clearer_axis(ratios, axes, fallback):
+    # the axis with a clearly higher separation ratio, otherwise the fallback
+    # axis if it is among the candidates, otherwise the first candidate
+    best = int(np.argmax(ratios))
+    if ratios[best] > SEPARATION_MARGIN * min(ratios):
+        return axes[best]
+    return fallback if fallback in axes else axes[0]
+
+
+def remap_sorting_order(template, height, rows, columns):
+    """
+    Function to move a sorting order to other array axes.
+    template - dictionary with sorting preferences, its directions are kept
+    height, rows, columns - the new axes
+    Returns a new dictionary with sorting preferences.
+    """
+    new_axes = {
+        template["height"]: height,
+        template["rows"]: rows,
+        template["columns"]: columns,
+    }
+    sorder = dict(template)
+    sorder.update(height=height, rows=rows, columns=columns)
+    for key, value in template.items():
+        if key.startswith("rotation_"):
+            sorder[key] = tuple(new_axes[axis] for axis in value)
+    return sorder
+
+
+def detect_sorting_order(centroids, template=slogic.sorting_order_classic, min_gap=0.0):
+    """
+    Function to detect the height, rows and columns axes of a stack
+    of layers with rows of objects from the centroids of the objects.
+    centroids - an array of the shape (n, 3)
+    template - dictionary with sorting preferences, the directions
+    of the axes are taken from it, and the axes if the centroids don't tell
+    them apart
+    min_gap - the smallest gap between layers (rows) in voxels,
+    see SortingEngine.min_gap
+    Returns a new dictionary with sorting preferences
+    (the template itself if there are too few objects to analyze).
+    """
+    centroids = np.asarray(centroids, dtype=np.float64)
+    if len(centroids) < 4:
+        return template
+    variances, directions = principal_axes(centroids)
+    axes, tilts = snap_to_axes(directions)
+    if tilts.max() > MAX_TILT_DEGREES:
+        logging.warning(
+            f"The array of objects is tilted by {tilts.max():.1f} degrees "
+            "to the volume axes, rows may be mixed up"
+        )
+    axes = [int(axis) for axis in axes]
+    height = axes[0]  # the least variance
+    if variances[1] < AMBIGUOUS_VARIANCE_RATIO * variances[0]:
+        height = _clearer_axis(
+            [separation_ratio(centroids[:, axis], min_gap) for axis in axes[:2]],
+            axes[:2],
+            template["height"],
+        )
+    in_plane = [axis for axis in axes if axis != height]  # the larger variances
+
+    layer_labels, _ = slogic.cluster_by_gaps(centroids[:, height], min_gap=min_gap)
+    scores = []
+    for axis in in_plane:
+        ratios = [
+            separation_ratio(centroids[layer_labels == layer, axis], min_gap)
+            for layer in range(layer_labels.max() + 1)
+        ]
+        scores.append(float(np.median(ratios)))
+    rows = _clearer_axis(scores, in_plane, template["rows"])
+    columns = in_plane[1] if rows == in_plane[0] else in_plane[0]
+    logging.debug(
+        f"Principal variances {variances}, axes {axes}, tilts {tilts}, "
+        f"row separation {dict(zip(in_plane, scores))}"
+    )
+    return remap_sorting_order(template, height, rows, columns)
+
+
+def describe_sorting_order(sorder):
+    """
+    Returns a short description of the axes of a sorting order,
+    like "height 2 (+), rows 0 (+), columns 1 (+)".
+    """
+    return ", ".join(
+        f"{key} {sorder[key]} ({'+' if sorder[key + '_direction'] > 0 else '-'})"
+        for key in ("height", "rows", "columns")
+    )
@@ -0,0 +1,368 @@
+import argparse
+import contextlib
+import csv
+import json
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from . import engine as sengine
+from . import sorting_logic as slogic
+from .axis_detection import describe_sorting_order
+from .cubicle_writer import WRITER_THREADS, CubicleWriter, save_volume
+
+# pylint: skip-file
+
+# Command line entry point to enumerate and break whole directories of scans:
+#
+#   python -m sort_library.batch <input_dir> <output_dir> --workers 8
+#
+# (run from the ArrayWranglerModule folder). Every scan is a pair of NIfTI
+# files <case>_source_0000.nii.gz and <case>_mask.nii.gz, the cubicles are
+# written to <output_dir>/<case>/source and <output_dir>/<case>/segm with the
+# same names as the Break + Export buttons of the Slicer module produce.
+
+SOURCE_SUFFIX = "_source_0000.nii.gz"
+MASK_SUFFIX = "_mask.nii.gz"
+
+SORTING_ORDERS = {
+    "classic": slogic.sorting_order_classic,
+    "ras": slogic.sorting_order_ras,
+}
+
+
+def find_pairs(input_dir, source_suffix=SOURCE_SUFFIX, mask_suffix=MASK_SUFFIX):
+    """
+    Function to find source/mask pairs in a directory.
+    input_dir - directory with the scans
+    source_suffix - file name ending of source volumes
+    mask_suffix - file name ending of masks
+    Returns a sorted list of tuples (case, source_path, mask_path),
+    sources without a mask are reported and skipped.
+    """
+    pairs = []
+    for fname in sorted(os.listdir(input_dir)):
+        if not fname.endswith(source_suffix):
+            continue
+        case = fname[: -len(source_suffix)]
+        mask_path = os.path.join(input_dir, case + mask_suffix)
+        if not os.path.isfile(mask_path):
+            logging.warning(f"No mask for {fname}, skipped")
+            continue
+        pairs.append((case, os.path.join(input_dir, fname), mask_path))
+    return pairs
+
+
+class KJIVolume:
+    """
+    Read-only view of a NIfTI image in the KJI order which reads only
+    the requested block of the file (through the nibabel array proxy),
+    e.g. a slab of planes to label or a cubicle to write.
+    Only indexing with slices is supported.
+    dataobj - the array proxy of the image (image.dataobj)
+    """
+
+    def __init__(self, dataobj):
+        self.dataobj = dataobj
+        self.shape = tuple(dataobj.shape[::-1])
+        self.ndim = len(self.shape)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        return np.asarray(self.dataobj[key[::-1]]).transpose(2, 1, 0)
+
+
+def load_volume(path, lazy=False):
+    """
+    Function to load a NIfTI volume.
+    path - path to the volume
+    lazy - if True, the voxels are not loaded, a KJIVolume reading blocks
+    of the file on demand is returned instead of the array
+    Returns a tuple of the array in the KJI order (as slicer.util.arrayFromVolume
+    returns it, so the sorting orders of the module apply) and the affine.
+    """
+    import nibabel as nib
+
+    image = nib.load(path)
+    if lazy:
+        return KJIVolume(image.dataobj), image.affine
+    return np.asarray(image.dataobj).transpose(2, 1, 0), image.affine
+
+
+def process_case(
+    case,
+    source_path,
+    mask_path,
+    output_dir,
+    num_layers=4,
+    num_rows=3,
+    mapping_bases=None,
+    sorting_order="classic",
+    clustering_method="optimal",
+    span=5,
+    slab_size=0,
+    writers=1,
+    detect_axes=False,
+    scratch_dir=None,
+):
+    """
+    Function to run Apply + Break + Export for one scan.
+    case - name of the scan
+    source_path, mask_path - paths to the source volume and the mask
+    output_dir - root output directory, cubicles are written to
+    <output_dir>/<case>/source and <output_dir>/<case>/segm
+    slab_size - if > 0, the scan is processed out of core: the source and
+    the mask are read block by block, the mask is labeled in slabs of that many
+    planes and the label volumes are memory-mapped files in scratch_dir
+    writers - number of threads writing the cubicles of the scan
+    detect_axes - if True, the height, rows and columns axes are detected
+    from the centroids, sorting_order gives the directions only
+    scratch_dir - directory for the memory-mapped label volumes of
+    the out-of-core mode, a temporary directory is created (and removed)
+    in it, by default in output_dir
+    the rest of parameters are the same as of the Slicer module
+    Returns a dictionary with the summary of the scan.
+    """
+    start = time.perf_counter()
+    out_of_core = slab_size > 0
+    source_img, affine = load_volume(source_path, lazy=out_of_core)
+    segm_img, _ = load_volume(mask_path, lazy=out_of_core)
+    assert (
+        source_img.shape == segm_img.shape
+    ), f"Source {source_img.shape} and mask {segm_img.shape} shapes differ"
+
+    scratch = (
+        tempfile.TemporaryDirectory(prefix=f"{case}_", dir=scratch_dir or output_dir)
+        if out_of_core
+        else contextlib.nullcontext()
+    )
+    with scratch as scratch_path:
+        engine = sengine.SortingEngine(
+            num_layers=num_layers,
+            num_rows=num_rows,
+            mapping_bases=mapping_bases,
+            sorting_order=SORTING_ORDERS[sorting_order],
+            clustering_method=clustering_method,
+            slab_size=slab_size,
+            detect_axes=detect_axes,
+            scratch_dir=scratch_path,
+        )
+        enum_img, result = engine.run(segm_img)
+
+        # bounding boxes come from the object table of the enumeration,
+        # no find_objects pass over the enumerated image is needed
+        ob_expanded = result.objects.slices(span)
+
+        source_dir = os.path.join(output_dir, case, "source")
+        segm_dir = os.path.join(output_dir, case, "segm")
+        with CubicleWriter(source_dir, segm_dir, affine, workers=writers) as writer:
+            # names as in the Slicer module: <sparse label>_<consecutive label>
+            for lb, obex in enumerate(ob_expanded, start=1):
+                node_name = f"{result.sparse_labels[lb - 1]}_{lb}"
+                offset = tuple(sl.start for sl in obex)
+                # restricting the segmentation to the enumerated object
+                # (prevents the snapping of adjacent seeds)
+                segm_cube = np.where(enum_img[obex] == lb, segm_img[obex], 0)
+                source_cube = source_img[obex].astype(np.int16)
+                writer.submit(node_name, offset, source_cube, segm_cube)
+        # the memory map has to be closed before its file is removed
+        del enum_img
+
+    return {
+        "case": case,
+        "status": "ok",
+        "num_objects": result.num_objects,
+        "num_layers": result.num_layers,
+        "rows_per_level": result.rows_per_level,
+        "axes": describe_sorting_order(result.sorting_order),
+        "seconds": round(time.perf_counter() - start, 2),
+        "error": "",
+    }
+
+
+def _limit_memory(memory_limit_mb):
+    # worker initializer, caps the address space of every worker process
+    # so a single oversized scan fails instead of bringing the box down
+    if not memory_limit_mb:
+        return
+    try:
+        import resource
+    except ImportError:  # not available on Windows
+        logging.warning("Memory limit is not supported on this platform")
+        return
+    limit = int(memory_limit_mb) * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def _failed_summary(case, error):
+    return {
+        "case": case,
+        "status": "failed",
+        "num_objects": 0,
+        "num_layers": 0,
+        "rows_per_level": [],
+        "axes": "",
+        "seconds": 0,
+        "error": repr(error),
+    }
+
+
+def _run_case(pair, output_dir, options):
+    try:
+        return process_case(*pair, output_dir=output_dir, **options)
+    except Exception as e:  # MemoryError included
+        logging.exception(f"Scan {pair[0]} failed")
+        return _failed_summary(pair[0], e)
+
+
+def run_batch(pairs, output_dir, workers=1, memory_limit_mb=0, **options):
+    """
+    Function to process the scans in a pool of worker processes.
+    pairs - list of tuples (case, source_path, mask_path), see find_pairs
+    output_dir - root output directory
+    workers - number of worker processes
+    memory_limit_mb - memory cap of every worker in MB, 0 - no limit
+    options - keyword arguments of process_case
+    Returns the list of summaries ordered as pairs.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    summaries = {}
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_limit_memory, initargs=(memory_limit_mb,)
+    ) as executor:
+        futures = {
+            executor.submit(_run_case, pair, output_dir, options): pair[0]
+            for pair in pairs
+        }
+        for i, future in enumerate(as_completed(futures), start=1):
+            try:
+                summary = future.result()
+            except Exception as e:  # the worker process died
+                summary = _failed_summary(futures[future], e)
+            summaries[summary["case"]] = summary
+            logging.info(
+                f"[{i}/{len(pairs)}] {summary['case']}: {summary['status']}, "
+                f"{summary['num_objects']} objects, {summary['seconds']} s"
+            )
+    return [summaries[case] for case, _, _ in pairs]
+
+
+def write_summary(summaries, output_dir):
+    """
+    Function to write the summary of the batch as summary.json and summary.csv.
+    """
+    with open(os.path.join(output_dir, "summary.json"), "w") as f:
+        json.dump(summaries, f, indent=2)
+    with open(os.path.join(output_dir, "summary.csv"), "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(summaries[0].keys()))
+        writer.writeheader()
+        for summary in summaries:
+            row = dict(summary)
+            row["rows_per_level"] = "-".join(map(str, row["rows_per_level"]))
+            writer.writerow(row)
+
+
+def _int_list(text):
+    return [int(value) for value in text.replace("-", ",").split(",") if value]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Enumerate and break directories of NIfTI source/mask pairs"
+    )
+    parser.add_argument("input_dir", help="directory with source/mask pairs")
+    parser.add_argument("output_dir", help="directory for cubicles and summary")
+    parser.add_argument("--source-suffix", default=SOURCE_SUFFIX)
+    parser.add_argument("--mask-suffix", default=MASK_SUFFIX)
+    parser.add_argument(
+        "--layers", type=int, default=4, help="number of layers, 0 - detect"
+    )
+    parser.add_argument(
+        "--rows",
+        type=_int_list,
+        default=[3],
+        help="rows per layer, single number or list like 3-3-4, 0 - detect",
+    )
+    parser.add_argument(
+        "--bases", type=_int_list, default=None, help="mapping bases, e.g. 100,200"
+    )
+    parser.add_argument("--order", choices=SORTING_ORDERS, default="classic")
+    parser.add_argument(
+        "--detect-axes",
+        action="store_true",
+        help="detect the height, rows and columns axes of every scan "
+        "(the directions can't be detected, they are taken from --order)",
+    )
+    parser.add_argument(
+        "--method", choices=slogic.CLUSTERING_METHODS, default="optimal"
+    )
+    parser.add_argument(
+        "--span", type=int, default=5, help="voxels to expand the cubicles by"
+    )
+    parser.add_argument(
+        "--slab-size",
+        type=int,
+        default=0,
+        help="process scans out of core, labeling masks in slabs of that many "
+        "planes (scans larger than RAM), 0 - load scans whole",
+    )
+    parser.add_argument(
+        "--scratch-dir",
+        default=None,
+        help="directory for the memory-mapped label volumes of --slab-size "
+        "(default: the output directory)",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count(), help="worker processes"
+    )
+    parser.add_argument(
+        "--writers",
+        type=int,
+        default=1,
+        help=f"threads writing the cubicles of every scan (e.g. {WRITER_THREADS})",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=int,
+        default=0,
+        help="memory cap of every worker in MB, 0 - no limit",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    pairs = find_pairs(args.input_dir, args.source_suffix, args.mask_suffix)
+    if not pairs:
+        parser.error(f"No source/mask pairs found in {args.input_dir}")
+    logging.info(f"Found {len(pairs)} scans, {args.workers} workers")
+
+    summaries = run_batch(
+        pairs,
+        args.output_dir,
+        workers=args.workers,
+        memory_limit_mb=args.memory_limit,
+        num_layers=args.layers,
+        num_rows=args.rows[0] if len(args.rows) == 1 else args.rows,
+        mapping_bases=args.bases,
+        sorting_order=args.order,
+        clustering_method=args.method,
+        span=args.span,
+        slab_size=args.slab_size,
+        scratch_dir=args.scratch_dir,
+        writers=args.writers,
+        detect_axes=args.detect_axes,
+    )
+    write_summary(summaries, args.output_dir)
+    failed = [s["case"] for s in summaries if s["status"] != "ok"]
+    if failed:
+        logging.error(f"Failed scans: {failed}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,120 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage as ndi
+from scipy import sparse
+from scipy.sparse import csgraph
+
+# pylint: skip-file
+
+# Connected-component labeling of volumes larger than RAM. The mask is read
+# in slabs along the first axis (e.g. from np.load(path, mmap_mode="r") or
+# a memory-mapped NIfTI), every slab is labeled independently, the labels
+# touching across slab boundaries are merged with a union-find table
+# (connected components of the graph of provisional labels) and renumbered,
+# so the result is identical to ndi.label of the whole mask.
+
+SLAB_SIZE = 64
+
+
+def _label_slab(mask, out, start, stop, structure):
+    # labels one slab into out (local labels 1..n) and returns n with
+    # the boundary planes needed for merging
+    slab = np.asarray(mask[start:stop]) > 0
+    labels, num = ndi.label(slab, structure=structure, output=out.dtype)
+    out[start:stop] = labels
+    return num, labels[0].copy(), labels[-1].copy()
+
+
+def _boundary_edges(lower, upper, structure):
+    # pairs of provisional labels connected across the boundary between
+    # the last plane of a slab (lower) and the first plane of the next (upper)
+    edges = []
+    rows, cols = lower.shape
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if not structure[2, 1 + dy, 1 + dx]:
+                continue
+            a = lower[max(0, -dy) : rows - max(0, dy), max(0, -dx) : cols - max(0, dx)]
+            b = upper[max(0, dy) : rows - max(0, -dy), max(0, dx) : cols - max(0, -dx)]
+            both = (a > 0) & (b > 0)
+            edges.append(np.stack([a[both], b[both]]).astype(np.int64))
+    return np.concatenate(edges, axis=1)
+
+
+def label_slabs(
+    mask, slab_size=SLAB_SIZE, out=None, workers=1, structure=None, dtype=np.int32
+):
+    """
+    Function to label connected components of a 3D mask slab by slab.
+    mask - array-like of the shape (z, y, x) supporting slicing along the first
+    axis (numpy array or memmap), non-zero voxels belong to objects
+    slab_size - number of planes labeled at once
+    out - output array (e.g. np.lib.format.open_memmap), created if None
+    workers - number of threads labeling slabs in parallel
+    structure - connectivity as in ndi.label (3x3x3), face connectivity if None
+    dtype - dtype of the created output
+    Returns a tuple of the labeled array and the number of objects,
+    the same as ndi.label(mask > 0, structure) returns.
+    Raises RuntimeError (as ndi.label does) if the labels don't fit
+    the dtype of the output.
+    """
+    if structure is None:
+        structure = ndi.generate_binary_structure(3, 1)
+    structure = np.asarray(structure, dtype=bool)
+    assert structure.shape == (3, 3, 3), "Only 3x3x3 structures are supported"
+    if out is None:
+        out = np.empty(mask.shape, dtype=dtype)
+    depth = mask.shape[0]
+    bounds = [
+        (start, min(start + slab_size, depth)) for start in range(0, depth, slab_size)
+    ]
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        slabs = list(
+            executor.map(
+                lambda bound: _label_slab(mask, out, bound[0], bound[1], structure),
+                bounds,
+            )
+        )
+
+    # provisional labels are local labels shifted by the slab offsets
+    counts = np.array([num for num, _, _ in slabs], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    num_provisional = int(offsets[-1])
+
+    edges = [np.zeros((2, 0), dtype=np.int64)]
+    for i in range(len(slabs) - 1):
+        pairs = _boundary_edges(slabs[i][2], slabs[i + 1][1], structure)
+        pairs[0] += offsets[i]
+        pairs[1] += offsets[i + 1]
+        edges.append(pairs)
+    edges = np.concatenate(edges, axis=1)
+
+    # union-find over provisional labels
+    graph = sparse.coo_matrix(
+        (np.ones(edges.shape[1], dtype=np.int8), (edges[0], edges[1])),
+        shape=(num_provisional + 1, num_provisional + 1),
+    )
+    _, component = csgraph.connected_components(graph, directed=False)
+    # components are numbered by their smallest provisional label,
+    # it follows the raster order of the first voxel like ndi.label does
+    first = np.full(component.max() + 1, num_provisional + 1, dtype=np.int64)
+    np.minimum.at(first, component[1:], np.arange(1, num_provisional + 1))
+    used = first <= num_provisional
+    num_objects = int(used.sum())
+    if num_objects > np.iinfo(out.dtype).max:
+        raise RuntimeError(
+            f"{num_objects} objects don't fit the output dtype {out.dtype}"
+        )
+    rank = np.zeros(first.size, dtype=np.int64)
+    rank[used] = np.argsort(np.argsort(first[used], kind="stable")) + 1
+    final = np.zeros(num_provisional + 1, dtype=out.dtype)
+    final[1:] = rank[component[1:]]
+
+    for (start, stop), offset, count in zip(bounds, offsets[:-1], counts):
+        lut = np.zeros(count + 1, dtype=out.dtype)
+        lut[1:] = final[offset + 1 : offset + count + 1]
+        out[start:stop] = np.take(lut, out[start:stop], mode="clip")
+
+    return out, num_objects
@@ -0,0 +1,196 @@
+import gzip
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# pylint: skip-file
+
+# Streaming writers of volumes and cubicles. Arrays are handed over as soon
+# as they are ready and written as NIfTI files by a small pool of threads
+# (gzip and file IO release the GIL). The number of arrays waiting in the
+# queue is bounded, so the producer blocks instead of piling copies up
+# in memory when the disk is slower than the carving.
+
+WRITER_THREADS = 4
+
+# gzip levels of the written files, 0 writes uncompressed .nii
+COMPRESSION_LEVELS = {
+    0: "Uncompressed .nii (fast)",
+    1: "gzip level 1",
+    6: "gzip level 6",
+    9: "gzip level 9 (archive)",
+}
+DEFAULT_COMPRESSLEVEL = 1  # the level nibabel uses by default
+
+
+def nifti_extension(compresslevel=DEFAULT_COMPRESSLEVEL):
+    """
+    Returns the file extension of NIfTI files written with compresslevel.
+    """
+    return ".nii" if compresslevel == 0 else ".nii.gz"
+
+
+def save_volume(
+    array, affine, path, offset=(0, 0, 0), compresslevel=DEFAULT_COMPRESSLEVEL
+):
+    """
+    Function to save a KJI ordered array as a NIfTI volume.
+    array - array in the order of slicer.util.arrayFromVolume
+    affine - 4x4 IJK to RAS matrix of the original volume
+    path - .nii or .nii.gz file path
+    offset - KJI index of the first voxel of the array in the original volume
+    (cubicles keep their position in the physical space)
+    compresslevel - gzip level of .nii.gz files
+    Returns the size of the written file in bytes.
+    """
+    import nibabel as nib
+
+    affine = np.array(affine, dtype=np.float64)
+    affine[:3, 3] += affine[:3, :3] @ np.asarray(offset[::-1], dtype=np.float64)
+    image = nib.Nifti1Image(np.ascontiguousarray(array.transpose(2, 1, 0)), affine)
+    if path.endswith(".gz"):
+        with gzip.open(path, "wb", compresslevel=compresslevel) as f:
+            image.to_stream(f)
+    else:
+        with open(path, "wb") as f:
+            image.to_stream(f)
+    return os.path.getsize(path)
+
+
+class VolumeWriter:
+    """
+    Bounded pool of threads writing arrays as NIfTI files.
+    Use as a context manager, leaving it waits for all files and raises
+    the first write error.
+    """
+
+    def __init__(
+        self,
+        workers=WRITER_THREADS,
+        max_pending=None,
+        compresslevel=DEFAULT_COMPRESSLEVEL,
+    ):
+        """
+        workers - number of writer threads
+        max_pending - the largest number of arrays held in the queue,
+        twice the number of threads if None
+        compresslevel - gzip level of .nii.gz files
+        """
+        workers = max(1, workers)
+        self.compresslevel = compresslevel
+        self.extension = nifti_extension(compresslevel)
+        self._slots = threading.BoundedSemaphore(max_pending or 2 * workers)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._error = None
+        self._start = time.perf_counter()
+        self.seconds = 0.0
+        self.num_written = 0
+        self.raw_bytes = 0  # bytes of the written arrays
+        self.file_bytes = 0  # bytes of the written files
+
+    @property
+    def throughput_mb_s(self):
+        """
+        Written array data in MB per second of writing.
+        """
+        return self.raw_bytes / 2**20 / max(self.seconds, 1e-9)
+
+    def _write(self, array, affine, path, offset):
+        file_bytes = save_volume(array, affine, path, offset, self.compresslevel)
+        return array.nbytes, file_bytes
+
+    def _done(self, future):
+        self._slots.release()
+        with self._lock:
+            if future.exception() is not None:
+                self._error = self._error or future.exception()
+                return
+            raw_bytes, file_bytes = future.result()
+            self.num_written += 1
+            self.raw_bytes += raw_bytes
+            self.file_bytes += file_bytes
+
+    def write(self, array, affine, path, offset=(0, 0, 0)):
+        """
+        Queue an array for writing, blocks while the queue is full.
+        array - array owned by the writer from now on (not modified
+        by the caller until the writer is closed)
+        affine - 4x4 IJK to RAS matrix
+        path - path of the file without extension
+        offset - KJI index of the first voxel of the array in the volume
+        of the affine
+        """
+        if self._error is not None:
+            raise self._error
+        self._slots.acquire()
+        future = self._executor.submit(
+            self._write, array, affine, path + self.extension, offset
+        )
+        future.add_done_callback(self._done)
+
+    def close(self):
+        """
+        Wait for all queued arrays and raise the first write error.
+        """
+        self._executor.shutdown(wait=True)
+        self.seconds = time.perf_counter() - self._start
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._executor.shutdown(wait=True)
+        return False
+
+
+class CubicleWriter(VolumeWriter):
+    """
+    VolumeWriter of cubicles to <source_dir>/<name>_0000.nii.gz
+    and <segm_dir>/<name>.nii.gz (the names of the Export button).
+    """
+
+    def __init__(
+        self,
+        source_dir,
+        segm_dir,
+        affine,
+        workers=WRITER_THREADS,
+        max_pending=None,
+        compresslevel=DEFAULT_COMPRESSLEVEL,
+    ):
+        """
+        source_dir, segm_dir - output folders, empty or None to skip the side
+        affine - 4x4 IJK to RAS matrix of the volume the cubicles are cut from
+        the rest of parameters are the same as of VolumeWriter
+        """
+        super().__init__(workers, max_pending, compresslevel)
+        self.source_dir = source_dir
+        self.segm_dir = segm_dir
+        self.affine = affine
+        for folder in (source_dir, segm_dir):
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+
+    def submit(self, name, offset, source_cube, segm_cube):
+        """
+        Queue a cubicle for writing, blocks while the queue is full.
+        name - file name of the cubicle without extension
+        offset - KJI index of the first voxel of the cubicle
+        source_cube, segm_cube - arrays owned by the writer from now on
+        (not modified by the caller), None to skip the side
+        """
+        if self.source_dir and source_cube is not None:
+            path = os.path.join(self.source_dir, name + "_0000")
+            self.write(source_cube, self.affine, path, offset)
+        if self.segm_dir and segm_cube is not None:
+            path = os.path.join(self.segm_dir, name)
+            self.write(segm_cube, self.affine, path, offset)
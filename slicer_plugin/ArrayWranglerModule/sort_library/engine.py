@@ -0,0 +1,329 @@
+import logging
+import os
+import tempfile
+
+import numpy as np
+from scipy import ndimage as ndi
+
+from . import sorting_logic as slogic
+from .axis_detection import describe_sorting_order, detect_sorting_order
+from .chunked_label import label_slabs
+from .object_table import object_table
+
+# pylint: skip-file
+
+# Headless enumeration engine: label -> centroids -> layer/row/column sort ->
+# remap table. It has no Slicer or Qt dependency, so it can be used
+# from the Slicer module, command line tools or worker processes alike.
+
+# the 'space' between level numbers in the default mapping (100, 200, ...)
+MAPPING_SPACER = 100
+
+
+def default_mapping_bases(num_layers, spacer=MAPPING_SPACER):
+    """
+    Function to create the default mapping bases for levels: 100, 200, 300...
+    num_layers - number of layers (levels)
+    spacer - the 'space' between level numbers
+    Returns an array of mapping bases.
+    """
+    return np.arange(spacer, (num_layers + 1) * spacer, spacer)
+
+
+class EnumerationResult:
+    """
+    Outcome of sorting the objects of an array.
+    num_layers - number of layers (detected or given)
+    rows_per_level - list with the number of rows on every layer
+    mapping_bases - bases of level-wise labels (100, 200, ...)
+    remap - parallel arrays (original labels, sparse level-wise labels)
+    fused_remap - parallel arrays (original labels, consecutive labels)
+    sparse_labels - list of sparse labels, the sparse label of the consecutive
+    label i is found at position i - 1
+    objects - ObjectTable of the relabeled (consecutive) image, if known
+    sorting_order - dictionary with the sorting preferences used
+    (detected ones if the axes were detected automatically)
+    """
+
+    def __init__(
+        self,
+        num_layers,
+        rows_per_level,
+        mapping_bases,
+        remap,
+        fused_remap,
+        sparse_labels,
+        objects=None,
+        sorting_order=None,
+    ):
+        self.num_layers = num_layers
+        self.rows_per_level = rows_per_level
+        self.mapping_bases = mapping_bases
+        self.remap = remap
+        self.fused_remap = fused_remap
+        self.sparse_labels = sparse_labels
+        self.objects = objects
+        self.sorting_order = sorting_order
+
+    @property
+    def num_objects(self):
+        return len(self.sparse_labels)
+
+
+class SortingEngine:
+    """
+    Enumerates regular arrays of objects (seeds on plates stacked in layers)
+    in a binary mask: objects are sorted by layers, rows on a layer and
+    position in a row, and relabeled consecutively in that order.
+
+    num_layers - number of layers, 0 - detect automatically
+    num_rows - number of rows on every layer (single number or a list per layer),
+    0 - detect automatically
+    mapping_bases - bases of level-wise labels, by default 100, 200, ...
+    sorting_order - dictionary with sorting preferences
+    (slogic.sorting_order_classic or slogic.sorting_order_ras)
+    clustering_method - backend to cluster layers and rows,
+    one of slogic.CLUSTERING_METHODS
+    debug - if True, log additional information for debugging purposes
+    slab_size - if > 0, the mask is labeled in slabs of that many planes
+    (label_slabs), so a memory-mapped mask is never binarized as a whole,
+    the object table and the final remap are computed slab by slab as well
+    label_workers - number of threads labeling slabs in parallel
+    compact - if True, the mask is labeled straight into uint16 (int32 only
+    if there are more objects than uint16 holds) instead of int32
+    (memory-budget mode)
+    orientation - AxisOrientation of a volume reoriented without rewriting
+    its voxels, the centroids are sorted along the aligned axes
+    detect_axes - if True, the height, rows and columns axes are detected
+    from the centroids (detect_sorting_order), sorting_order gives
+    the directions only
+    scratch_dir - directory for disk-backed (memory-mapped) label volumes,
+    used with slab_size > 0: the labels and the enumerated image are written
+    there slab by slab instead of being held in RAM, the files are left
+    for the caller to remove (e.g. with a tempfile.TemporaryDirectory)
+    """
+
+    def __init__(
+        self,
+        num_layers=4,
+        num_rows=3,
+        mapping_bases=None,
+        sorting_order=slogic.sorting_order_classic,
+        clustering_method="optimal",
+        debug=False,
+        slab_size=0,
+        label_workers=1,
+        compact=False,
+        orientation=None,
+        detect_axes=False,
+        scratch_dir=None,
+    ):
+        self.num_layers = num_layers
+        self.num_rows = num_rows
+        self.mapping_bases = mapping_bases
+        self.sorting_order = sorting_order
+        self.clustering_method = clustering_method
+        self.debug = debug
+        self.slab_size = slab_size
+        self.label_workers = label_workers
+        self.compact = compact
+        self.orientation = orientation
+        self.detect_axes = detect_axes
+        self.scratch_dir = scratch_dir
+
+    def _scratch_array(self, name, shape, dtype):
+        # memory-mapped output volume in the scratch directory,
+        # None (an in-RAM output) unless the engine works out of core
+        if self.scratch_dir is None or self.slab_size <= 0:
+            return None
+        fd, path = tempfile.mkstemp(prefix=name, suffix=".npy", dir=self.scratch_dir)
+        os.close(fd)
+        return np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=shape)
+
+    def label(self, mask):
+        """
+        Label connected components of the mask and collect their features.
+        mask - numpy array, non-zero voxels belong to objects
+        Returns a tuple of the labeled image and its ObjectTable.
+        """
+        if self.compact:
+            # labeled straight into uint16, int32 only if there are more objects
+            try:
+                label_img_enum, num_objects = self._label(mask, np.uint16)
+            except RuntimeError:
+                logging.info("More than 65535 objects, labels are kept as int32")
+                label_img_enum, num_objects = self._label(mask, np.int32)
+        else:
+            label_img_enum, num_objects = self._label(mask, np.int32)
+        table = object_table(label_img_enum, slab_size=self.slab_size)
+        if self.debug:
+            logging.info(f"{mask.shape = } {num_objects = }")
+        return label_img_enum, table
+
+    def _label(self, mask, dtype):
+        # connected components of the mask in an output of the dtype,
+        # RuntimeError if the labels don't fit it
+        if self.slab_size > 0:
+            return label_slabs(
+                mask,
+                slab_size=self.slab_size,
+                out=self._scratch_array("labels_", mask.shape, dtype),
+                workers=self.label_workers,
+                dtype=dtype,
+            )
+        return ndi.label(mask > 0, output=dtype)
+
+    def min_gap(self, table):
+        """
+        Estimate the smallest gap between layers (rows) for their automatic
+        detection: a half of the typical object size, computed as the cube root
+        of the median object volume.
+        table - ObjectTable of the labeled image
+        Returns the gap in voxels (0 for an empty image).
+        """
+        if table.num_objects == 0:
+            return 0.0
+        return 0.5 * float(np.cbrt(np.median(table.counts)))
+
+    def sort(self, centroids, enum_labels, min_gap=0.0, sorting_order=None):
+        """
+        Sort the objects by their centroids.
+        centroids - an array of the shape (n, 3)
+        enum_labels - an array of the shape (n,) with labels of the objects
+        min_gap - the smallest gap between layers (rows) accepted when their
+        number is detected automatically, see min_gap()
+        sorting_order - dictionary with sorting preferences overriding
+        the one of the engine (e.g. detected axes)
+        Returns EnumerationResult.
+        """
+        sorder = self.sorting_order if sorting_order is None else sorting_order
+        num_layers = int(self.num_layers)
+        if num_layers == 0:
+            num_layers = slogic.count_clusters_1d(
+                centroids[:, sorder["height"]], min_gap=min_gap
+            )
+            logging.info(f"Detected number of layers: {num_layers}")
+
+        sorted_level_labels = slogic.cluster_zcoord(
+            cpoints=centroids,
+            num_zclusters=num_layers,
+            sorder=sorder,
+            debug=self.debug,
+            method=self.clustering_method,
+        )
+        if self.debug:
+            logging.info(f"{centroids.shape = }")
+            logging.info(f"{sorted_level_labels = }")
+
+        # level-wise labels are base + position on the level, so the spacer
+        # between bases has to exceed the number of objects on a level
+        # (100, 200... for usual trays, 1000, 2000... or more for larger ones)
+        max_on_level = int(np.bincount(sorted_level_labels).max(initial=0))
+        mapping_bases = self.mapping_bases
+        if mapping_bases is None or len(mapping_bases) == 0:
+            spacer = MAPPING_SPACER
+            while spacer <= max_on_level:
+                spacer *= 10
+            mapping_bases = default_mapping_bases(num_layers, spacer)
+        assert (
+            len(mapping_bases) == num_layers
+        ), "Number of mapping bases should be equal to number of layers."
+        if num_layers > 1 and np.min(np.diff(np.sort(mapping_bases))) <= max_on_level:
+            logging.warning(
+                f"Mapping bases {list(mapping_bases)} are too close for "
+                f"{max_on_level} objects on a level, level-wise labels overlap"
+            )
+
+        rows_per_level = slogic.resolve_rows_per_level(
+            center_points=centroids,
+            levelwise_labels=sorted_level_labels,
+            num_levels=num_layers,
+            rows_onlevel=self.num_rows,
+            sorder=sorder,
+            min_gap=min_gap,
+            method=self.clustering_method,
+        )
+        logging.info(f"Number of rows per layer: {rows_per_level}")
+
+        remap = slogic.full_remap(
+            level_bases=mapping_bases,
+            center_points=centroids,
+            levelwise_labels=sorted_level_labels,
+            init_enum=enum_labels,
+            rows_onlevel=rows_per_level,
+            sorting_scheme=sorder,
+            debug=self.debug,
+            method=self.clustering_method,
+            min_gap=min_gap,
+        )
+        # The positional mapping (with levels starting 100, 200 etc.) and
+        # bringing the enumeration to the consequtive format are composed
+        # at the level of labels, so the voxels are remapped only once.
+        fused_remap, sparse_labels = slogic.consecutive_remap(remap)
+        if self.debug:
+            logging.info(f"{remap = }")
+            logging.info(f"{fused_remap = }")
+
+        return EnumerationResult(
+            num_layers=num_layers,
+            rows_per_level=rows_per_level,
+            mapping_bases=[int(base) for base in mapping_bases],
+            remap=remap,
+            fused_remap=fused_remap,
+            sparse_labels=sparse_labels,
+            sorting_order=sorder,
+        )
+
+    def _detects_counts(self):
+        rows = np.atleast_1d(self.num_rows)
+        return int(self.num_layers) == 0 or not np.all(rows)
+
+    def relabel(self, label_img_enum, result, dtype="auto"):
+        """
+        Remap the labeled image to consecutive labels in the sorting order.
+        dtype - dtype of the output, "auto" - int16 while the labels fit,
+        uint16 or uint32 for larger arrays (slogic.label_volume_dtype),
+        None - the smallest unsigned type
+        Returns the remapped label image of the given dtype.
+        """
+        if isinstance(dtype, str) and dtype == "auto":
+            dtype = slogic.label_volume_dtype(result.num_objects)
+        elif dtype is None:
+            dtype = slogic.smallest_label_dtype(result.num_objects)
+        return slogic.perform_remap(
+            remapping_dict=result.fused_remap,
+            enum_img=label_img_enum,
+            dtype=dtype,
+            out=self._scratch_array("enumerated_", label_img_enum.shape, dtype),
+            slab_size=self.slab_size,
+        )
+
+    def run(self, mask, dtype="auto"):
+        """
+        Run the whole enumeration on the mask.
+        Returns a tuple of the enumerated label image and EnumerationResult.
+        """
+        label_img_enum, table = self.label(mask)
+        return self.run_labeled(label_img_enum, table, dtype=dtype)
+
+    def run_labeled(self, label_img_enum, table, dtype="auto"):
+        """
+        Run the enumeration on an already labeled image (see label()),
+        e.g. the one kept in a cache. The labeled image is not modified.
+        Returns a tuple of the enumerated label image and EnumerationResult.
+        """
+        min_gap = self.min_gap(table) if self._detects_counts() else 0.0
+        centroids = table.rounded_centroids()
+        if self.orientation is not None:
+            centroids = self.orientation.map_points(centroids, label_img_enum.shape)
+        sorting_order = None
+        if self.detect_axes:
+            sorting_order = detect_sorting_order(
+                centroids, self.sorting_order, min_gap=self.min_gap(table)
+            )
+            logging.info(f"Detected axes: {describe_sorting_order(sorting_order)}")
+        result = self.sort(
+            centroids, table.labels, min_gap=min_gap, sorting_order=sorting_order
+        )
+        result.objects = table.relabel(result.fused_remap)
+        return self.relabel(label_img_enum, result, dtype=dtype), result
@@ -0,0 +1,94 @@
+import logging
+from collections import OrderedDict
+
+# pylint: skip-file
+
+# Least recently used cache of labeled volumes and their object tables,
+# bounded by a memory budget. Keys are built by the caller (e.g. from node IDs
+# and modification times), so the cache itself does not depend on Slicer.
+
+LABEL_CACHE_BUDGET_MB = 1024
+
+
+def _table_nbytes(table):
+    arrays = (
+        table.labels,
+        table.counts,
+        table.centroids,
+        table.bbox_start,
+        table.bbox_stop,
+        table.intensity_sums,
+    )
+    return sum(array.nbytes for array in arrays if array is not None)
+
+
+class LabelCache:
+    """
+    LRU cache of (labeled image, ObjectTable) pairs.
+    memory_budget_mb - the largest total size of the cached arrays in MB,
+    0 disables the cache
+    Cached label images are made read-only, so an accidental in-place
+    modification fails instead of corrupting later results.
+    """
+
+    def __init__(self, memory_budget_mb=LABEL_CACHE_BUDGET_MB):
+        self.memory_budget_mb = memory_budget_mb
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns the cached tuple (labeled image, ObjectTable) or None.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def put(self, key, label_img, table):
+        """
+        Store the labeled image and its table, evicting the least recently used
+        entries to stay within the memory budget.
+        Entries larger than the whole budget are not stored.
+        """
+        self.discard(key)
+        nbytes = label_img.nbytes + _table_nbytes(table)
+        budget = int(self.memory_budget_mb * 1024 * 1024)
+        if nbytes > budget:
+            logging.info(f"Labels of {nbytes / 2**20:.0f} MB exceed the cache budget")
+            return
+        while self._entries and self._nbytes + nbytes > budget:
+            self.discard(next(iter(self._entries)))
+        label_img.setflags(write=False)
+        self._entries[key] = (label_img, table, nbytes)
+        self._nbytes += nbytes
+
+    def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._nbytes -= entry[2]
+
+    def set_memory_budget(self, memory_budget_mb):
+        """
+        Change the memory budget, evicting entries if it shrinks.
+        """
+        self.memory_budget_mb = memory_budget_mb
+        budget = int(memory_budget_mb * 1024 * 1024)
+        while self._entries and self._nbytes > budget:
+            self.discard(next(iter(self._entries)))
+
+    def clear(self):
+        self._entries.clear()
+        self._nbytes = 0
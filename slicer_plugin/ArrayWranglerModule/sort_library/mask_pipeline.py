@@ -0,0 +1,102 @@
+import logging
+import os
+import time
+
+import numpy as np
+from scipy import ndimage as ndi
+
+from . import morphology as smorphology
+from . import separation as sseparation
+from .chunked_label import label_slabs
+from .object_table import object_table, remove_small_objects
+
+# pylint: skip-file
+
+# Composable mask operations. A pipeline is a list of steps (name, parameters)
+# run on the mask array one after another, so the segmentation is exported
+# and imported only once for the whole chain, e.g.
+#
+#   run_pipeline(mask, [("erosion", {"iterations": 2}),
+#                       ("remove_small", {"min_size": 30})])
+#
+# or from text: parse_pipeline("erosion 2; remove_small 30; separate 1.5")
+
+
+def _erosion(mask, iterations=1, structure=None, workers=None):
+    return smorphology.binary_erosion(mask, structure, int(iterations), workers=workers)
+
+
+def _remove_small(mask, min_size=30, workers=None):
+    workers = workers or os.cpu_count() or 1
+    label_img, _ = label_slabs(mask, workers=workers)
+    return remove_small_objects(
+        label_img, object_table(label_img), int(min_size), workers=workers
+    )
+
+
+def _separate(mask, size_factor=sseparation.SIZE_FACTOR, workers=None):
+    label_img, _ = ndi.label(mask)
+    table = object_table(label_img)
+    separated, _, _ = sseparation.separate_objects(
+        label_img, table, float(size_factor), workers=workers or 1
+    )
+    return sseparation.pieces_mask(separated, table.max_label + 1)
+
+
+# name -> (function of the mask, name of the parameter given in text specs)
+MASK_OPERATIONS = {
+    "erosion": (_erosion, "iterations"),
+    "remove_small": (_remove_small, "min_size"),
+    "separate": (_separate, "size_factor"),
+}
+
+
+def parse_pipeline(text):
+    """
+    Function to parse a pipeline typed in UI, like
+    "erosion 2; remove_small 30; separate 1.5" (steps separated by ";",
+    every step is an operation name and an optional value of its
+    main parameter).
+    Returns a list of steps (name, parameters).
+    """
+    steps = []
+    for item in text.split(";"):
+        parts = item.split()
+        if not parts:
+            continue
+        name = parts[0].lower()
+        if name not in MASK_OPERATIONS:
+            raise ValueError(
+                f"Unknown mask operation '{name}', "
+                f"expected one of {list(MASK_OPERATIONS)}"
+            )
+        if len(parts) > 2:
+            raise ValueError(f"Wrong format of the step '{item.strip()}'")
+        params = {}
+        if len(parts) == 2:
+            params[MASK_OPERATIONS[name][1]] = float(parts[1])
+        steps.append((name, params))
+    return steps
+
+
+def run_pipeline(mask, steps, workers=None, debug=False):
+    """
+    Function to run mask operations one after another.
+    mask - 3D array, non-zero voxels belong to objects
+    steps - list of tuples (operation name, dictionary of parameters),
+    see MASK_OPERATIONS
+    workers - number of threads used by the operations
+    debug - if True, log the voxel count and time of every step
+    Returns the resulting bool mask.
+    """
+    mask = np.asarray(mask) > 0
+    for name, params in steps:
+        operation = MASK_OPERATIONS[name][0]
+        start = time.perf_counter()
+        mask = operation(mask, workers=workers, **params)
+        if debug:
+            logging.info(
+                f"{name} {params}: {np.count_nonzero(mask)} voxels, "
+                f"{time.perf_counter() - start:.2f} s"
+            )
+    return mask
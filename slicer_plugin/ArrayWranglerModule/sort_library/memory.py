@@ -0,0 +1,91 @@
+import logging
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# pylint: skip-file
+
+# Peak memory reporting and a rough up-front estimate of the memory needed
+# to enumerate a volume. NumPy reports its buffers to tracemalloc, so the
+# peak covers the arrays allocated by the pipeline (not VTK/Slicer buffers).
+
+
+class MemoryReport:
+    """
+    Result of peak_memory: name of the tracked call, peak of traced
+    allocations in bytes (relative to the start of the call) and duration.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.peak_bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def peak_mb(self):
+        return self.peak_bytes / 2**20
+
+    def __repr__(self):
+        return f"{self.name}: peak {self.peak_mb:.1f} MB in {self.seconds:.2f} s"
+
+
+@contextmanager
+def peak_memory(name, enabled=True):
+    """
+    Context manager to measure the peak of memory allocated inside the block.
+    name - name of the tracked call used in the log message
+    enabled - if False, nothing is traced (tracemalloc slows Python code down)
+    Yields MemoryReport filled when the block exits.
+    """
+    report = MemoryReport(name)
+    if not enabled:
+        yield report
+        return
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield report
+    finally:
+        report.seconds = time.perf_counter() - start
+        report.peak_bytes = max(0, tracemalloc.get_traced_memory()[1] - baseline)
+        if started:
+            tracemalloc.stop()
+        logging.info(repr(report))
+
+
+def estimate_peak_bytes(shape, mask_itemsize=1, foreground_fraction=0.5):
+    """
+    Function to estimate the peak memory of enumerating a mask
+    with compact dtypes (bool mask, narrowest labels), to check up front
+    whether a scan fits on a workstation.
+    shape - shape of the volume
+    mask_itemsize - bytes per voxel of the exported mask
+    foreground_fraction - expected fraction of object voxels
+    Returns the estimate in bytes.
+    The model: exported mask + binarized bool mask + int32 labels of ndi.label
+    coexisting with their narrowed (up to uint32) copy + the enumerated
+    output (up to uint32) + the object table sweep (flat indices, labels,
+    their sort order and decoded coordinates, 8 bytes each, for the foreground).
+    """
+    voxels = 1
+    for size in shape:
+        voxels *= int(size)
+    per_voxel = mask_itemsize + 1 + 4 + 4 + 4
+    per_foreground_voxel = 8 * 4
+    return int(voxels * (per_voxel + per_foreground_voxel * foreground_fraction))
+
+
+def available_memory_bytes():
+    """
+    Returns the physical memory available to new processes in bytes,
+    or None if it can't be determined on this platform.
+    """
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
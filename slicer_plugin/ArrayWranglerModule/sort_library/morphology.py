@@ -0,0 +1,77 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage as ndi
+
+# pylint: skip-file
+
+# Chunked morphology executor. The volume is split into blocks along the first
+# axis, every block is read with a halo of planes sized to the structuring
+# element (times iterations), processed in a thread pool (scipy releases
+# the GIL) and its core is written into a preallocated output. The halo
+# makes the result identical to the whole-volume operation.
+
+BLOCK_SIZE = 64
+
+
+def _default_workers(workers):
+    return max(1, workers or os.cpu_count() or 1)
+
+
+def map_blocks(
+    func, image, out, halo=0, block_size=BLOCK_SIZE, workers=None, dtype=None
+):
+    """
+    Function to apply func to overlapping blocks of the image in parallel.
+    func - function of a block returning an array of the same shape
+    image - array-like of 3D shape supporting slicing along the first axis
+    out - output array, created (with dtype or the dtype of image) if None
+    halo - number of planes added on both sides of a block
+    block_size - number of planes of a block core
+    workers - number of threads, all cores if None
+    Returns the output array.
+    """
+    depth = image.shape[0]
+    if out is None:
+        out = np.empty(image.shape, dtype=dtype or image.dtype)
+
+    def process(start):
+        stop = min(start + block_size, depth)
+        ext_start, ext_stop = max(0, start - halo), min(depth, stop + halo)
+        result = func(np.asarray(image[ext_start:ext_stop]))
+        out[start:stop] = result[start - ext_start : stop - ext_start]
+
+    with ThreadPoolExecutor(max_workers=_default_workers(workers)) as executor:
+        list(executor.map(process, range(0, depth, block_size)))
+    return out
+
+
+def binary_erosion(
+    mask, structure=None, iterations=1, block_size=BLOCK_SIZE, workers=None, out=None
+):
+    """
+    Function to erode a binary mask block by block in parallel, the result
+    equals skimage.morphology.binary_erosion (the border counts as object)
+    applied iterations times.
+    mask - 3D array-like, non-zero voxels belong to objects
+    structure - structuring element (odd-sized, centered), cross if None
+    iterations - number of erosions (at least 1)
+    Returns the eroded bool mask.
+    Raises ValueError if iterations is less than 1.
+    """
+    # ndi.binary_erosion repeats until nothing changes for iterations < 1,
+    # which the halo of a finite size can't cover
+    if iterations < 1:
+        raise ValueError(f"Number of iterations {iterations} should be at least 1")
+    if structure is None:
+        structure = ndi.generate_binary_structure(3, 1)
+    structure = np.asarray(structure, dtype=bool)
+    halo = (structure.shape[0] // 2) * iterations
+
+    def erode(block):
+        return ndi.binary_erosion(
+            block > 0, structure=structure, iterations=iterations, border_value=1
+        )
+
+    return map_blocks(erode, mask, out, halo, block_size, workers, dtype=bool)
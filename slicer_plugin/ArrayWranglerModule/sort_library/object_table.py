@@ -0,0 +1,254 @@
+import numpy as np
+
+from . import sorting_logic as slogic
+from .morphology import map_blocks
+
+# pylint: skip-file
+
+# Per-object features of a label image collected in one sweep: the foreground
+# voxels are found once, grouped by label with a single stable sort and every
+# feature is reduced over the groups. It replaces separate np.unique,
+# ndi.center_of_mass and ndi.find_objects passes over the whole volume.
+
+
+class ObjectTable:
+    """
+    Array-backed table of the objects of a label image, row i describes
+    the object labels[i], the rows are sorted by label.
+    labels - array (n,) of labels present in the image (background 0 excluded)
+    counts - array (n,) of voxel counts
+    centroids - array (n, 3) of centroids (mean voxel index)
+    bbox_start, bbox_stop - arrays (n, 3) of bounding boxes, stop is exclusive
+    intensity_sums - array (n,) of intensity sums or None
+    shape - shape of the label image
+    """
+
+    def __init__(
+        self, labels, counts, centroids, bbox_start, bbox_stop, intensity_sums, shape
+    ):
+        self.labels = labels
+        self.counts = counts
+        self.centroids = centroids
+        self.bbox_start = bbox_start
+        self.bbox_stop = bbox_stop
+        self.intensity_sums = intensity_sums
+        self.shape = tuple(shape)
+
+    @property
+    def num_objects(self):
+        return self.labels.size
+
+    @property
+    def max_label(self):
+        return int(self.labels[-1]) if self.labels.size else 0
+
+    def rounded_centroids(self):
+        """
+        Returns the centroids rounded to voxel indices as an int32 array (n, 3).
+        """
+        return np.round(self.centroids).astype(np.int32)
+
+    def mean_intensities(self):
+        """
+        Returns the mean intensity of every object (requires intensity sums).
+        """
+        return self.intensity_sums / self.counts
+
+    def slices(self, span=0):
+        """
+        Function to get the bounding boxes as tuples of slices
+        (like ndi.find_objects) expanded by span voxels in each direction
+        and clipped to the image (like expand_object_dims).
+        Returns a list of tuples of slices in the order of labels.
+        """
+        start = np.maximum(self.bbox_start - span, 0)
+        stop = np.minimum(self.bbox_stop + span, self.shape)
+        return [
+            tuple(slice(int(a), int(b), None) for a, b in zip(row_start, row_stop))
+            for row_start, row_stop in zip(start, stop)
+        ]
+
+    def select(self, rows):
+        """
+        Function to create a table with a subset of objects.
+        rows - boolean mask or indices of rows
+        """
+        return ObjectTable(
+            labels=self.labels[rows],
+            counts=self.counts[rows],
+            centroids=self.centroids[rows],
+            bbox_start=self.bbox_start[rows],
+            bbox_stop=self.bbox_stop[rows],
+            intensity_sums=(
+                None if self.intensity_sums is None else self.intensity_sums[rows]
+            ),
+            shape=self.shape,
+        )
+
+    def relabel(self, remapping):
+        """
+        Function to create the table of a remapped label image without
+        rescanning it.
+        remapping - dictionary or parallel arrays (old labels, new labels)
+        covering all labels of the table
+        Returns a new table sorted by the new labels.
+        """
+        old_labels, new_labels = slogic.remap_arrays(remapping)
+        rows = np.searchsorted(self.labels, old_labels)
+        order = np.argsort(new_labels, kind="stable")
+        table = self.select(rows[order])
+        table.labels = new_labels[order]
+        return table
+
+
+def _empty_table(shape, with_intensity=False):
+    empty = np.zeros((0, len(shape)), dtype=np.int64)
+    return ObjectTable(
+        labels=np.zeros(0, dtype=np.int64),
+        counts=np.zeros(0, dtype=np.int64),
+        centroids=np.zeros((0, len(shape)), dtype=np.float64),
+        bbox_start=empty,
+        bbox_stop=empty.copy(),
+        intensity_sums=np.zeros(0) if with_intensity else None,
+        shape=shape,
+    )
+
+
+def _collect_features(label_img, intensity_img=None, offset=0):
+    # per-label voxel counts, coordinate sums (exact integers, so tables
+    # of slabs can be merged without rounding), bounding boxes and intensity
+    # sums, offset is added to the coordinates along the first axis
+    shape = label_img.shape
+    flat_labels = label_img.ravel()
+    # the only full-volume pass, further work is proportional
+    # to the number of foreground voxels
+    flat_index = np.flatnonzero(flat_labels)
+    voxel_labels = flat_labels[flat_index]
+    order = np.argsort(voxel_labels, kind="stable")
+    flat_index = flat_index[order]
+    voxel_labels = voxel_labels[order]
+    del order
+
+    if flat_index.size == 0:
+        return None
+
+    starts = np.flatnonzero(np.r_[True, voxel_labels[1:] != voxel_labels[:-1]])
+    labels = voxel_labels[starts].astype(np.int64)
+    counts = np.diff(np.r_[starts, voxel_labels.size]).astype(np.int64)
+
+    ndim = len(shape)
+    coord_sums = np.empty((labels.size, ndim), dtype=np.int64)
+    bbox_start = np.empty((labels.size, ndim), dtype=np.int64)
+    bbox_stop = np.empty((labels.size, ndim), dtype=np.int64)
+    stride = 1
+    # coordinates are decoded axis by axis to keep a single
+    # foreground-sized temporary array
+    for axis in range(ndim - 1, -1, -1):
+        coords = (flat_index // stride) % shape[axis]
+        coord_sums[:, axis] = np.add.reduceat(coords, starts)
+        bbox_start[:, axis] = np.minimum.reduceat(coords, starts)
+        bbox_stop[:, axis] = np.maximum.reduceat(coords, starts) + 1
+        stride *= shape[axis]
+    coord_sums[:, 0] += offset * counts
+    bbox_start[:, 0] += offset
+    bbox_stop[:, 0] += offset
+
+    intensity_sums = None
+    if intensity_img is not None:
+        assert intensity_img.shape == shape, "Intensity and label shapes differ"
+        values = np.asarray(intensity_img).ravel()[flat_index].astype(np.float64)
+        intensity_sums = np.add.reduceat(values, starts)
+    return labels, counts, coord_sums, bbox_start, bbox_stop, intensity_sums
+
+
+def _merge_features(parts):
+    # joins the features of slabs: objects crossing slab boundaries
+    # appear in several parts, their counts and sums add up
+    # and their bounding boxes are united
+    labels, counts, coord_sums, bbox_start, bbox_stop, intensity_sums = (
+        np.concatenate(values) if values[0] is not None else None
+        for values in zip(*parts)
+    )
+    order = np.argsort(labels, kind="stable")
+    labels = labels[order]
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    return (
+        labels[starts],
+        np.add.reduceat(counts[order], starts),
+        np.add.reduceat(coord_sums[order], starts, axis=0),
+        np.minimum.reduceat(bbox_start[order], starts, axis=0),
+        np.maximum.reduceat(bbox_stop[order], starts, axis=0),
+        (
+            None
+            if intensity_sums is None
+            else np.add.reduceat(intensity_sums[order], starts)
+        ),
+    )
+
+
+def object_table(label_img, intensity_img=None, slab_size=0):
+    """
+    Function to collect per-object features of a label image in one sweep.
+    label_img - a 3D numpy array with non-negative integer labels
+    (or a memory-mapped array if slab_size is given)
+    intensity_img - optional array of the same shape (source volume),
+    if given, intensity sums of the objects are collected as well
+    slab_size - if > 0, the image is swept in slabs of that many planes
+    along the first axis and the tables of the slabs are merged, so only
+    a slab of the image (and of its foreground) is held in memory at once
+    Returns ObjectTable.
+    """
+    shape = label_img.shape
+    if 0 < slab_size < shape[0]:
+        parts = [
+            _collect_features(
+                np.asarray(label_img[start : start + slab_size]),
+                (
+                    None
+                    if intensity_img is None
+                    else intensity_img[start : start + slab_size]
+                ),
+                offset=start,
+            )
+            for start in range(0, shape[0], slab_size)
+        ]
+        parts = [part for part in parts if part is not None]
+        features = _merge_features(parts) if parts else None
+    else:
+        features = _collect_features(label_img, intensity_img)
+
+    if features is None:
+        return _empty_table(shape, with_intensity=intensity_img is not None)
+    labels, counts, coord_sums, bbox_start, bbox_stop, intensity_sums = features
+    return ObjectTable(
+        labels=labels,
+        counts=counts,
+        centroids=coord_sums / counts[:, None],
+        bbox_start=bbox_start,
+        bbox_stop=bbox_stop,
+        intensity_sums=intensity_sums,
+        shape=shape,
+    )
+
+
+def remove_small_objects(label_img, table, min_size, workers=1):
+    """
+    Function to remove objects smaller than min_size voxels
+    (like skimage.morphology.remove_small_objects, but without relabeling).
+    label_img - a labeled image
+    table - ObjectTable of the label image
+    min_size - the smallest object size to keep
+    workers - number of threads selecting the kept objects block by block
+    Returns a boolean mask of the kept objects.
+    """
+    keep = np.zeros(table.max_label + 1, dtype=bool)
+    keep[table.labels[table.counts >= min_size]] = True
+    if workers > 1:
+        return map_blocks(
+            lambda block: np.take(keep, block, mode="clip"),
+            label_img,
+            None,
+            workers=workers,
+            dtype=bool,
+        )
+    return np.take(keep, label_img, mode="clip")
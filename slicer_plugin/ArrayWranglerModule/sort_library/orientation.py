@@ -0,0 +1,138 @@
+import numpy as np
+
+# pylint: skip-file
+
+# Zero-copy reorientation. Flips, swaps and rotations by 90 degrees of
+# a volume are tracked as a permutation and flips of the array axes instead
+# of rewriting the voxels: the aligned ("logical") array is the view
+#
+#   np.flip(np.transpose(array, perm), flipped axes)
+#
+# of the stored one. The same descriptor maps object centroids to the aligned
+# axes for sorting, and its index matrix composed with the IJK to RAS matrix
+# of the volume places the stored voxels where the rewritten ones would be.
+# A queue of such operations simplifies to a single descriptor, i.e. one
+# transpose + flip, whatever the number of clicks (see simplify).
+
+AXIS_OPERATIONS = ("flip", "swapaxes", "rot90")
+
+
+class AxisOrientation:
+    """
+    Permutation and flips of the axes of a 3D array. The methods flip,
+    swapaxes and rot90 take the arguments of their numpy namesakes and
+    compose the operation with the descriptor (applied to the aligned view).
+    """
+
+    def __init__(self, perm=(0, 1, 2), flips=(False, False, False)):
+        self.perm = list(perm)
+        self.flips = [bool(flip) for flip in flips]
+
+    def __repr__(self):
+        return f"AxisOrientation(perm={tuple(self.perm)}, flips={tuple(self.flips)})"
+
+    def __eq__(self, other):
+        return self.perm == other.perm and self.flips == other.flips
+
+    @property
+    def is_identity(self):
+        return self.perm == [0, 1, 2] and not any(self.flips)
+
+    def copy(self):
+        return AxisOrientation(self.perm, self.flips)
+
+    def flip(self, axis):
+        """
+        Compose np.flip(view, axis).
+        """
+        self.flips[axis] = not self.flips[axis]
+        return self
+
+    def swapaxes(self, axis1, axis2):
+        """
+        Compose np.swapaxes(view, axis1, axis2).
+        """
+        for axes in (self.perm, self.flips):
+            axes[axis1], axes[axis2] = axes[axis2], axes[axis1]
+        return self
+
+    def rot90(self, k=1, axes=(0, 1)):
+        """
+        Compose np.rot90(view, k, axes).
+        """
+        axis1, axis2 = axes
+        for _ in range(k % 4):
+            # the same decomposition as numpy uses for k == 1
+            self.flip(axis2).swapaxes(axis1, axis2)
+        return self
+
+    def view(self, array):
+        """
+        Returns the aligned view of the stored array (no copy).
+        """
+        flipped = tuple(axis for axis, flip in enumerate(self.flips) if flip)
+        return np.flip(np.transpose(array, self.perm), axis=flipped)
+
+    def aligned_shape(self, shape):
+        """
+        Returns the shape of the aligned view of an array of the shape.
+        """
+        return tuple(shape[axis] for axis in self.perm)
+
+    def map_points(self, points, shape):
+        """
+        Function to map indices of the stored array to the aligned view.
+        points - array of the shape (n, 3), e.g. object centroids
+        shape - shape of the stored array
+        Returns an array of the shape (n, 3).
+        """
+        points = np.asarray(points)
+        aligned = points[:, self.perm].copy()
+        for axis, flip in enumerate(self.flips):
+            if flip:
+                aligned[:, axis] = shape[self.perm[axis]] - 1 - aligned[:, axis]
+        return aligned
+
+    def index_matrix(self, shape):
+        """
+        Returns the 4x4 matrix mapping homogeneous indices of the stored array
+        to indices of the aligned view (both in the numpy KJI order).
+        """
+        matrix = np.zeros((4, 4))
+        matrix[3, 3] = 1.0
+        for axis, source in enumerate(self.perm):
+            if self.flips[axis]:
+                matrix[axis, source] = -1.0
+                matrix[axis, 3] = shape[source] - 1
+            else:
+                matrix[axis, source] = 1.0
+        return matrix
+
+    def ijk_matrix(self, shape):
+        """
+        Returns index_matrix in the IJK order of volume geometry, so that
+        IJK to RAS of the aligned volume times ijk_matrix is IJK to RAS
+        of the stored voxels placed where the aligned ones are.
+        shape - shape of the stored array (KJI order)
+        """
+        reverse = np.eye(4)[[2, 1, 0, 3]]  # IJK <-> KJI
+        return reverse @ self.index_matrix(shape) @ reverse
+
+
+def simplify(operations, orientation=None):
+    """
+    Function to compose a sequence of axis operations into one permutation
+    and flips of the axes.
+    operations - list of tuples (name, args, kwargs), the name is one of
+    AXIS_OPERATIONS, args and kwargs are the arguments of the numpy function
+    except the array
+    orientation - AxisOrientation the operations are applied after,
+    identity if None (not modified)
+    Returns a new AxisOrientation.
+    """
+    result = AxisOrientation() if orientation is None else orientation.copy()
+    for name, args, kwargs in operations:
+        if name not in AXIS_OPERATIONS:
+            raise ValueError(f"Unknown axis operation '{name}'")
+        getattr(result, name)(*args, **kwargs)
+    return result
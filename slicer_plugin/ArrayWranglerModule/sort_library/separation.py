@@ -0,0 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy import ndimage as ndi
+
+from . import sorting_logic as slogic
+
+# pylint: skip-file
+
+# Separation of touching objects. Merged components are found in the object
+# table as volume outliers and split by a distance-transform watershed run
+# only inside their bounding boxes, the rest of the volume is not touched.
+# The pieces keep every voxel of the object (no watershed lines), so their
+# sizes add up to the size of the object. A binary mask can't keep touching
+# pieces apart, so pieces_mask cuts them only when the labels are binarized.
+
+# objects larger than SIZE_FACTOR times the median size are treated as merged
+SIZE_FACTOR = 1.5
+
+
+def find_merged(table, size_factor=SIZE_FACTOR):
+    """
+    Function to find merged (touching) objects as volume outliers.
+    table - ObjectTable of the labeled mask
+    size_factor - objects larger than size_factor * median size are suspects
+    Returns an array of rows of the table.
+    """
+    if table.num_objects == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.flatnonzero(table.counts > size_factor * np.median(table.counts))
+
+
+def split_object(cube, label, num_pieces, min_distance):
+    """
+    Function to split one object by the watershed of its distance transform.
+    cube - labeled image cropped to the bounding box of the object
+    (with a margin, so the object doesn't touch the borders)
+    label - label of the object
+    num_pieces - the largest number of pieces (markers)
+    min_distance - the smallest distance between markers (voxels)
+    Returns the array of pieces 1..k (0 - background), covering every voxel
+    of the object, or None if the object has a single marker.
+    """
+    from skimage.feature import peak_local_max
+    from skimage.segmentation import watershed
+
+    mask = cube == label
+    distance = ndi.distance_transform_edt(mask)
+    peaks = peak_local_max(
+        distance,
+        min_distance=min_distance,
+        labels=mask.view(np.uint8),
+        num_peaks=num_pieces,
+        exclude_border=False,
+    )
+    if len(peaks) < 2:
+        return None
+    markers = np.zeros(cube.shape, dtype=np.int32)
+    markers[tuple(peaks.T)] = np.arange(1, len(peaks) + 1)
+    return watershed(-distance, markers, mask=mask, watershed_line=False)
+
+
+def separate_objects(
+    label_img, table, size_factor=SIZE_FACTOR, min_distance=None, workers=1
+):
+    """
+    Function to split merged objects of a labeled image.
+    label_img - labeled image (not modified)
+    table - ObjectTable of the labeled image
+    size_factor - objects larger than size_factor * median size are split
+    min_distance - the smallest distance between centers of pieces,
+    by default the radius of a sphere of the median object volume
+    workers - number of threads splitting objects in parallel
+    Returns a tuple of the new labeled image (pieces get labels after
+    the largest label), the number of split objects and the number of pieces.
+    """
+    rows = find_merged(table, size_factor)
+    if rows.size == 0:
+        return label_img, 0, 0
+    median = float(np.median(table.counts))
+    if min_distance is None:
+        min_distance = max(1, int(np.cbrt(3 * median / (4 * np.pi))))
+    suspects = table.select(rows)
+    slices = suspects.slices(span=1)
+
+    def split(i):
+        num_pieces = max(2, int(round(suspects.counts[i] / median)))
+        return split_object(
+            label_img[slices[i]], suspects.labels[i], num_pieces, min_distance
+        )
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        results = list(executor.map(split, range(len(slices))))
+
+    num_pieces = sum(int(pieces.max()) for pieces in results if pieces is not None)
+    next_label = table.max_label + 1
+    dtype = slogic.smallest_label_dtype(next_label + num_pieces)
+    out = label_img.astype(np.promote_types(label_img.dtype, dtype))
+    num_split = 0
+    for obex, label, pieces in zip(slices, suspects.labels, results):
+        if pieces is None:
+            continue
+        region = out[obex]
+        inside = pieces > 0
+        region[inside] = pieces[inside] + (next_label - 1)
+        next_label += int(pieces.max())
+        num_split += 1
+    return out, num_split, num_pieces
+
+
+def pieces_mask(label_img, first_label):
+    """
+    Function to binarize a labeled image with split pieces, so the pieces
+    stay apart when the mask is labeled again: where two pieces touch
+    by a face, the voxel of the piece with the lower label is cleared.
+    label_img - labeled image returned by separate_objects
+    first_label - the label of the first piece (the largest label
+    of the table given to separate_objects + 1)
+    Returns the bool mask.
+    """
+    mask = label_img > 0
+    for axis in range(label_img.ndim):
+        lower = [slice(None)] * label_img.ndim
+        upper = [slice(None)] * label_img.ndim
+        lower[axis], upper[axis] = slice(None, -1), slice(1, None)
+        low, high = label_img[tuple(lower)], label_img[tuple(upper)]
+        cut = (low != high) & (np.minimum(low, high) >= first_label)
+        mask[tuple(lower)] &= ~(cut & (low < high))
+        mask[tuple(upper)] &= ~(cut & (high < low))
+    return mask
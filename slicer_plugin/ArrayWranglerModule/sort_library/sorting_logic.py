@@ -1,18 +1,15 @@
 import numpy as np
-import slicer
+from scipy.spatial import cKDTree
 
 # pylint: skip-file
 
-# check if scikit-learn is installed, if not - install it
+# The module is deliberately free of Slicer (and Qt) dependencies,
+# so the sorting can run in a plain Python process, a worker pool or a test.
+# scikit-learn is optional and only needed for the 'kmeans' clustering backend.
 try:
     from sklearn.cluster import KMeans
 except ModuleNotFoundError:
-    if slicer.util.confirmOkCancelDisplay(
-        "This module requires 'scikit-learn' Python package. "
-        "Click OK to install it now."
-    ):
-        slicer.util.pip_install("scikit-learn")
-        from sklearn.cluster import KMeans
+    KMeans = None
 
 # dictinary defining sorting order (axes) in the numpy array
 sorting_order_classic = {
@@ -42,35 +39,283 @@ sorting_order_ras = {
 }
 
 
-def cluster_zcoord(cpoints, num_zclusters=4, sorder=sorting_order_classic, debug=True):
+# available backends for clustering 1D coordinates (layers and rows)
+# and their names displayed in the UI
+CLUSTERING_METHODS = {
+    "optimal": "Exact 1D k-means (deterministic)",
+    "kmeans": "KMeans (scikit-learn)",
+    "gaps": "Split at the largest gaps",
+    "lattice": "Fit a (tilted) grid of rows and columns",
+}
+
+# default of the gap-based detection of the number of layers/rows: how many
+# times the breaks between clusters exceed the gaps inside them (on average)
+GAP_FACTOR = 3.0
+
+# step (voxels) to which coordinates are rounded before the exact 1D k-means
+# in cluster_1d: the DP runs over distinct values, which are then bounded
+# by the extent of the array / OPTIMAL_RESOLUTION instead of the number
+# of objects, the clusters of an array of objects are not affected
+OPTIMAL_RESOLUTION = 0.1
+
+# iterations of the estimate of the spacing in a row (lattice method)
+LATTICE_ITERATIONS = 3
+
+
+def _segment_costs(prefix0, prefix1, prefix2, starts, stops):
+    """
+    Sum of squared deviations from the mean for the segments [start, stop]
+    (inclusive) of a sorted array of weighted values,
+    computed from the prefix sums of weights, values and squared values.
+    """
+    counts = prefix0[stops + 1] - prefix0[starts]
+    sums = prefix1[stops + 1] - prefix1[starts]
+    sums2 = prefix2[stops + 1] - prefix2[starts]
+    return np.maximum(sums2 - sums * sums / counts, 0.0)
+
+
+def kmeans_1d_optimal(data, n_clusters, resolution=None):
+    """
+    Function to find the globally optimal k-means clustering of 1D data.
+    Uses dynamic programming over the sorted data, where each layer of the
+    DP table is filled by divide and conquer (the optimal split point is
+    monotone), processing all subproblems of a recursion depth at once
+    in O(n) vectorized operations. Total cost is O(k n log n), where n is
+    the number of distinct values (repeated values, e.g. rounded centroids,
+    always fall into the same cluster and are processed as weighted points).
+    data - an array of n values (any shape, flattened)
+    n_clusters - number of clusters k (1 <= k <= n)
+    resolution - if given, values equal after rounding to this step are kept
+    in the same cluster (processed as one point at their mean), which bounds
+    the number of distinct values (and the time) for unrounded data
+    Returns a tuple of labels (n,) and cluster centers (k,), clusters being
+    numbered in ascending order of their centers.
+    """
+    data = np.asarray(data, dtype=np.float64).ravel()
+    n = data.size
+    if not 1 <= n_clusters <= n:
+        raise ValueError(f"Number of clusters {n_clusters} should be between 1 and {n}")
+
+    keys = data if resolution is None else np.round(data / resolution)
+    values, inverse, weights = np.unique(keys, return_inverse=True, return_counts=True)
+    if resolution is not None:
+        # means of the rounded groups, they keep the order of the groups
+        values = np.bincount(inverse.ravel(), weights=data) / weights
+    if values.size < n_clusters:
+        # not enough distinct values, equal values have to be split
+        order = np.argsort(data, kind="stable")
+        values, weights = data[order], np.ones(n)
+        inverse = np.empty(n, dtype=np.int64)
+        inverse[order] = np.arange(n)
+    n = values.size
+    xs = values - data.mean()  # centering improves numerical accuracy
+    prefix0 = np.concatenate(([0.0], np.cumsum(weights)))
+    prefix1 = np.concatenate(([0.0], np.cumsum(weights * xs)))
+    prefix2 = np.concatenate(([0.0], np.cumsum(weights * xs * xs)))
+    prefixes = (prefix0, prefix1, prefix2)
+
+    # cost[i] - the best cost of splitting xs[0..i] into m + 1 clusters,
+    # split_points[m, i] - start of the last cluster in that solution
+    cost = _segment_costs(*prefixes, np.zeros(n, dtype=np.int64), np.arange(n))
+    split_points = np.zeros((n_clusters, n), dtype=np.int64)
+    for m in range(1, n_clusters):
+        prev_cost = cost
+        cost = np.full(n, np.inf)
+        # subproblems: rows i in [i_lo, i_hi] with the split in [j_lo, j_hi]
+        i_lo, i_hi = np.array([m]), np.array([n - 1])
+        j_lo, j_hi = np.array([m]), np.array([n - 1])
+        while i_lo.size > 0:
+            mid = (i_lo + i_hi) // 2
+            lengths = np.minimum(j_hi, mid) - j_lo + 1
+            offsets = np.cumsum(lengths) - lengths
+            task = np.repeat(np.arange(mid.size), lengths)
+            js = np.arange(task.size) - offsets[task] + j_lo[task]
+            candidates = prev_cost[js - 1] + _segment_costs(*prefixes, js, mid[task])
+            # the first (leftmost) minimum in every subproblem
+            minima = np.minimum.reduceat(candidates, offsets)
+            hits = np.flatnonzero(candidates <= minima[task])
+            hits = hits[np.r_[True, task[hits][1:] != task[hits][:-1]]]
+            best = js[hits]
+            cost[mid] = candidates[hits]
+            split_points[m, mid] = best
+
+            left = i_lo < mid
+            right = mid < i_hi
+            i_lo, i_hi = (
+                np.concatenate((i_lo[left], mid[right] + 1)),
+                np.concatenate((mid[left] - 1, i_hi[right])),
+            )
+            j_lo, j_hi = (
+                np.concatenate((j_lo[left], best[right])),
+                np.concatenate((best[left], j_hi[right])),
+            )
+
+    labels_sorted = np.empty(n, dtype=np.int64)
+    stop = n - 1
+    for m in range(n_clusters - 1, -1, -1):
+        start = split_points[m, stop] if m > 0 else 0
+        labels_sorted[start : stop + 1] = m
+        stop = start - 1
+
+    labels = labels_sorted[inverse.ravel()]
+    centers = np.bincount(labels, weights=data, minlength=n_clusters) / np.bincount(
+        labels, minlength=n_clusters
+    )
+    return labels, centers
+
+
+def count_clusters_1d(data, gap_factor=GAP_FACTOR, min_gap=0.0):
+    """
+    Function to detect the number of clusters (layers, rows) in 1D coordinates
+    from the gaps between the sorted values.
+    The gaps are split into the gaps inside clusters and the breaks between
+    them by the optimal 2-means of their logarithms (log(1 + gap), so one huge
+    gap doesn't outweigh the rest of the breaks). The split doesn't depend on
+    which kind of gaps is more numerous, e.g. layers of a few objects have more
+    breaks than gaps inside layers.
+    data - an array of n values
+    gap_factor - how many times the breaks should exceed the gaps inside
+    clusters (on average), otherwise the data is a single cluster
+    min_gap - the smallest gap (in voxels) accepted as a break, e.g. a half
+    of the object size, it separates the jitter of rounded centroids
+    in a single cluster from real breaks
+    Returns the number of clusters (at least 1 for non-empty data).
+    """
+    gaps = np.diff(np.sort(np.asarray(data, dtype=np.float64).ravel()))
+    breaks = _break_gaps(gaps, gap_factor, min_gap)
+    return int(np.count_nonzero(breaks)) + 1
+
+
+def _break_gaps(gaps, gap_factor=GAP_FACTOR, min_gap=0.0):
+    """
+    Boolean mask of the gaps between sorted values treated as cluster breaks.
+    """
+    breaks = np.zeros(gaps.shape, dtype=bool)
+    if gaps.size < 2 or not np.any(gaps > min_gap):
+        return breaks
+    groups, _ = kmeans_1d_optimal(np.log1p(gaps), 2)
+    large = groups == 1
+    if gaps[large].mean() < gap_factor * gaps[~large].mean():
+        return breaks
+    return large & (gaps > min_gap)
+
+
+def cluster_by_gaps(data, n_clusters=None, min_gap=0.0):
+    """
+    Function to cluster 1D data by splitting the sorted values
+    at the largest gaps.
+    data - an array of n values
+    n_clusters - number of clusters, if None (or 0) it is detected
+    with count_clusters_1d
+    min_gap - the smallest gap accepted as a break when detecting
+    the number of clusters (see count_clusters_1d)
+    Returns a tuple of labels (n,) and cluster centers (n_clusters,), clusters
+    being numbered in ascending order of their centers.
+    """
+    data = np.asarray(data, dtype=np.float64).ravel()
+    order = np.argsort(data, kind="stable")
+    gaps = np.diff(data[order])
+    if not n_clusters:
+        breaks = np.flatnonzero(_break_gaps(gaps, min_gap=min_gap))
+    else:
+        if not 1 <= n_clusters <= data.size:
+            raise ValueError(
+                f"Number of clusters {n_clusters} should be between 1 and {data.size}"
+            )
+        breaks = np.sort(np.argsort(gaps, kind="stable")[::-1][: n_clusters - 1])
+
+    labels_sorted = np.zeros(data.size, dtype=np.int64)
+    labels_sorted[breaks + 1] = 1
+    labels_sorted = np.cumsum(labels_sorted)
+    labels = np.empty(data.size, dtype=np.int64)
+    labels[order] = labels_sorted
+    n_found = breaks.size + 1
+    centers = np.bincount(labels, weights=data, minlength=n_found) / np.bincount(
+        labels, minlength=n_found
+    )
+    return labels, centers
+
+
+def cluster_1d(data, n_clusters, method="kmeans", min_gap=0.0):
+    """
+    Function to cluster 1D coordinates with the selected backend.
+    data - an array of n values
+    n_clusters - number of clusters, if None or 0 the number is detected
+    automatically from the gaps in the data (count_clusters_1d)
+    method - one of the CLUSTERING_METHODS keys:
+    'kmeans' - scikit-learn KMeans (default, heuristic with restarts)
+    'optimal' - exact and deterministic 1D k-means (kmeans_1d_optimal)
+    of the data rounded to OPTIMAL_RESOLUTION
+    'gaps' - splitting the sorted data at the largest gaps (cluster_by_gaps)
+    'lattice' - rows and columns are fitted as a grid (fit_lattice),
+    1D data (e.g. layers) are clustered as with 'gaps'
+    min_gap - the smallest gap accepted as a break when detecting
+    the number of clusters
+    Returns a tuple of labels (n,) and cluster centers (n_clusters,).
+    """
+    if method in ("gaps", "lattice"):
+        return cluster_by_gaps(data, n_clusters, min_gap=min_gap)
+    if not n_clusters:
+        n_clusters = count_clusters_1d(data, min_gap=min_gap)
+    if method == "kmeans":
+        if KMeans is None:
+            raise ModuleNotFoundError(
+                "The 'kmeans' clustering method requires 'scikit-learn' package, "
+                "install it or use the 'optimal' method."
+            )
+        clustered_obj = KMeans(n_clusters=n_clusters, random_state=0).fit(
+            np.asarray(data).reshape(-1, 1)
+        )
+        return clustered_obj.labels_, clustered_obj.cluster_centers_.flatten()
+    if method == "optimal":
+        return kmeans_1d_optimal(data, n_clusters, resolution=OPTIMAL_RESOLUTION)
+    raise ValueError(f"Unknown clustering method: {method}")
+
+
+def rank_clusters(labels, centers, direction=1):
+    """
+    Function to renumber cluster labels in the order of their centers.
+    labels - an array of the shape (n,) with cluster labels (0..k-1)
+    centers - an array of the shape (k,) with cluster centers
+    direction - 1 for ascending order of centers, -1 for descending
+    Returns an array of the shape (n,) with renumbered labels.
+    """
+    sorted_indx = np.argsort(centers, kind="stable")
+    if direction < 0:  # if reversed
+        sorted_indx = sorted_indx[::-1]
+    lb_mapping = np.empty(len(centers), dtype=np.int64)
+    lb_mapping[sorted_indx] = np.arange(len(centers))
+    return lb_mapping[labels]
+
+
+def cluster_zcoord(
+    cpoints,
+    num_zclusters=4,
+    sorder=sorting_order_classic,
+    debug=True,
+    method="kmeans",
+    min_gap=0.0,
+):
     height_axis = sorder["height"]
-    zdata = cpoints[:, height_axis].reshape(
-        -1, 1
-    )  # taking only z coordinates in (n, 1) shape
-    # zdata = cpoints[:, 0].reshape(-1, 1) # taking only z coordinates in (n, 1) shape
-    clustered_obj = KMeans(n_clusters=num_zclusters, random_state=0).fit(zdata)
-    z_centers = np.round(clustered_obj.cluster_centers_.flatten(), 0).astype(np.int32)
-
-    orig_labels = clustered_obj.labels_
+    zdata = cpoints[:, height_axis]  # taking only z coordinates
+    orig_labels, centers = cluster_1d(
+        zdata, num_zclusters, method=method, min_gap=min_gap
+    )
+    z_centers = np.round(centers, 0).astype(np.int32)
+
     # print(orig_labels)
     if debug:
         print("Distribution of labels: label, count (unsorted)")
-        for i in np.unique(orig_labels):
-            print(i, np.count_nonzero(orig_labels == i))
+        for i, count in enumerate(np.bincount(orig_labels)):
+            print(i, count)
 
-    # sorting zcluster centers from top to bottom and
-    sorted_indx = np.argsort(z_centers)
-    if sorder["height_direction"] < 0:  # if reversed
-        sorted_indx = sorted_indx[::-1]
-    lb_mapping = {
-        old_label: new_label for new_label, old_label in enumerate(sorted_indx)
-    }
-    labels_zsorted = np.array([lb_mapping[label] for label in orig_labels])
+    # sorting zcluster centers from top to bottom
+    labels_zsorted = rank_clusters(orig_labels, z_centers, sorder["height_direction"])
 
     if debug:
         print("Distribution of labels: label, count (sorted)")
-        for i in np.unique(labels_zsorted):
-            print(i, np.count_nonzero(labels_zsorted == i))
+        for i, count in enumerate(np.bincount(labels_zsorted)):
+            print(i, count)
 
     return labels_zsorted
 
@@ -97,94 +342,305 @@ def filter_data(level, center_points, mapped_labels, center_original_labels):
     return center_points_filtered, center_labels_filtered
 
 
-def level_sort(
+def group_indices(mapped_labels, num_groups):
+    """
+    Function to split the points into groups (e.g. levels) with a single
+    stable sort instead of a boolean scan over all points per group.
+    mapped_labels - an array of the shape (n,) with group values 0..num_groups-1
+    num_groups - number of groups
+    Returns a list of index arrays, one per group (in the original order).
+    """
+    order = np.argsort(mapped_labels, kind="stable")
+    bounds = np.searchsorted(mapped_labels[order], np.arange(num_groups + 1))
+    return [order[bounds[i] : bounds[i + 1]] for i in range(num_groups)]
+
+
+def sort_rows(
     cpoints_level,
-    enum_labels_level,
     row_clusters=3,
-    mapping_base=100,
     sorder=sorting_order_classic,
     debug=True,
+    method="kmeans",
+    min_gap=0.0,
 ):
+    """
+    Function to assign the points of one level to rows.
+    cpoints_level - an array of the shape (n, 3) of points on the level
+    row_clusters - number of rows (0 - detect automatically)
+    sorder - dictionary with sorting preferences
+    debug - if True, prints additional information for debugging purposes
+    method - clustering backend (see CLUSTERING_METHODS)
+    min_gap - the smallest gap between rows when detecting their number
+    Returns an array of the shape (n,) with row numbers in the sorting order.
+    """
     # sorting points by rows coordinate
     # axis/coordinate - by rows - y(0) in the classic array
     # differs at RAS compatiple scheme
     rows_axis = sorder["rows"]
-    ydata = cpoints_level[:, rows_axis].reshape(
-        -1, 1
-    )  # taking only y coordinates in (n, 1) shape
-    clustered_obj = KMeans(n_clusters=row_clusters, random_state=0).fit(ydata)
-    y_centers = np.round(clustered_obj.cluster_centers_.flatten(), 0).astype(np.int32)
+    ydata = cpoints_level[:, rows_axis]  # taking only y coordinates
+    orig_labels, centers = cluster_1d(
+        ydata, row_clusters, method=method, min_gap=min_gap
+    )
+    y_centers = np.round(centers, 0).astype(np.int32)
+
+    # sorting ycluster centers from top to bottom
+    labels_ysorted = rank_clusters(orig_labels, y_centers, sorder["rows_direction"])
 
-    orig_labels = clustered_obj.labels_
     if debug:
         print(f"{y_centers = }")
         print(f"{orig_labels = }")
-        print("Distribution of labels: label, count (unsorted)")
-        for i in np.unique(orig_labels):
-            print(i, np.count_nonzero(orig_labels == i))
+        print("Distribution of labels: label, count (sorted)")
+        print(f"{labels_ysorted = }")
+        print(f"count_on_rows = {np.bincount(labels_ysorted).tolist()}")
 
-    # sorting ycluster centers from top to bottom and
-    sorted_indx = np.argsort(y_centers)
-    if sorder["rows_direction"] < 0:  # if order is reversed
-        sorted_indx = sorted_indx[::-1]
-    lb_mapping = {
-        old_label: new_label for new_label, old_label in enumerate(sorted_indx)
-    }
-    labels_ysorted = np.array([lb_mapping[label] for label in orig_labels])
+    return labels_ysorted
+
+
+def row_direction(points, num_neighbours=4):
+    """
+    Function to estimate the direction of rows from the vectors
+    to the nearest neighbours (KD-tree).
+    Every point contributes the vector to its nearest neighbour lying closer
+    to the columns axis than to the rows axis (rows are assumed tilted
+    by less than 45 degrees), a missing object only makes some vectors
+    longer, not differently directed.
+    points - an array of the shape (n, 2) of (rows, columns) coordinates
+    num_neighbours - number of the nearest neighbours examined per point
+    Returns the median angle (radians) of the rows to the columns axis.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if len(points) < 2:
+        return 0.0
+    _, neighbours = cKDTree(points).query(
+        points, k=min(num_neighbours, len(points) - 1) + 1
+    )
+    vectors = points[neighbours[:, 1:]] - points[:, None, :]
+    in_row = np.abs(vectors[..., 1]) > np.abs(vectors[..., 0])
+    has_row_neighbour = in_row.any(axis=1)
+    if not has_row_neighbour.any():
+        return 0.0
+    nearest = np.argmax(in_row, axis=1)  # neighbours are sorted by distance
+    vectors = vectors[np.arange(len(points)), nearest][has_row_neighbour]
+    vectors *= np.sign(vectors[:, 1:2])  # pointing along the columns axis
+    return float(np.median(np.arctan2(vectors[:, 0], vectors[:, 1])))
 
-    labels_ysorted_unique = np.unique(labels_ysorted)
-    count_on_rows = [
-        np.count_nonzero(labels_ysorted == i) for i in np.unique(labels_ysorted_unique)
+
+def _deviations(values, labels):
+    # deviations of the values from the means of their groups (rows)
+    means = np.bincount(labels, weights=values) / np.maximum(np.bincount(labels), 1)
+    return values - means[labels]
+
+
+def _number_columns(along, spacing):
+    # column numbers of the positions along the rows: offsets from the first
+    # one in units of the spacing, shifted by the median phase of the grid
+    # (wrapped to [-0.5, 0.5))
+    steps = (along - along.min()) / spacing
+    phase = np.median((steps + 0.5) % 1.0 - 0.5)
+    return np.round(steps - phase).astype(np.int64)
+
+
+def _row_separation(across, labels):
+    # the smallest break between neighbouring rows divided by the widest row
+    # (rows are numbered in ascending order of the across coordinate)
+    num_rows = int(labels.max()) + 1
+    if num_rows < 2:
+        return 0.0
+    lows = np.full(num_rows, np.inf)
+    highs = np.full(num_rows, -np.inf)
+    np.minimum.at(lows, labels, across)
+    np.maximum.at(highs, labels, across)
+    return float((lows[1:] - highs[:-1]).min() / max((highs - lows).max(), 1.0))
+
+
+def _rotate_rows(points, angle):
+    # coordinates across and along the rows of the direction angle
+    cos, sin = np.cos(angle), np.sin(angle)
+    across = points[:, 0] * cos - points[:, 1] * sin
+    along = points[:, 0] * sin + points[:, 1] * cos
+    return across, along
+
+
+def lattice_coordinates(
+    cpoints_level, sorder=sorting_order_classic, row_clusters=0, min_gap=0.0
+):
+    """
+    Function to express the points of one level in the coordinates
+    of their rows, which may be tilted to the array axes.
+    The direction from the nearest neighbours (row_direction) is refined
+    by the least-squares slope of the points within their rows, which
+    pools whole rows instead of the jitter of neighbouring points.
+    Short bent rows can mislead the neighbours, so the refinement is started
+    from the array axes too, and the direction separating the rows more
+    clearly is kept.
+    cpoints_level - an array of the shape (n, 3) of points on the level
+    sorder - dictionary with sorting preferences
+    row_clusters - number of rows (0 - detect automatically)
+    min_gap - the smallest gap between rows when detecting their number
+    Returns a tuple of the coordinates across the rows (n,)
+    and along the rows (n,).
+    """
+    points = np.asarray(cpoints_level, dtype=np.float64)[
+        :, [sorder["rows"], sorder["columns"]]
     ]
+    if len(points) < 3:
+        return _rotate_rows(points, row_direction(points))
+    best = None
+    for angle in (row_direction(points), 0.0):
+        across, along = _rotate_rows(points, angle)
+        labels, _ = cluster_by_gaps(across, row_clusters, min_gap=min_gap)
+        d_across, d_along = _deviations(across, labels), _deviations(along, labels)
+        var_along = np.dot(d_along, d_along)
+        if var_along > 0:
+            angle += np.arctan(np.dot(d_across, d_along) / var_along)
+            across, along = _rotate_rows(points, angle)
+            labels, _ = cluster_by_gaps(across, row_clusters, min_gap=min_gap)
+        separation = _row_separation(across, labels)
+        if best is None or separation > best[0]:
+            best = (separation, across, along)
+    return best[1], best[2]
+
+
+def fit_lattice(
+    cpoints_level,
+    row_clusters=3,
+    sorder=sorting_order_classic,
+    debug=True,
+    min_gap=0.0,
+):
+    """
+    Function to assign the points of one level to rows and columns of a grid,
+    which may be slightly rotated to the array axes (tilted plates).
+    The direction of rows is estimated from the nearest neighbours
+    (lattice_coordinates), rows are split at the largest gaps across
+    the fitted direction (rows are clearly separated once the tilt
+    is removed, a single sort is enough) and columns are numbered
+    by the spacing of the objects along the rows, so missing objects leave
+    gaps in the numbers instead of shifting the neighbours into other columns.
+    cpoints_level - an array of the shape (n, 3) of points on the level
+    row_clusters - number of rows (0 - detect automatically)
+    sorder - dictionary with sorting preferences
+    debug - if True, prints additional information for debugging purposes
+    min_gap - the smallest gap between rows when detecting their number
+    Returns a tuple of row numbers (n,) and column numbers (n,) in the sorting
+    order and positions along the rows (n,), increasing in the sorting order.
+    """
+    across, along = lattice_coordinates(cpoints_level, sorder, row_clusters, min_gap)
+    orig_labels, centers = cluster_by_gaps(across, row_clusters, min_gap=min_gap)
+    rows = rank_clusters(orig_labels, centers, sorder["rows_direction"])
+    along = along * sorder["columns_direction"]
+
+    # spacing - the distance between neighbours in a row, the steps behind
+    # missing objects are its multiples, so every step is divided by its
+    # multiple of the estimate (starting from the lower quartile of steps)
+    order = np.lexsort((along, rows))
+    same_row = rows[order][1:] == rows[order][:-1]
+    steps = np.diff(along[order])[same_row]
+    steps = steps[steps > 0]
+    spacing = float(np.percentile(steps, 25)) if steps.size else 0.0
+    columns = np.zeros(along.size, dtype=np.int64)
+    if spacing > 0:
+        for _ in range(LATTICE_ITERATIONS):
+            multiples = np.maximum(np.round(steps / spacing), 1)
+            spacing = float(np.median(steps / multiples))
+        columns = _number_columns(along, spacing)
+        # refined by the slope of the positions over the column numbers
+        # within the rows, which pools all the points
+        d_columns = _deviations(columns.astype(np.float64), rows)
+        var_columns = np.dot(d_columns, d_columns)
+        if var_columns > 0:
+            spacing = np.dot(d_columns, _deviations(along, rows)) / var_columns
+            columns = _number_columns(along, spacing)
 
     if debug:
+        print(f"spacing in a row = {spacing:.1f}")
+        print(f"count_on_rows = {np.bincount(rows).tolist()}")
+        print(f"columns = {columns.tolist()}")
+    return rows, columns, along
 
-        print("Distribution of labels: label, count (sorted)")
-        print(f"{labels_ysorted = }")
-        print(f"{labels_ysorted_unique = }")
-        print(f"{count_on_rows = }")
-        # for i in np.unique(labels_ysorted):
-        #    print(i, np.count_nonzero(labels_ysorted == i))
-
-    remap_counter = mapping_base
-    remap_dic = {}
-
-    # starting to sort ascending on every row
-    # actually i and row_label are supposed to be the same
-    for i, row_label in enumerate(labels_ysorted_unique):
-        centroids_onrow, enum_labels_onrow = filter_data(
-            level=row_label,
-            center_points=cpoints_level,
-            mapped_labels=labels_ysorted,
-            center_original_labels=enum_labels_level,
+
+def level_sort(
+    cpoints_level,
+    enum_labels_level,
+    row_clusters=3,
+    mapping_base=100,
+    sorder=sorting_order_classic,
+    debug=True,
+    method="kmeans",
+):
+    """
+    Function to enumerate the points of one level row by row.
+    Returns a dictionary mapping original labels to mapping_base + 1, + 2, ...
+    (see full_remap for the vectorized version processing all levels)
+    """
+    if method == "lattice":
+        labels_ysorted, columns, xdata = fit_lattice(
+            cpoints_level, row_clusters, sorder=sorder, debug=debug
         )
-        # x coordinates (axis 1) - along the row from left to right (columns)
-        # in the classical sorting scheme
-        # differs in RAS compatible scheme
-        column_axis = sorder["columns"]
-        xdata = centroids_onrow[:, column_axis]
-        sorted_ixx = np.argsort(xdata)
-        if sorder["columns_direction"] < 0:  # if reversed
-            sorted_ixx = sorted_ixx[::-1]
-        enum_labels_onrow_sorted = enum_labels_onrow[sorted_ixx]
-
-        for i, old_label in enumerate(enum_labels_onrow_sorted):
-            remap_counter += 1
-            remap_dic[old_label] = remap_counter
-        # lb_mapping = {old_label: remap_counter+i for i, old_label
-        # in enumerate(enum_labels_onrow_sorted)}
-
-        """
-        print(f"Distribution of labels in row {row_label}:")
-        print(f"{centroids_onrow = }")
-        print(f"{enum_labels_onrow = }")
-
-        print(f"{xdata = }")
-        print(f"{sorted_ixx = }")
-        print(f"{enum_labels_onrow_sorted = }")
-        """
-
-    return remap_dic
+        order = np.lexsort((xdata, columns, labels_ysorted))
+        new_labels = mapping_base + 1 + np.arange(order.size)
+        return dict(zip(enum_labels_level[order].tolist(), new_labels.tolist()))
+    labels_ysorted = sort_rows(
+        cpoints_level, row_clusters, sorder=sorder, debug=debug, method=method
+    )
+    # x coordinates (axis 1) - along the row from left to right (columns)
+    # in the classical sorting scheme
+    # differs in RAS compatible scheme
+    xdata = cpoints_level[:, sorder["columns"]] * sorder["columns_direction"]
+    order = np.lexsort((xdata, labels_ysorted))
+    new_labels = mapping_base + 1 + np.arange(order.size)
+    return dict(zip(enum_labels_level[order].tolist(), new_labels.tolist()))
+
+
+def resolve_rows_per_level(
+    center_points,
+    levelwise_labels,
+    num_levels,
+    rows_onlevel=3,
+    sorder=sorting_order_classic,
+    min_gap=0.0,
+    method=None,
+):
+    """
+    Function to determine the number of rows on every level.
+    center_points - an array of the shape (n, 3) of label centers
+    levelwise_labels - an array of the shape (n,) with mapping of the points
+    to level value
+    num_levels - number of levels
+    rows_onlevel - a single number of rows for all levels or a list with
+    a number per level, 0 means that the number of rows is detected
+    from the gaps between row coordinates (count_clusters_1d)
+    sorder - dictionary with sorting preferences
+    min_gap - the smallest gap between rows when detecting their number
+    method - clustering backend, with 'lattice' the rows are counted
+    across the fitted (possibly tilted) rows
+    Returns a list with the number of rows on every level.
+    """
+    if np.ndim(rows_onlevel) == 0:
+        rows_onlevel = [rows_onlevel] * num_levels
+    assert (
+        len(rows_onlevel) == num_levels
+    ), "Number of row counts should be equal to number of levels."
+    if all(rows_onlevel):
+        return [int(num_rows) for num_rows in rows_onlevel]
+
+    groups = group_indices(levelwise_labels, num_levels)
+
+    def row_coordinates(level):
+        if method == "lattice":
+            return lattice_coordinates(
+                center_points[groups[level]], sorder, min_gap=min_gap
+            )[0]
+        return center_points[groups[level], sorder["rows"]]
+
+    return [
+        (
+            int(num_rows)
+            if num_rows
+            else count_clusters_1d(row_coordinates(level), min_gap=min_gap)
+        )
+        for level, num_rows in enumerate(rows_onlevel)
+    ]
 
 
 def full_remap(
@@ -195,65 +651,274 @@ def full_remap(
     rows_onlevel=3,
     sorting_scheme=sorting_order_classic,
     debug=True,
+    method="kmeans",
+    min_gap=0.0,
 ):
     """
-    Function to remap all labels in the whole list of points
-    with the mapping dictionary obtained from level_sort function
+    Function to remap all labels in the whole list of points.
+    Points are grouped by level with one stable sort, rows are clustered
+    on every level, and the final order is obtained with a single lexsort
+    over (level, row, column) keys, so the cost is linear in the number of
+    points apart from the sorts.
     level_bases - list of level bases (100, 200, 300, ...)
     center_points - an array of the shape (n, 3) of label centers
     levelwise_labels - an array of the shape (n,) with mapping of the points
     to level value
     init_enum - an array of the shape (n,) with original labels (mapped to the points)
-    rows_onlevel - number of clusters (number of rows) on each level (default = 3)
+    rows_onlevel - number of clusters (number of rows) on each level (default = 3),
+    either a single number or a list with a number per level;
+    0 means that the number of rows is detected automatically
     sorting_sheme - dictionary with sorting preferences
     debug - if True, prints additional information for debugging purposes
-    Returns a dictionary with remapped labels
+    method - clustering backend for rows (see CLUSTERING_METHODS), with 'lattice'
+    rows and columns are fitted as a (tilted) grid on every level (fit_lattice)
+    min_gap - the smallest gap between rows when detecting their number
+    Returns a tuple of parallel arrays (original labels, remapped labels)
     """
+    num_levels = len(level_bases)
+    levelwise_labels = np.asarray(levelwise_labels)
+    rows_per_level = resolve_rows_per_level(
+        center_points=center_points,
+        levelwise_labels=levelwise_labels,
+        num_levels=num_levels,
+        rows_onlevel=rows_onlevel,
+        sorder=sorting_scheme,
+        min_gap=min_gap,
+        method=method,
+    )
 
-    full_map = {}
-
-    for i, mbase in enumerate(level_bases):
-        pts_level, labels_lvl = filter_data(
-            level=i,
-            center_points=center_points,
-            mapped_labels=levelwise_labels,
-            center_original_labels=init_enum,
-        )
-        lmapper = level_sort(
-            cpoints_level=pts_level,
-            enum_labels_level=labels_lvl,
-            row_clusters=rows_onlevel,
-            mapping_base=mbase,
+    # x coordinates - along the row (columns), negated if the order is reversed
+    column_key = np.asarray(
+        center_points[:, sorting_scheme["columns"]]
+        * sorting_scheme["columns_direction"],
+        dtype=np.float64,
+    )
+    row_labels = np.zeros(levelwise_labels.size, dtype=np.int64)
+    # column numbers of the fitted grid (lattice method only)
+    column_labels = np.zeros(levelwise_labels.size, dtype=np.int64)
+    for level, level_indx in enumerate(group_indices(levelwise_labels, num_levels)):
+        if level_indx.size == 0:
+            continue
+        if method == "lattice":
+            (
+                row_labels[level_indx],
+                column_labels[level_indx],
+                column_key[level_indx],
+            ) = fit_lattice(
+                cpoints_level=center_points[level_indx],
+                row_clusters=rows_per_level[level],
+                sorder=sorting_scheme,
+                debug=debug,
+                min_gap=min_gap,
+            )
+            continue
+        row_labels[level_indx] = sort_rows(
+            cpoints_level=center_points[level_indx],
+            row_clusters=rows_per_level[level],
             sorder=sorting_scheme,
             debug=debug,
+            method=method,
         )
-        full_map = full_map | lmapper
-    return full_map
+
+    order = np.lexsort((column_key, column_labels, row_labels, levelwise_labels))
+    sorted_levels = levelwise_labels[order]
+    # position of every point within its level, counting from 1
+    rank_on_level = (
+        np.arange(order.size) - np.searchsorted(sorted_levels, sorted_levels) + 1
+    )
+    new_labels = np.asarray(level_bases, dtype=np.int64)[sorted_levels] + rank_on_level
+    return np.asarray(init_enum)[order], new_labels
 
 
-def perform_remap(remapping_dict, enum_img):
+def smallest_label_dtype(max_label, signed=False):
+    """
+    Function to pick the narrowest integer dtype able to hold label values
+    in the range [0, max_label].
+    max_label - the largest label value to be stored
+    signed - if True, only signed types are considered (e.g. int16 for Slicer)
+    Returns a numpy dtype.
+    """
+    candidates = (
+        (np.int8, np.int16, np.int32, np.int64)
+        if signed
+        else (np.uint8, np.uint16, np.uint32, np.uint64)
+    )
+    for dtype in candidates:
+        if max_label <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f"Label value {max_label} does not fit any integer type")
+
+
+def label_volume_dtype(max_label):
+    """
+    Function to pick the dtype of a label volume passed to Slicer:
+    int16 (the usual labelmap type) while the labels fit, then uint16
+    and uint32 for very large arrays of objects (small grains, pollen).
+    max_label - the largest label value to be stored
+    Returns a numpy dtype.
+    """
+    if max_label <= np.iinfo(np.int16).max:
+        return np.dtype(np.int16)
+    if max_label <= np.iinfo(np.uint16).max:
+        return np.dtype(np.uint16)
+    if max_label <= np.iinfo(np.uint32).max:
+        return np.dtype(np.uint32)
+    raise ValueError(f"Label value {max_label} does not fit a label volume")
+
+
+def remap_arrays(remapping):
+    """
+    Function to convert a label mapping to parallel arrays.
+    remapping - a dictionary with old labels as keys and new labels as values,
+    or a tuple of parallel arrays (old labels, new labels)
+    Returns a tuple of two int64 arrays (old labels, new labels).
+    """
+    if isinstance(remapping, dict):
+        keys = np.fromiter(remapping.keys(), dtype=np.int64, count=len(remapping))
+        values = np.fromiter(remapping.values(), dtype=np.int64, count=len(remapping))
+        return keys, values
+    keys, values = remapping
+    return np.asarray(keys, dtype=np.int64), np.asarray(values, dtype=np.int64)
+
+
+def build_lookup_table(remapping_dict, max_label=None, dtype=None):
+    """
+    Function to build a dense lookup table (LUT) from the remapping dictionary.
+    lut[old_label] = new_label, labels absent in the dictionary keep their value
+    (identity mapping), so the LUT reproduces the semantics of perform_remap.
+    remapping_dict - a dictionary with old labels as keys and new labels as values
+    (or a tuple of parallel arrays of old and new labels)
+    max_label - the largest label present in the image to be remapped
+    (default - the largest key in the dictionary)
+    dtype - dtype of the LUT (and the remapped image), by default the smallest
+    unsigned type that fits all output values
+    Returns the LUT as a 1D numpy array of the size max_label + 1.
+    """
+    keys, values = remap_arrays(remapping_dict)
+    max_key = int(keys.max()) if keys.size > 0 else 0
+    max_label = max_key if max_label is None else max(int(max_label), max_key)
+
+    lut = np.arange(max_label + 1, dtype=np.int64)
+    lut[keys] = values
+    if dtype is None:
+        dtype = smallest_label_dtype(int(lut.max()))
+    return lut.astype(dtype)
+
+
+def apply_lookup_table(enum_img, lut, inplace=False, out=None, slab_size=0):
+    """
+    Function to remap the label image with a dense lookup table in a single
+    vectorized gather over the voxels.
+    enum_img - the label image (numpy array of non-negative integers)
+    lut - the lookup table built with build_lookup_table, covering all labels
+    of the image
+    inplace - if True and the dtypes of the image and LUT are the same,
+    the result is written into enum_img without allocating a new volume
+    out - output array of the dtype of the LUT (e.g. np.lib.format.open_memmap),
+    created if None
+    slab_size - if > 0, the image is remapped in slabs of that many planes
+    along the first axis, so memory-mapped images are never loaded whole
+    Returns the remapped label image with the dtype of the LUT.
+    """
+    if out is None:
+        if inplace and enum_img.dtype == lut.dtype and enum_img.flags.writeable:
+            out = enum_img
+        else:
+            out = np.empty(enum_img.shape, dtype=lut.dtype)
+    # 'clip' mode doesn't buffer the output, so the gather works in place
+    if slab_size > 0:
+        for start in range(0, enum_img.shape[0], slab_size):
+            stop = start + slab_size
+            np.take(lut, enum_img[start:stop], out=out[start:stop], mode="clip")
+    else:
+        np.take(lut, enum_img, out=out, mode="clip")
+    return out
+
+
+def perform_remap(
+    remapping_dict, enum_img, dtype=None, inplace=False, out=None, slab_size=0
+):
     """
     Function to remap the labels in the label image using the provided remapping
-    dictionary.
+    dictionary. All labels are remapped simultaneously in one pass
+    through a lookup table.
     remapping_dict - a dictionary with old labels as keys and new labels as values
-    enum_img - the label image to be remapped (numpy array) - passed by value(copy)
+    (or a tuple of parallel arrays of old and new labels)
+    enum_img - the label image to be remapped (numpy array)
+    dtype - dtype of the output image, by default the smallest unsigned type
+    that fits all labels
+    inplace - if True, the image is overwritten when the output dtype allows it
+    out, slab_size - see apply_lookup_table
     Returns the remapped label image.
     """
-    for key in remapping_dict.keys():
-        enum_img = np.where(enum_img == key, remapping_dict[key], enum_img)
-    return enum_img
+    # nothing to remap, only the dtype is changed (the output array
+    # is filled through the identity LUT below)
+    if out is None and len(remap_arrays(remapping_dict)[0]) == 0:
+        return enum_img if dtype is None else enum_img.astype(dtype, copy=False)
+    lut = build_lookup_table(remapping_dict, max_label=int(enum_img.max()), dtype=dtype)
+    return apply_lookup_table(
+        enum_img, lut, inplace=inplace, out=out, slab_size=slab_size
+    )
 
 
-def make_consequtive_labels(enum_img, sparse_labels):
+def make_consequtive_labels(enum_img, sparse_labels, dtype=None, inplace=False):
     """
     Function to make the labels in the label image consecutive.
-    enum_img - the label image to be remapped (numpy array) - passed by value(copy)
+    enum_img - the label image to be remapped (numpy array)
     sparse_labels - a list of labels to be remapped into consecutive labels
+    dtype - dtype of the output image, by default the smallest unsigned type
+    that fits all labels
+    inplace - if True, the image is overwritten when the output dtype allows it
     Returns the remapped label image.
     """
-    for i, labelValue in enumerate(sparse_labels):
-        enum_img = np.where(enum_img == labelValue, i + 1, enum_img)
-    return enum_img
+    remapping_dict = {labelValue: i + 1 for i, labelValue in enumerate(sparse_labels)}
+    return perform_remap(remapping_dict, enum_img, dtype=dtype, inplace=inplace)
+
+
+def compose_remaps(first_dict, second_dict):
+    """
+    Function to compose two label mappings into one, so that applying the result
+    is equivalent to applying first_dict and then second_dict to the image.
+    first_dict - a dictionary with old labels as keys and intermediate labels
+    as values
+    second_dict - a dictionary with intermediate labels as keys and new labels
+    as values (intermediate labels absent in it are kept unchanged)
+    Returns a dictionary mapping old labels directly to new labels.
+    """
+    composed = {
+        old_label: second_dict.get(mid_label, mid_label)
+        for old_label, mid_label in first_dict.items()
+    }
+    # labels untouched by the first mapping may still be caught by the second one
+    for mid_label, new_label in second_dict.items():
+        if mid_label not in first_dict:
+            composed.setdefault(mid_label, new_label)
+    return composed
+
+
+def consecutive_remap(remapping_dict):
+    """
+    Function to fuse the positional (level-wise sparse, e.g. 101, 102, 201...)
+    mapping with the subsequent conversion to consecutive labels,
+    so the label image has to be remapped only once.
+    remapping_dict - a dictionary with original labels as keys and
+    sparse level-wise labels as values, or a tuple of parallel arrays
+    (original labels, sparse labels) as returned by full_remap
+    Returns a tuple of:
+    - a mapping of original labels straight to consecutive labels (1, 2, ...),
+    of the same kind as remapping_dict (dictionary or tuple of arrays)
+    - a sorted list of sparse labels, where the sparse label of the consecutive
+    label i is found at position i - 1 (side table for naming segments)
+    """
+    if not isinstance(remapping_dict, dict):
+        old_labels, new_labels = remap_arrays(remapping_dict)
+        sparse_labels = np.unique(new_labels)
+        consecutive = np.searchsorted(sparse_labels, new_labels) + 1
+        return (old_labels, consecutive), sparse_labels.tolist()
+
+    sparse_labels = sorted(set(remapping_dict.values()))
+    to_consecutive = {labelValue: i + 1 for i, labelValue in enumerate(sparse_labels)}
+    return compose_remaps(remapping_dict, to_consecutive), sparse_labels
 
 
 def expand_object_dims(obj_list, span, ymax0, xmax1, zmax2):
@@ -343,14 +1008,23 @@ def break_cubicles(slices_list, image):
     return obcubes, shapes
 
 
-def draw_axes(vol_image, offset=3, line_width=1):
+def _clipped_box(shape, ranges):
+    # slices of the (start, stop) ranges clipped to the shape
+    return tuple(
+        slice(min(max(start, 0), size), min(max(stop, 0), size))
+        for (start, stop), size in zip(ranges, shape)
+    )
+
+
+def axes_boxes(shape, offset=3, line_width=1):
     """
-    Function to draw axes in a 3D volume image
-    vol_image - a 3D numpy array representing the volume image (helper object)
+    Function to compute the boxes of the axes of draw_axes
+    shape - shape of the 3D volume image (helper object)
     offset - the offset from the edges where the axes will be drawn (default=3)
     line_width - the width of the axes lines (default=1)
+    Returns a list of tuples (label, slices) in the drawing order.
     """
-    max0, max1, max2 = vol_image.shape
+    max0, max1, max2 = shape
     # draw_values = [1,2,3]
     # drawing axes, 0 axis is the longest, the 1 axis is half, the 2 is third")
     # vol_image[:, offset:offset+line_width, offset:offset+line_width] = 1
@@ -359,39 +1033,55 @@ def draw_axes(vol_image, offset=3, line_width=1):
 
     # drawing axes, height z axis2 is the longest, the rows y axis0 is half,
     # the x axis1 is the shortest"
-    vol_image[offset : offset + line_width, offset : offset + line_width, :] = 3
-    vol_image[
-        : max0 // 2, offset : offset + line_width, offset : offset + line_width
-    ] = 1
-    vol_image[
-        offset : offset + line_width, : max1 // 3, offset : offset + line_width
-    ] = 2
-    return vol_image
+    line = (offset, offset + line_width)
+    return [
+        (3, _clipped_box(shape, (line, line, (0, max2)))),
+        (1, _clipped_box(shape, ((0, max0 // 2), line, line))),
+        (2, _clipped_box(shape, (line, (0, max1 // 3), line))),
+    ]
 
 
-def draw_axes_ras(vol_image, offset=3, line_width=1):
+def axes_boxes_ras(shape, offset=3, line_width=1):
     """
-    Function to draw axes in a 3D volume image adapted to RAS orientation
-    vol_image - a 3D numpy array representing the volume image (helper object)
+    Function to compute the boxes of the axes of draw_axes_ras
+    shape - shape of the 3D volume image (helper object)
     offset - the offset from the edges where the axes will be drawn (default=3)
     line_width - the width of the axes lines (default=1)
+    Returns a list of tuples (label, slices) in the drawing order.
     """
-    max0, max1, max2 = vol_image.shape
+    max0, max1, max2 = shape
     # drawing axes,  y axis0 is the longest (the height) and reversed,
     # the rows x axis1 is half and reversed,
     # the z axis2 (columns) is the shortest"
-    vol_image[
-        :, max1 - offset - line_width : max1 - offset, offset : offset + line_width
-    ] = 3
-    vol_image[
-        max0 - offset - line_width : max0 - offset,  # offset : offset + line_width,
-        max1 // 2 :,
-        offset : offset + line_width,
-    ] = 1
-    vol_image[
-        max0 - offset - line_width : max0 - offset,  # offset : offset + line_width,
-        max1 - offset - line_width : max1 - offset,
-        : max2 // 3,
-    ] = 2
+    line = (offset, offset + line_width)
+    end_line0 = (max0 - offset - line_width, max0 - offset)
+    end_line1 = (max1 - offset - line_width, max1 - offset)
+    return [
+        (3, _clipped_box(shape, ((0, max0), end_line1, line))),
+        (1, _clipped_box(shape, (end_line0, (max1 // 2, max1), line))),
+        (2, _clipped_box(shape, (end_line0, end_line1, (0, max2 // 3)))),
+    ]
 
+
+def draw_axes(vol_image, offset=3, line_width=1):
+    """
+    Function to draw axes in a 3D volume image
+    vol_image - a 3D numpy array representing the volume image (helper object)
+    offset - the offset from the edges where the axes will be drawn (default=3)
+    line_width - the width of the axes lines (default=1)
+    """
+    for label, box in axes_boxes(vol_image.shape, offset, line_width):
+        vol_image[box] = label
+    return vol_image
+
+
+def draw_axes_ras(vol_image, offset=3, line_width=1):
+    """
+    Function to draw axes in a 3D volume image adapted to RAS orientation
+    vol_image - a 3D numpy array representing the volume image (helper object)
+    offset - the offset from the edges where the axes will be drawn (default=3)
+    line_width - the width of the axes lines (default=1)
+    """
+    for label, box in axes_boxes_ras(vol_image.shape, offset, line_width):
+        vol_image[box] = label
     return vol_image
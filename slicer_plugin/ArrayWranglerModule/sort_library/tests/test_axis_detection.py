@@ -0,0 +1,64 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from .. import axis_detection as saxes
+from .. import sorting_logic as slogic
+
+# pylint: skip-file
+
+
+def tray_stack(rng, levels=3, rows=6, columns=10):
+    # centroids (height, rows, columns) of a stack of trays, lower than wide
+    grid = np.stack(
+        np.meshgrid(
+            30.0 * np.arange(levels),
+            25.0 * np.arange(rows),
+            15.0 * np.arange(columns),
+            indexing="ij",
+        ),
+        axis=-1,
+    ).reshape(-1, 3)
+    # objects in a row share the row coordinate, their positions along the row
+    # vary more
+    return grid + rng.normal(0, [1.0, 1.0, 3.0], grid.shape) + 100
+
+
+@pytest.mark.parametrize("axes", list(itertools.permutations(range(3))))
+def test_detect_sorting_order(axes):
+    rng = np.random.default_rng(sum(axes))
+    # move height, rows and columns to the given array axes
+    centroids = np.zeros((3 * 6 * 10, 3))
+    centroids[:, list(axes)] = tray_stack(rng)
+    sorder = saxes.detect_sorting_order(centroids)
+    assert (sorder["height"], sorder["rows"], sorder["columns"]) == axes
+    for key in ("height_direction", "rows_direction", "columns_direction"):
+        assert sorder[key] == slogic.sorting_order_classic[key]
+
+
+def test_remap_sorting_order_moves_rotations():
+    template = slogic.sorting_order_classic
+    sorder = saxes.remap_sorting_order(template, 0, 1, 2)
+    new_axes = {template["height"]: 0, template["rows"]: 1, template["columns"]: 2}
+    for key, value in template.items():
+        if key.startswith("rotation_"):
+            assert sorder[key] == tuple(new_axes[axis] for axis in value)
+
+
+def test_detect_sorting_order_keeps_template_for_few_objects():
+    template = slogic.sorting_order_classic
+    assert saxes.detect_sorting_order(np.zeros((3, 3))) is template
+
+
+@pytest.mark.parametrize(
+    "template", [slogic.sorting_order_classic, slogic.sorting_order_ras]
+)
+def test_detect_sorting_order_keeps_template_axes_if_ambiguous(template):
+    # a cube of objects spaced alike along all axes
+    rng = np.random.default_rng(0)
+    grid = np.stack(np.meshgrid(*[20.0 * np.arange(5)] * 3, indexing="ij"), axis=-1)
+    centroids = grid.reshape(-1, 3) + rng.normal(0, 0.1, (125, 3))
+    sorder = saxes.detect_sorting_order(centroids, template)
+    for key in ("height", "rows", "columns"):
+        assert sorder[key] == template[key]
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from scipy import ndimage as ndi
+
+from ..chunked_label import label_slabs
+
+# pylint: skip-file
+
+STRUCTURES = {
+    "faces": ndi.generate_binary_structure(3, 1),
+    "edges": ndi.generate_binary_structure(3, 2),
+    "corners": ndi.generate_binary_structure(3, 3),
+}
+
+
+@pytest.fixture(scope="module")
+def mask():
+    rng = np.random.default_rng(0)
+    return ndi.binary_opening(rng.random((33, 28, 30)) > 0.55).astype(np.uint8)
+
+
+@pytest.mark.parametrize("slab_size", [1, 2, 5, 16, 64])
+@pytest.mark.parametrize("structure", STRUCTURES)
+def test_label_slabs_matches_ndi_label(mask, slab_size, structure):
+    expected, expected_num = ndi.label(mask > 0, structure=STRUCTURES[structure])
+    labels, num_objects = label_slabs(
+        mask, slab_size=slab_size, structure=STRUCTURES[structure]
+    )
+    assert num_objects == expected_num
+    np.testing.assert_array_equal(labels, expected)
+
+
+@pytest.mark.parametrize("workers", [1, 4])
+def test_label_slabs_into_memmap(mask, tmp_path, workers):
+    expected, expected_num = ndi.label(mask > 0)
+    out = np.lib.format.open_memmap(
+        tmp_path / "labels.npy", mode="w+", dtype=np.int32, shape=mask.shape
+    )
+    labels, num_objects = label_slabs(mask, slab_size=4, out=out, workers=workers)
+    assert labels is out
+    assert num_objects == expected_num
+    np.testing.assert_array_equal(labels, expected)
+
+
+def test_label_slabs_empty_mask():
+    labels, num_objects = label_slabs(np.zeros((8, 5, 5), dtype=bool), slab_size=3)
+    assert num_objects == 0
+    assert not labels.any()
+
+
+@pytest.mark.parametrize("slab_size", [1, 4])
+def test_label_slabs_into_narrow_dtype(mask, slab_size):
+    expected, expected_num = ndi.label(mask > 0)
+    labels, num_objects = label_slabs(mask, slab_size=slab_size, dtype=np.uint16)
+    assert labels.dtype == np.uint16
+    assert num_objects == expected_num
+    np.testing.assert_array_equal(labels, expected)
+
+
+def test_label_slabs_overflow():
+    # 300 single-voxel objects, each slab holds less than uint8 does
+    mask = np.zeros((10, 10, 60), dtype=bool)
+    mask[::2, ::2, ::2] = True
+    with pytest.raises(RuntimeError):
+        label_slabs(mask, slab_size=2, dtype=np.uint8)
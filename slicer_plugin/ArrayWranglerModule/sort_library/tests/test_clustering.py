@@ -0,0 +1,91 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from .. import sorting_logic as slogic
+
+# pylint: skip-file
+
+
+def clustering_cost(data, labels):
+    return sum(
+        ((data[labels == label] - data[labels == label].mean()) ** 2).sum()
+        for label in np.unique(labels)
+    )
+
+
+def brute_force_cost(data, n_clusters):
+    # optimal 1D clusters are contiguous in the sorted data,
+    # so it is enough to try every set of split points
+    values = np.sort(data)
+    best = np.inf
+    for splits in itertools.combinations(range(1, values.size), n_clusters - 1):
+        parts = np.split(values, splits)
+        best = min(best, sum(((part - part.mean()) ** 2).sum() for part in parts))
+    return best
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_kmeans_1d_optimal_matches_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    size = rng.integers(2, 11)
+    data = rng.integers(0, 30, size=size).astype(np.float64)
+    for n_clusters in range(1, size + 1):
+        labels, centers = slogic.kmeans_1d_optimal(data, n_clusters)
+        assert np.bincount(labels, minlength=n_clusters).min() > 0
+        assert np.all(np.diff(centers) >= 0)
+        np.testing.assert_allclose(
+            clustering_cost(data, labels),
+            brute_force_cost(data, n_clusters),
+            atol=1e-9,
+        )
+
+
+def test_kmeans_1d_optimal_splits_repeated_values():
+    data = np.array([5.0, 5.0, 5.0, 9.0])
+    labels, centers = slogic.kmeans_1d_optimal(data, 3)
+    assert len(np.unique(labels)) == 3
+    assert clustering_cost(data, labels) == 0
+
+
+def test_kmeans_1d_optimal_with_resolution():
+    rng = np.random.default_rng(0)
+    data = np.repeat(20.0 * np.arange(30), 200) + rng.normal(0, 2, 6000)
+    expected, expected_centers = slogic.kmeans_1d_optimal(data, 30)
+    labels, centers = slogic.kmeans_1d_optimal(data, 30, resolution=0.1)
+    np.testing.assert_array_equal(labels, expected)
+    np.testing.assert_allclose(centers, expected_centers)
+    # values rounded to the same step share the cluster
+    labels, _ = slogic.kmeans_1d_optimal([0.0, 0.9, 1.1, 2.0], 2, resolution=1.0)
+    assert labels[1] == labels[2]
+
+
+def test_kmeans_1d_optimal_rejects_too_many_clusters():
+    with pytest.raises(ValueError):
+        slogic.kmeans_1d_optimal([1.0, 2.0], 3)
+
+
+def test_count_clusters_1d():
+    data = np.r_[np.arange(10), np.arange(40, 45), np.arange(90, 100)]
+    assert slogic.count_clusters_1d(data) == 3
+    assert slogic.count_clusters_1d(np.arange(10)) == 1
+
+
+def test_count_clusters_1d_with_more_breaks_than_gaps_inside():
+    # layers of one or two objects, most of the gaps are breaks
+    data = np.array([0.0, 0.6, 30.0, 61.0, 61.4, 90.0, 121.0])
+    assert slogic.count_clusters_1d(data) == 5
+    assert slogic.count_clusters_1d(data, min_gap=40) == 1
+    # rounded jitter inside rows is not taken for breaks
+    rows = np.repeat([10.0, 35.0, 60.0], 8) + np.tile([0, 1, 0, 2, 1, 0, 1, 3], 3)
+    assert slogic.count_clusters_1d(rows, min_gap=5) == 3
+
+
+def test_cluster_by_gaps():
+    data = np.array([41.0, 2.0, 90.0, 0.0, 44.0, 93.0, 1.0])
+    labels, centers = slogic.cluster_by_gaps(data)
+    np.testing.assert_array_equal(labels, [1, 0, 2, 0, 1, 2, 0])
+    np.testing.assert_allclose(centers, [1.0, 42.5, 91.5])
+    labels, _ = slogic.cluster_by_gaps(data, n_clusters=2)
+    np.testing.assert_array_equal(labels, [0, 0, 1, 0, 0, 1, 0])
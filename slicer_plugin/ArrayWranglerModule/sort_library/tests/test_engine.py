@@ -0,0 +1,127 @@
+import os
+
+import numpy as np
+import pytest
+from scipy import ndimage as ndi
+
+from .. import engine as sengine
+from .. import sorting_logic as slogic
+from ..axis_detection import remap_sorting_order
+from ..object_table import object_table
+
+# pylint: skip-file
+
+SAMPLE_MASK = os.path.join(
+    os.path.dirname(__file__), *[os.pardir] * 4, "sample_data", "maize_mask.nii.gz"
+)
+
+
+def seed_mask(levels=3, rows=3, columns=5, shape=(80, 100, 70)):
+    # a stack of trays of box-shaped seeds in the classic sorting order
+    mask = np.zeros(shape, dtype=np.uint8)
+    for level in range(levels):
+        for row in range(rows):
+            for column in range(columns):
+                y, x, z = 8 + 22 * row, 6 + 18 * column, 5 + 22 * level
+                mask[y : y + 10 + column % 3, x : x + 9, z : z + 8 + row % 2] = 1
+    return mask
+
+
+@pytest.mark.parametrize("slab_size", [1, 6, 32])
+def test_object_table_in_slabs(slab_size):
+    rng = np.random.default_rng(0)
+    labels, _ = ndi.label(ndi.binary_opening(rng.random((30, 20, 25)) > 0.6))
+    intensity = rng.random(labels.shape)
+    expected = object_table(labels, intensity)
+    result = object_table(labels, intensity, slab_size=slab_size)
+    for name in ("labels", "counts", "centroids", "bbox_start", "bbox_stop"):
+        np.testing.assert_array_equal(getattr(result, name), getattr(expected, name))
+    np.testing.assert_allclose(result.intensity_sums, expected.intensity_sums)
+
+
+def test_object_table_matches_ndi():
+    labels, num = ndi.label(seed_mask())
+    table = object_table(labels)
+    index = np.arange(1, num + 1)
+    np.testing.assert_array_equal(table.labels, index)
+    np.testing.assert_allclose(
+        table.centroids, ndi.center_of_mass(labels, labels, index)
+    )
+    assert table.slices() == ndi.find_objects(labels)
+
+
+def test_engine_enumerates_trays():
+    enum_img, result = sengine.SortingEngine(num_layers=0, num_rows=0).run(seed_mask())
+    assert result.num_layers == 3
+    assert result.rows_per_level == [3, 3, 3]
+    assert result.sparse_labels[:6] == [101, 102, 103, 104, 105, 106]
+    # the first object of the second row on the first layer
+    assert enum_img[8 + 22, 6, 5] == 6
+
+
+@pytest.mark.parametrize("method", ["optimal", "kmeans", "gaps", "lattice"])
+def test_engine_detects_sample_layout(method):
+    pytest.importorskip("nibabel")
+    if method == "kmeans":
+        pytest.importorskip("sklearn")
+    from ..batch import load_volume
+
+    mask, _ = load_volume(SAMPLE_MASK)
+    # the seeds of the sample lie in 4 layers along the first (K) axis
+    # of the KJI array, with 3 rows along the third (I) one
+    sorder = remap_sorting_order(slogic.sorting_order_ras, 0, 2, 1)
+    engine = sengine.SortingEngine(
+        num_layers=0, num_rows=0, sorting_order=sorder, clustering_method=method
+    )
+    _, result = engine.run(mask)
+    assert result.num_layers == 4
+    assert result.rows_per_level == [3, 3, 3, 3]
+    assert result.num_objects == 50
+
+
+@pytest.mark.parametrize(
+    "template", [slogic.sorting_order_classic, slogic.sorting_order_ras]
+)
+def test_engine_detects_sample_axes(template):
+    pytest.importorskip("nibabel")
+    from ..batch import load_volume
+
+    mask, _ = load_volume(SAMPLE_MASK)
+    engine = sengine.SortingEngine(
+        num_layers=0, num_rows=0, sorting_order=template, detect_axes=True
+    )
+    _, result = engine.run(mask)
+    assert (result.sorting_order["height"], result.sorting_order["rows"]) == (0, 2)
+    assert result.rows_per_level == [3, 3, 3, 3]
+
+
+def test_engine_out_of_core_matches_in_memory(tmp_path):
+    mask = seed_mask()
+    expected, expected_result = sengine.SortingEngine().run(mask)
+    engine = sengine.SortingEngine(slab_size=7, scratch_dir=str(tmp_path))
+    enum_img, result = engine.run(mask)
+    assert isinstance(enum_img, np.memmap)
+    assert enum_img.dtype == expected.dtype
+    np.testing.assert_array_equal(enum_img, expected)
+    assert result.sparse_labels == expected_result.sparse_labels
+    np.testing.assert_array_equal(result.objects.counts, expected_result.objects.counts)
+    del enum_img
+
+
+@pytest.mark.parametrize("slab_size", [0, 9])
+def test_engine_compact_labels(slab_size):
+    mask = seed_mask()
+    expected, expected_num = ndi.label(mask)
+    engine = sengine.SortingEngine(slab_size=slab_size, compact=True)
+    labels, table = engine.label(mask)
+    assert labels.dtype == np.uint16
+    assert table.num_objects == expected_num
+    np.testing.assert_array_equal(labels, expected)
+
+
+def test_engine_compact_labels_fall_back_to_int32():
+    mask = np.zeros((80, 80, 90), dtype=np.uint8)
+    mask[::2, ::2, ::2] = 1
+    labels, table = sengine.SortingEngine(compact=True).label(mask)
+    assert labels.dtype == np.int32
+    assert table.num_objects == 40 * 40 * 45
@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from scipy import ndimage as ndi
+
+from .. import mask_pipeline as smaskpipeline
+from .. import morphology as smorphology
+
+# pylint: skip-file
+
+skimage_morphology = pytest.importorskip("skimage.morphology")
+# newer scikit-image deprecates the reference functions, not their results
+pytestmark = pytest.mark.filterwarnings("ignore::FutureWarning")
+
+
+@pytest.fixture(scope="module")
+def mask():
+    rng = np.random.default_rng(1)
+    blobs = ndi.gaussian_filter(rng.random((40, 24, 26)), 2)
+    return blobs > np.percentile(blobs, 60)
+
+
+@pytest.mark.parametrize("block_size", [1, 3, 8, 64])
+@pytest.mark.parametrize("workers", [1, 3])
+def test_binary_erosion_matches_skimage(mask, block_size, workers):
+    footprint = ndi.generate_binary_structure(3, 1)
+    expected = skimage_morphology.binary_erosion(mask, footprint)
+    result = smorphology.binary_erosion(
+        mask, structure=footprint, block_size=block_size, workers=workers
+    )
+    np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize("iterations", [1, 2, 3])
+@pytest.mark.parametrize("connectivity", [1, 3])
+def test_binary_erosion_iterations_match_ndi(mask, iterations, connectivity):
+    structure = ndi.generate_binary_structure(3, connectivity)
+    expected = ndi.binary_erosion(
+        mask, structure=structure, iterations=iterations, border_value=1
+    )
+    result = smorphology.binary_erosion(
+        mask, structure=structure, iterations=iterations, block_size=4, workers=2
+    )
+    np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize("iterations", [0, -1])
+def test_binary_erosion_rejects_no_iterations(mask, iterations):
+    with pytest.raises(ValueError):
+        smorphology.binary_erosion(mask, iterations=iterations)
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_remove_small_step_matches_skimage(mask, workers):
+    expected = skimage_morphology.remove_small_objects(mask, 50)
+    result = smaskpipeline.run_pipeline(
+        mask, [("remove_small", {"min_size": 50})], workers=workers
+    )
+    np.testing.assert_array_equal(result, expected)
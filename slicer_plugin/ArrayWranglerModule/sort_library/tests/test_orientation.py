@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from .. import orientation as sorientation
+
+# pylint: skip-file
+
+NUMPY_OPERATIONS = {
+    "flip": np.flip,
+    "swapaxes": np.swapaxes,
+    "rot90": np.rot90,
+}
+
+
+def random_operations(rng, count):
+    operations = []
+    for _ in range(count):
+        name = rng.choice(sorientation.AXIS_OPERATIONS)
+        axes = [int(axis) for axis in rng.permutation(3)[:2]]
+        if name == "flip":
+            operations.append((name, (axes[0],), {}))
+        elif name == "swapaxes":
+            operations.append((name, tuple(axes), {}))
+        else:
+            operations.append((name, (int(rng.integers(-3, 5)),), {"axes": axes}))
+    return operations
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_simplify_matches_numpy(seed):
+    rng = np.random.default_rng(seed)
+    array = np.arange(2 * 3 * 4).reshape(2, 3, 4)
+    operations = random_operations(rng, int(rng.integers(1, 8)))
+    expected = array
+    for name, args, kwargs in operations:
+        expected = NUMPY_OPERATIONS[name](expected, *args, **kwargs)
+
+    orientation = sorientation.simplify(operations)
+    np.testing.assert_array_equal(orientation.view(array), expected)
+    assert orientation.aligned_shape(array.shape) == expected.shape
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_points_and_index_matrix_follow_the_view(seed):
+    rng = np.random.default_rng(seed)
+    shape = (3, 4, 5)
+    array = np.arange(np.prod(shape)).reshape(shape)
+    orientation = sorientation.simplify(random_operations(rng, 5))
+    view = orientation.view(array)
+
+    points = np.argwhere(array >= 0)
+    aligned = orientation.map_points(points, shape)
+    np.testing.assert_array_equal(view[tuple(aligned.T)], array[tuple(points.T)])
+
+    homogeneous = np.c_[points, np.ones(len(points))]
+    mapped = homogeneous @ orientation.index_matrix(shape).T
+    np.testing.assert_array_equal(mapped[:, :3], aligned)
+
+
+def test_simplify_composes_with_existing_orientation():
+    array = np.arange(24).reshape(2, 3, 4)
+    first = sorientation.simplify([("rot90", (1,), {"axes": (0, 2)})])
+    second = sorientation.simplify([("flip", (1,), {})], orientation=first)
+    np.testing.assert_array_equal(
+        second.view(array), np.flip(np.rot90(array, 1, axes=(0, 2)), 1)
+    )
+    assert first == sorientation.simplify([("rot90", (1,), {"axes": (0, 2)})])
+    assert sorientation.simplify([("rot90", (4,), {})]).is_identity
+
+
+def test_simplify_rejects_unknown_operations():
+    with pytest.raises(ValueError):
+        sorientation.simplify([("roll", (1,), {})])
@@ -0,0 +1,87 @@
+import numpy as np
+import pytest
+
+from .. import sorting_logic as slogic
+
+# pylint: skip-file
+
+
+def where_remap(remapping_dict, enum_img):
+    # the original implementation: one np.where pass per label
+    for key in remapping_dict.keys():
+        enum_img = np.where(enum_img == key, remapping_dict[key], enum_img)
+    return enum_img
+
+
+@pytest.fixture
+def label_image():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 60, size=(20, 16, 12)).astype(np.int32)
+
+
+def shuffled_remap(labels, base=100, seed=1):
+    rng = np.random.default_rng(seed)
+    new_labels = base + 1 + rng.permutation(len(labels))
+    return dict(zip(labels.tolist(), new_labels.tolist()))
+
+
+def test_lookup_table_matches_where_loop(label_image):
+    labels = np.unique(label_image[label_image > 0])
+    remapping = shuffled_remap(labels)
+    expected = where_remap(remapping, label_image)
+    lut = slogic.build_lookup_table(remapping, max_label=int(label_image.max()))
+    result = slogic.apply_lookup_table(label_image, lut)
+    np.testing.assert_array_equal(result, expected)
+    assert result.dtype == np.uint8
+
+
+def test_lookup_table_keeps_unmapped_labels(label_image):
+    # labels absent in the dictionary keep their value
+    labels = np.unique(label_image[label_image > 0])[::2]
+    remapping = shuffled_remap(labels, base=1000)
+    expected = where_remap(remapping, label_image)
+    result = slogic.perform_remap(remapping, label_image)
+    np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize("slab_size", [1, 3, 7, 64])
+def test_perform_remap_in_slabs(label_image, slab_size):
+    labels = np.unique(label_image[label_image > 0])
+    remapping = shuffled_remap(labels)
+    expected = where_remap(remapping, label_image)
+    out = np.zeros(label_image.shape, dtype=np.int16)
+    result = slogic.perform_remap(
+        remapping, label_image, dtype=np.int16, out=out, slab_size=slab_size
+    )
+    assert result is out
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_perform_remap_inplace(label_image):
+    labels = np.unique(label_image[label_image > 0])
+    remapping = shuffled_remap(labels)
+    expected = where_remap(remapping, label_image)
+    image = label_image.copy()
+    result = slogic.perform_remap(remapping, image, dtype=np.int32, inplace=True)
+    assert result is image
+    np.testing.assert_array_equal(result, expected)
+
+
+@pytest.mark.parametrize("dtype", [None, np.int32, np.uint16])
+def test_perform_remap_empty_mapping(label_image, dtype):
+    result = slogic.perform_remap({}, label_image, dtype=dtype)
+    assert result.dtype == (label_image.dtype if dtype is None else dtype)
+    np.testing.assert_array_equal(result, label_image)
+    out = np.zeros(label_image.shape, dtype=np.uint16)
+    assert slogic.perform_remap({}, label_image, dtype=np.uint16, out=out) is out
+    np.testing.assert_array_equal(out, label_image)
+
+
+def test_make_consequtive_labels(label_image):
+    sparse_labels = [101, 205, 7, 59]
+    image = np.where(label_image < 4, np.take(sparse_labels, label_image % 4), 0)
+    expected = image.copy()
+    for i, label in enumerate(sparse_labels):
+        expected = np.where(image == label, i + 1, expected)
+    result = slogic.make_consequtive_labels(image, sparse_labels)
+    np.testing.assert_array_equal(result, expected)
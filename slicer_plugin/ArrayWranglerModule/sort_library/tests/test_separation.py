@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from scipy import ndimage as ndi
+
+from .. import separation as sseparation
+from ..object_table import object_table
+
+# pylint: skip-file
+
+pytest.importorskip("skimage")
+
+
+def ball(shape, center, radius):
+    grid = np.indices(shape).reshape(3, -1).T
+    inside = np.sum((grid - center) ** 2, axis=1) <= radius**2
+    return inside.reshape(shape)
+
+
+@pytest.fixture(scope="module")
+def label_img():
+    # three single balls and two touching balls
+    shape = (40, 60, 30)
+    mask = np.zeros(shape, dtype=bool)
+    for center in [
+        (10, 10, 15),
+        (30, 10, 15),
+        (10, 30, 15),
+        (28, 38, 15),
+        (28, 47, 15),
+    ]:
+        mask |= ball(shape, center, 6)
+    labels, _ = ndi.label(mask)
+    return labels
+
+
+def test_find_merged(label_img):
+    table = object_table(label_img)
+    rows = sseparation.find_merged(table)
+    np.testing.assert_array_equal(table.labels[rows], [label_img[28, 38, 15]])
+
+
+def test_separate_objects(label_img):
+    table = object_table(label_img)
+    merged = label_img[28, 38, 15]
+    result, num_split, num_pieces = sseparation.separate_objects(label_img, table)
+    assert (num_split, num_pieces) == (1, 2)
+    # the other objects keep their labels and voxels
+    untouched = (label_img > 0) & (label_img != merged)
+    np.testing.assert_array_equal(result[untouched], label_img[untouched])
+    assert not np.any(result == merged)
+    first, second = result[28, 38, 15], result[28, 47, 15]
+    assert first != second
+    assert {int(first), int(second)} == {table.max_label + 1, table.max_label + 2}
+    # the pieces keep every voxel of the merged object
+    np.testing.assert_array_equal(result > 0, label_img > 0)
+
+
+def test_pieces_mask_keeps_pieces_apart(label_img):
+    table = object_table(label_img)
+    result, _, num_pieces = sseparation.separate_objects(label_img, table)
+    mask = sseparation.pieces_mask(result, table.max_label + 1)
+    assert ndi.label(mask)[1] == table.num_objects - 1 + num_pieces
+    # only voxels of the pieces are cleared
+    np.testing.assert_array_equal(
+        mask[result <= table.max_label], (result > 0)[result <= table.max_label]
+    )
+
+
+def test_separate_objects_without_merged(label_img):
+    single = np.where(label_img == label_img[10, 10, 15], label_img, 0)
+    result, num_split, num_pieces = sseparation.separate_objects(
+        single, object_table(single)
+    )
+    assert result is single
+    assert (num_split, num_pieces) == (0, 0)
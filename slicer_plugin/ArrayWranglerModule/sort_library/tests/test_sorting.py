@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+
+from .. import sorting_logic as slogic
+
+# pylint: skip-file
+
+
+def make_trays(rng, levels=3, rows=4, columns=8, tilt=0.0, missing=0.0, jitter=0.8):
+    # centroids of a stack of trays in the classic sorting order
+    # (height - axis 2, rows - axis 0, columns - axis 1), the rows are
+    # rotated by tilt degrees in the plane of a tray
+    angle = np.radians(tilt)
+    points, keys = [], []
+    for level in range(levels):
+        for row in range(rows):
+            for column in range(columns):
+                if rng.random() < missing:
+                    continue
+                y, x = 25.0 * row, 20.0 * column
+                points.append(
+                    [
+                        y * np.cos(angle) + x * np.sin(angle),
+                        -y * np.sin(angle) + x * np.cos(angle),
+                        40.0 * level,
+                    ]
+                )
+                keys.append((level, row, column))
+    points = np.array(points) + rng.normal(0, jitter, (len(points), 3)) + 200
+    return np.round(points).astype(np.int32), np.array(keys)
+
+
+def baseline_full_remap(level_bases, center_points, levelwise_labels, init_enum, rows):
+    # the original enumeration: KMeans rows on every level,
+    # sorted along the columns axis, one dictionary per level
+    KMeans = pytest.importorskip("sklearn.cluster").KMeans
+    sorder = slogic.sorting_order_classic
+    full_map = {}
+    for level, base in enumerate(level_bases):
+        on_level = levelwise_labels == level
+        points, labels = center_points[on_level], init_enum[on_level]
+        ydata = points[:, sorder["rows"]].reshape(-1, 1)
+        clustered = KMeans(n_clusters=rows, random_state=0).fit(ydata)
+        centers = np.round(clustered.cluster_centers_.flatten()).astype(np.int32)
+        ranks = np.argsort(np.argsort(centers))[clustered.labels_]
+        counter = base
+        for row in range(rows):
+            on_row = ranks == row
+            for label in labels[on_row][np.argsort(points[on_row, sorder["columns"]])]:
+                counter += 1
+                full_map[label] = counter
+    return full_map
+
+
+@pytest.mark.parametrize("method", ["optimal", "kmeans", "gaps", "lattice"])
+@pytest.mark.parametrize("seed", range(3))
+def test_full_remap_matches_baseline(method, seed):
+    if method == "kmeans":
+        pytest.importorskip("sklearn")
+    rng = np.random.default_rng(seed)
+    points, keys = make_trays(rng)
+    init_enum = rng.permutation(len(points)) + 1
+    levels = keys[:, 0]
+    bases = [100, 200, 300]
+    expected = baseline_full_remap(bases, points, levels, init_enum, rows=4)
+    old_labels, new_labels = slogic.full_remap(
+        bases, points, levels, init_enum, 4, debug=False, method=method
+    )
+    assert dict(zip(old_labels.tolist(), new_labels.tolist())) == expected
+
+
+@pytest.mark.parametrize("tilt", [-15, -8, 0, 5, 12, 18])
+@pytest.mark.parametrize("missing", [0.0, 0.25])
+def test_fit_lattice_on_tilted_trays(tilt, missing):
+    rng = np.random.default_rng(int(tilt * 10 + missing * 100) % 997)
+    points, keys = make_trays(rng, levels=1, rows=5, columns=12, tilt=tilt)
+    keep = rng.random(len(points)) >= missing
+    points, keys = points[keep], keys[keep]
+    rows, columns, along = slogic.fit_lattice(points, 0, debug=False)
+    np.testing.assert_array_equal(rows, keys[:, 1])
+    # missing objects leave gaps in the column numbers
+    np.testing.assert_array_equal(
+        columns - columns.min(), keys[:, 2] - keys[:, 2].min()
+    )
+    np.testing.assert_array_equal(
+        np.lexsort((along, columns, rows)), np.lexsort((keys[:, 2], keys[:, 1]))
+    )
+
+
+@pytest.mark.parametrize("method", ["optimal", "lattice"])
+def test_level_sort_on_tilted_tray(method):
+    rng = np.random.default_rng(7)
+    tilt = 10 if method == "lattice" else 2
+    points, keys = make_trays(rng, levels=1, rows=4, columns=9, tilt=tilt)
+    labels = rng.permutation(len(points)) + 1
+    remap = slogic.level_sort(
+        points, labels, 4, mapping_base=200, debug=False, method=method
+    )
+    expected_order = labels[np.lexsort((keys[:, 2], keys[:, 1]))]
+    assert [remap[label] for label in expected_order] == list(
+        range(201, 201 + len(points))
+    )
+
+
+def test_full_remap_passes_min_gap_to_row_detection():
+    rng = np.random.default_rng(3)
+    points, keys = make_trays(rng, levels=2, rows=3, columns=6)
+    init_enum = np.arange(1, len(points) + 1)
+    # rows 25 voxels apart are not split at gaps below 30
+    old_labels, _ = slogic.full_remap(
+        [100, 200], points, keys[:, 0], init_enum, 0, debug=False, min_gap=30
+    )
+    order = np.lexsort((points[:, 1], keys[:, 0]))
+    np.testing.assert_array_equal(old_labels, init_enum[order])
+
+
+def test_full_remap_detects_rows_and_reverses_directions():
+    rng = np.random.default_rng(11)
+    points, keys = make_trays(rng, levels=2, rows=3, columns=6)
+    sorder = dict(slogic.sorting_order_classic, rows_direction=-1, columns_direction=-1)
+    init_enum = np.arange(1, len(points) + 1)
+    old_labels, new_labels = slogic.full_remap(
+        [100, 200], points, keys[:, 0], init_enum, 0, sorder, debug=False
+    )
+    order = np.lexsort((-keys[:, 2], -keys[:, 1], keys[:, 0]))
+    np.testing.assert_array_equal(old_labels, init_enum[order])
+    assert new_labels[:3].tolist() == [101, 102, 103]
+    assert new_labels[18:21].tolist() == [201, 202, 203]
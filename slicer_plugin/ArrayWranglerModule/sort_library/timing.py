@@ -0,0 +1,56 @@
+import logging
+import time
+from contextlib import contextmanager
+
+# pylint: skip-file
+
+# Per-stage timing of an operation: export, processing, import, surfaces...
+# Stages with the same name are summed up, so a stage entered in a loop
+# (or by nested calls) is reported once, in the order of its first entry.
+
+
+class StageTimer:
+    """
+    Wall-clock durations of the named stages of one operation.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.stages = {}  # stage name -> seconds, in the order of first entry
+        self.start = time.perf_counter()
+        self.seconds = None  # total duration, set by stop()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Context manager adding the duration of the block to the stage name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def stop(self):
+        """
+        Fix the total duration of the operation.
+        """
+        self.seconds = time.perf_counter() - self.start
+
+    @property
+    def total_seconds(self):
+        if self.seconds is None:
+            return time.perf_counter() - self.start
+        return self.seconds
+
+    def report(self):
+        """
+        Returns a one-line report like "processApply: 3.20 s (label 0.80 s,
+        import 1.10 s, surface 1.20 s)".
+        """
+        stages = ", ".join(f"{name} {sec:.2f} s" for name, sec in self.stages.items())
+        return f"{self.name}: {self.total_seconds:.2f} s ({stages})"
+
+    def log(self):
+        logging.info(self.report())